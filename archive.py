@@ -0,0 +1,126 @@
+#######################################################
+# Imports #############################################
+#######################################################
+from common import logger
+
+import glob
+import gzip
+import json
+import os
+import threading
+import typing
+import zlib
+
+#######################################################
+# Globals #############################################
+#######################################################
+"""
+Keeps the raw output of every traceroute so it can be parsed and analysed again later without
+tracing again (see reanalyze.py). An archive is a folder of gzipped JSON-lines segments, one per
+run and process, only ever appended to:
+
+<root>/20230719T055023-4242.jsonl.gz
+
+{"target": "93.184.216.34", "backend": "win32", "run": "20230719T055023", "state": "Texas", "time": 1689745823.9, "duration": 8.2, "output": "\\nTracing route to ..."}
+
+Each record is written as its own gzip member, so a process that dies mid-write only loses the
+record it was writing. Readers stop at a truncated member and keep everything before it.
+"""
+
+SEGMENT_SUFFIX = ".jsonl.gz"
+# Small records don't compress much better at higher levels, and this is on the tracing path.
+COMPRESS_LEVEL = 6
+
+#######################################################
+# Classes #############################################
+#######################################################
+class Record(typing.TypedDict):
+	target: str
+	backend: str
+	run: str | None
+	state: str | None
+	time: float  # When the trace started, seconds since the epoch
+	duration: float
+	output: str
+
+class TraceArchive:
+	"""
+	Appends traceroute output to the archive under `root`. Like cache.SQLiteCache, the file is
+	opened lazily and per process, so pool workers each get a segment of their own.
+	"""
+
+	def __init__(self, root: str, run_id: str = None, state: str = None):
+		self.root = root
+		# Set by tracer.main before tracing starts, and handed to pool workers with the archive.
+		self.run_id = run_id
+		self.state = state
+
+		self._file = None
+		self._pid = None
+		self._lock = threading.Lock()
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		state["_file"] = None
+		state["_pid"] = None
+		state["_lock"] = None
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self._lock = threading.Lock()
+
+	def segment_path(self) -> str:
+		return os.path.join(self.root, f"{self.run_id or 'run'}-{os.getpid()}{SEGMENT_SUFFIX}")
+
+	@property
+	def file(self) -> typing.BinaryIO:
+		if self._file is None or self._pid != os.getpid():
+			os.makedirs(self.root, exist_ok=True)
+			self._file = open(self.segment_path(), "ab")
+			self._pid = os.getpid()
+
+		return self._file
+
+	def append(self, target: str, backend: str, started: float, duration: float, output: str):
+		record: Record = {"target": target, "backend": backend, "run": self.run_id, "state": self.state, "time": started, "duration": duration, "output": output}
+		data = gzip.compress(bytes(json.dumps(record) + "\n", "utf-8"), compresslevel=COMPRESS_LEVEL)
+
+		if self._pid != os.getpid():
+			# A lock copied over by fork could be held by a thread that doesn't exist here.
+			self._lock = threading.Lock()
+
+		with self._lock:
+			self.file.write(data)
+			self.file.flush()
+
+	def close(self):
+		if self._file is not None and self._pid == os.getpid():
+			self._file.close()
+
+		self._file = None
+		self._pid = None
+
+#######################################################
+# Functions ###########################################
+#######################################################
+def segments(root: str) -> list[str]:
+	return sorted(glob.glob(os.path.join(root, f"*{SEGMENT_SUFFIX}")))
+
+def read_segment(path: str) -> typing.Iterator[Record]:
+	"""
+	Yields every complete record in a segment, stopping at a truncated tail.
+	"""
+	try:
+		with gzip.open(path, "rt", encoding="utf-8") as f:
+			for line in f:
+				try:
+					yield json.loads(line)
+				except json.JSONDecodeError:
+					logger.warning(f"Skipping unreadable record in {path}")
+	except (EOFError, gzip.BadGzipFile, zlib.error) as err:
+		logger.warning(f"Archive segment {path} ends in a partial record, ignoring it ({err})")
+
+def read(root: str) -> typing.Iterator[Record]:
+	for path in segments(root):
+		yield from read_segment(path)
@@ -0,0 +1,311 @@
+#######################################################
+# Imports #############################################
+#######################################################
+import os
+import sys
+
+# The benchmarks live one folder down from the modules they measure.
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import standins
+import tracer
+from common import logger
+
+import datetime
+import glob
+import json
+import logging
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import typing
+
+#######################################################
+# Globals #############################################
+#######################################################
+"""
+Offline benchmarks for the tracer pipeline. Nothing touches the network: traces are replayed
+from recorded tracert output in fixtures/tracert, and Cymru and RIPE are replaced by the local
+stand-ins in standins.py.
+
+python benchmarks/bench.py
+python benchmarks/bench.py --benchmark main --size 100000
+python benchmarks/bench.py --latency 0.05 --noresults
+
+Each benchmark is timed on its own, then run again under tracemalloc for its peak memory. Results
+are appended to results.jsonl along with the commit they were measured at, and compared against
+the last result for the same benchmark, size and host from a different commit.
+
+Every target gets its own address (see target_ip) and one of the fixtures, rewritten so the
+trace ends at that address. The on-disk caches are turned off and the RPKI rate limit is lifted,
+so what gets measured is the code rather than the caches or politeness towards RIPE.
+"""
+
+FIXTURE_DIR = os.path.join(BENCH_DIR, "fixtures", "tracert")
+RESULTS_PATH = os.path.join(BENCH_DIR, "results.jsonl")
+
+SIZES = [1000, 10000, 100000]
+REPEAT = 1
+
+# Targets are spread over 1.0.0.0 - 223.255.255.255 with a multiplicative hash, so they land in
+# all sorts of prefixes (and now and then in private space).
+TARGET_START = 1 << 24
+TARGET_SPAN = 223 << 24
+TARGET_MULTIPLIER = 2654435761
+
+BENCH_RPKI_RATE_LIMIT = 1_000_000
+
+#######################################################
+# Classes #############################################
+#######################################################
+class Result(typing.TypedDict):
+	commit: str
+	dirty: bool
+	timestamp: str
+	host: str
+	python: str
+	benchmark: str
+	size: int
+	seconds: float
+	per_second: float
+	peak_memory_mb: float | None
+
+#######################################################
+# Functions ###########################################
+#######################################################
+def target_ip(index: int) -> str:
+	return standins.int_to_ip(TARGET_START + (index * TARGET_MULTIPLIER) % TARGET_SPAN)
+
+def load_fixtures() -> list[tuple[str, str]]:
+	"""
+	:return: (recorded destination, tracert output) for every fixture.
+	"""
+	fixtures = []
+	for path in sorted(glob.glob(os.path.join(FIXTURE_DIR, "*.txt"))):
+		with open(path) as f:
+			output = f.read()
+
+		_, destination = tracer.parse_output(output)
+		fixtures.append((destination, output))
+
+	return fixtures
+
+def replay_outputs(size: int) -> dict[str, str]:
+	"""
+	:return: target -> tracert output, for `size` targets.
+	"""
+	fixtures = load_fixtures()
+	outputs = {}
+	for index in range(size):
+		destination, output = fixtures[index % len(fixtures)]
+		target = target_ip(index)
+		outputs[target] = output.replace(destination, target)
+
+	return outputs
+
+def bench_parse_output(size: int) -> typing.Callable[[], None]:
+	outputs = list(replay_outputs(size).values())
+
+	def run():
+		for output in outputs:
+			tracer.parse_output(output)
+
+	return run
+
+def bench_mapToASes(size: int) -> typing.Callable[[], None]:
+	ips = []
+	for output in replay_outputs(size).values():
+		hops, _ = tracer.parse_output(output)
+		ips += [hop["ip"] for hop in hops]
+
+	def run():
+		tracer.mapToASes(ips)
+
+	return run
+
+def bench_get_rpki_data(size: int) -> typing.Callable[[], None]:
+	pairs = [standins.whois_answer(target_ip(index)) for index in range(size)]
+	pairs = [pair for pair in pairs if pair[1] != "NA"]
+
+	def run():
+		for asn, prefix in pairs:
+			tracer.get_rpki_data(asn, prefix)
+
+	return run
+
+def bench_main(size: int) -> typing.Callable[[], None]:
+	outputs = replay_outputs(size)
+	targets = list(outputs.keys())
+
+	def replay_traceroute(addresses: list[str] | str, backend: str = None, targets: list[str] = None) -> list[tracer.TracerouteResult]:
+		if type(addresses) == str:
+			addresses = [addresses]
+
+		return [tracer.make_result(*tracer.parse_output(outputs[address])) for address in addresses]
+
+	def run():
+		tracer.traceroute = replay_traceroute
+		try:
+			with tempfile.TemporaryDirectory() as folder:
+				tracer.main(
+					targets,
+					outfolder=os.path.join(folder, "out"),
+					multiprocessing=False,
+					dataset_root=os.path.join(folder, "dataset"),
+					latex_tables=False
+				)
+		finally:
+			tracer.traceroute = TRACEROUTE
+
+	return run
+
+def measure(prepare: typing.Callable[[int], typing.Callable[[], None]], size: int, repeat: int, memory: bool) -> (float, float | None):
+	"""
+	:return: Best time out of `repeat` runs in seconds, and peak traced memory in MB.
+	"""
+	run = prepare(size)
+
+	best = None
+	for _ in range(repeat):
+		start = time.perf_counter()
+		run()
+		elapsed = time.perf_counter() - start
+		best = (best is None and elapsed) or min(best, elapsed)
+
+	peak = None
+	if memory:
+		tracemalloc.start()
+		try:
+			run()
+			peak = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+		finally:
+			tracemalloc.stop()
+
+	return best, peak
+
+def git_commit() -> (str, bool):
+	root = os.path.dirname(BENCH_DIR)
+	try:
+		commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=root, capture_output=True, text=True, check=True).stdout.strip()
+		status = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=root, capture_output=True, text=True, check=True).stdout
+	except (OSError, subprocess.CalledProcessError):
+		return "unknown", True
+
+	return commit, status.strip() != ""
+
+def load_results(path: str) -> list[Result]:
+	if not os.path.exists(path):
+		return []
+
+	with open(path) as f:
+		return [json.loads(line) for line in f if line.strip()]
+
+def previous_result(results: list[Result], result: Result) -> Result | None:
+	"""
+	:return: The latest stored result for the same benchmark, size and host from another commit.
+	"""
+	for old in reversed(results):
+		if (old["benchmark"], old["size"], old["host"]) == (result["benchmark"], result["size"], result["host"]) and old["commit"] != result["commit"]:
+			return old
+
+	return None
+
+def change_string(new: float | None, old: float | None) -> str:
+	if new is None or not old:
+		return "-"
+
+	return f"{(new - old) / old * 100:+.1f}%"
+
+def run_benchmarks(benchmarks: list[str], sizes: list[int], repeat: int, memory: bool, results_path: str = None) -> list[Result]:
+	commit, dirty = git_commit()
+	stored = load_results(results_path) if results_path else []
+	results = []
+
+	for name in benchmarks:
+		for size in sizes:
+			print(f"Running {name} at {size} target(s)", file=sys.stderr, flush=True)
+			seconds, peak = measure(BENCHMARKS[name], size, repeat, memory)
+
+			result: Result = {
+				"commit": commit,
+				"dirty": dirty,
+				"timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+				"host": platform.node(),
+				"python": platform.python_version(),
+				"benchmark": name,
+				"size": size,
+				"seconds": round(seconds, 4),
+				"per_second": round(size / seconds, 1),
+				"peak_memory_mb": round(peak, 2) if peak is not None else None,
+			}
+			results.append(result)
+
+			old = previous_result(stored, result)
+			print(
+				f"{name:<14} {size:>7}  {result['seconds']:>9.3f}s  {result['per_second']:>10.1f}/s  "
+				f"{(peak is not None and f'{peak:.1f}MB') or '-':>9}  "
+				f"vs {(old and old['commit']) or '-'}: time {change_string(result['seconds'], old and old['seconds'])}, "
+				f"memory {change_string(result['peak_memory_mb'], old and old['peak_memory_mb'])}",
+				flush=True
+			)
+
+			if results_path:
+				with open(results_path, "a") as f:
+					f.write(json.dumps(result) + "\n")
+
+	return results
+
+#######################################################
+# Initialization ######################################
+#######################################################
+TRACEROUTE = tracer.traceroute
+
+BENCHMARKS: dict[str, typing.Callable[[int], typing.Callable[[], None]]] = {
+	"parse_output": bench_parse_output,
+	"mapToASes": bench_mapToASes,
+	"get_rpki_data": bench_get_rpki_data,
+	"main": bench_main,
+}
+
+parser = tracer.HelpParser(
+	prog="bench.py",
+	description="Benchmarks the tracer pipeline offline against recorded traces and local stand-in services.",
+	epilog=None
+)
+
+parser.add_argument("--benchmark", action="append", type=str, choices=list(BENCHMARKS.keys()), help="Only run this benchmark, can be given more than once.")
+parser.add_argument("--size", action="append", type=int, help="Number of targets to run at, can be given more than once. Defaults to 1k, 10k and 100k.")
+parser.add_argument("--repeat", type=int, default=REPEAT, help="Time each benchmark this many times and keep the best.")
+parser.add_argument("--latency", type=float, default=0.0, help="Seconds the stand-in services wait before answering each query.")
+parser.add_argument("--nomemory", action="store_true", help="Skip the extra tracemalloc run that measures peak memory.")
+parser.add_argument("--results", type=str, default=RESULTS_PATH, help="File to append results to.")
+parser.add_argument("--noresults", action="store_true", help="Don't store the results.")
+parser.add_argument("--verbose", action="store_true", help="Keep the pipeline's own logging.")
+
+if __name__ == "__main__":
+	args = parser.parse_args()
+
+	if not args.verbose:
+		# Also quiets asyncio's per-loop debug messages.
+		logging.getLogger().setLevel(logging.ERROR)
+		logger.setLevel(logging.ERROR)
+
+	tracer.RPKI_CACHE = None
+	tracer.AS_CACHE = None
+	tracer.PATH_CACHE = None
+	tracer.RPKI_RATE_LIMIT = BENCH_RPKI_RATE_LIMIT
+
+	with standins.Standins(latency=args.latency) as services:
+		tracer.CYMRU_WHOIS = services.whois_address
+		tracer.RIPE_RPKI = services.ripe_url
+
+		run_benchmarks(
+			args.benchmark or list(BENCHMARKS.keys()),
+			args.size or SIZES,
+			args.repeat,
+			memory=not args.nomemory,
+			results_path=(not args.noresults and args.results) or None
+		)
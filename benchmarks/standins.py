@@ -0,0 +1,198 @@
+#######################################################
+# Imports #############################################
+#######################################################
+import argparse
+import hashlib
+import http.server
+import json
+import multiprocessing as mp
+import socketserver
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+#######################################################
+# Globals #############################################
+#######################################################
+"""
+Local stand-ins for the services tracer.py talks to, so benchmarks don't depend on (or hammer)
+whois.cymru.com and stat.ripe.net:
+
+- A TCP server speaking Cymru's bulk whois protocol (begin / verbose / one IP per line / end).
+- An HTTP server answering RIPEstat's rpki-validation data call.
+
+Answers are a pure function of the query, so every run sees the same ASes, prefixes and
+statuses. Private space comes back as NA like it does from Cymru.
+
+The servers run in their own process so they don't compete with the code being measured for
+the GIL. They can also be run on their own:
+
+python benchmarks/standins.py --whoisport 4343 --ripeport 8080 --latency 0.02
+"""
+
+# 10.0.0.0/8, 100.64.0.0/10, 127.0.0.0/8, 172.16.0.0/12, 192.168.0.0/16
+PRIVATE_PREFIXES = [(10 << 24, 8), ((100 << 24) | (64 << 16), 10), (127 << 24, 8), ((172 << 24) | (16 << 16), 12), ((192 << 24) | (168 << 16), 16)]
+
+# Announced prefixes are the /16 around each IP.
+STANDIN_PREFIX_LENGTH = 16
+
+STATUSES = ["valid", "valid", "valid", "unknown", "unknown", "invalid_asn", "invalid_length"]
+
+#######################################################
+# Classes #############################################
+#######################################################
+class CymruHandler(socketserver.StreamRequestHandler):
+	latency = 0.0
+
+	def handle(self):
+		ips = []
+		for line in self.rfile:
+			line = str(line, "ascii").strip()
+			if line == "end":
+				break
+			elif line in ("begin", "verbose", ""):
+				continue
+
+			ips.append(line)
+
+		time.sleep(self.latency)
+
+		lines = ["Bulk mode; whois.cymru.com [2023-07-19 04:06:45 +0000]"]
+		for ip in ips:
+			asn, prefix = whois_answer(ip)
+			if asn == "NA":
+				lines.append(f"NA      | {ip:16} | NA                  |    | other    |            | NA")
+			else:
+				lines.append(f"{asn:<7} | {ip:16} | {prefix:19} | US | arin     | 2017-06-27 | STANDIN-{asn}, US")
+
+		self.wfile.write(bytes("\n".join(lines) + "\n", "ascii"))
+
+class RIPEHandler(http.server.BaseHTTPRequestHandler):
+	latency = 0.0
+	protocol_version = "HTTP/1.1"
+
+	def do_GET(self):
+		query = parse_qs(urlparse(self.path).query)
+		asn = query.get("resource", [""])[0]
+		prefix = query.get("prefix", [""])[0]
+
+		time.sleep(self.latency)
+
+		body = json.dumps({
+			"data": {
+				"validating_roas": [],
+				"status": rpki_answer(asn, prefix),
+				"validator": "standin",
+				"resource": asn,
+				"prefix": prefix
+			},
+			"status": "ok",
+			"status_code": 200
+		}).encode()
+
+		self.send_response(200)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, *args):
+		pass
+
+class ThreadingTCPServer(socketserver.ThreadingTCPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+class Standins:
+	"""
+	Runs both stand-ins in a child process. Use as a context manager, the ports are available
+	once it's entered.
+	"""
+	def __init__(self, latency: float = 0.0, whois_port: int = 0, ripe_port: int = 0):
+		self.latency = latency
+		self.requested_ports = (whois_port, ripe_port)
+		self.whois_port = None
+		self.ripe_port = None
+		self.process = None
+
+	@property
+	def whois_address(self) -> tuple[str, int]:
+		return ("127.0.0.1", self.whois_port)
+
+	@property
+	def ripe_url(self) -> str:
+		# Same shape as tracer.RIPE_RPKI
+		return f"http://127.0.0.1:{self.ripe_port}/data/rpki-validation/data.json?resource={{}}&prefix={{}}"
+
+	def __enter__(self) -> "Standins":
+		ports = mp.Queue()
+		self.process = mp.Process(target=serve, args=(self.latency, *self.requested_ports, ports), daemon=True)
+		self.process.start()
+		self.whois_port, self.ripe_port = ports.get(timeout=30)
+		return self
+
+	def __exit__(self, *exc):
+		self.process.terminate()
+		self.process.join()
+
+#######################################################
+# Functions ###########################################
+#######################################################
+def ip_to_int(ip: str) -> int:
+	a, b, c, d = ip.split(".")
+	return (int(a) << 24) | (int(b) << 16) | (int(c) << 8) | int(d)
+
+def int_to_ip(value: int) -> str:
+	return f"{value >> 24 & 255}.{value >> 16 & 255}.{value >> 8 & 255}.{value & 255}"
+
+def whois_answer(ip: str) -> (str, str):
+	"""
+	:return: (asn, prefix), or ("NA", "NA") for private space.
+	"""
+	value = ip_to_int(ip)
+	for network, length in PRIVATE_PREFIXES:
+		if value >> (32 - length) == network >> (32 - length):
+			return "NA", "NA"
+
+	mask = (0xFFFFFFFF << (32 - STANDIN_PREFIX_LENGTH)) & 0xFFFFFFFF
+	network = value & mask
+	# Neighbouring prefixes share an origin now and then, like they do in real tables.
+	asn = 1000 + (network >> (32 - STANDIN_PREFIX_LENGTH)) // 4
+	return str(asn), f"{int_to_ip(network)}/{STANDIN_PREFIX_LENGTH}"
+
+def rpki_answer(asn: str, prefix: str) -> str:
+	digest = hashlib.blake2b(bytes(f"{asn} {prefix}", "ascii"), digest_size=4).digest()
+	return STATUSES[int.from_bytes(digest, "big") % len(STATUSES)]
+
+def serve(latency: float, whois_port: int, ripe_port: int, ports: mp.Queue = None):
+	CymruHandler.latency = latency
+	RIPEHandler.latency = latency
+
+	whois = ThreadingTCPServer(("127.0.0.1", whois_port), CymruHandler)
+	ripe = http.server.ThreadingHTTPServer(("127.0.0.1", ripe_port), RIPEHandler)
+	ripe.daemon_threads = True
+
+	if ports is not None:
+		ports.put((whois.server_address[1], ripe.server_address[1]))
+	else:
+		print(f"Cymru whois stand-in on 127.0.0.1:{whois.server_address[1]}, RIPE stand-in on 127.0.0.1:{ripe.server_address[1]}")
+
+	# The whois server gets a thread of its own, RIPE runs on this one.
+	threading.Thread(target=whois.serve_forever, daemon=True).start()
+	ripe.serve_forever()
+
+#######################################################
+# Initialization ######################################
+#######################################################
+parser = argparse.ArgumentParser(
+	prog="standins.py",
+	description="Runs local stand-ins for the Cymru bulk whois and RIPEstat rpki-validation services."
+)
+
+parser.add_argument("--whoisport", type=int, default=4343, help="Port for the Cymru bulk whois stand-in.")
+parser.add_argument("--ripeport", type=int, default=8080, help="Port for the RIPEstat stand-in.")
+parser.add_argument("--latency", type=float, default=0.0, help="Seconds to wait before answering each query.")
+
+if __name__ == "__main__":
+	args = parser.parse_args()
+	serve(args.latency, args.whoisport, args.ripeport)
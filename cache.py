@@ -0,0 +1,437 @@
+#######################################################
+# Imports #############################################
+#######################################################
+from common import logger
+
+import json
+import os
+import socket
+import sqlite3
+import time
+
+#######################################################
+# Globals #############################################
+#######################################################
+RPKI_CACHE_PATH = "./rpki_cache.sqlite3"
+RPKI_CACHE_TTL = 60 * 60 * 24  # Seconds. ROAs don't change often, a day is plenty fresh.
+RPKI_CACHE_MAX_ENTRIES = 500_000
+
+AS_CACHE_PATH = "./as_cache.sqlite3"
+AS_CACHE_TTL = 60 * 60 * 24 * 7  # Seconds. Prefix origins are pretty stable.
+AS_CACHE_MAX_ENTRIES = 1_000_000
+
+PATH_CACHE_PATH = "./path_cache.sqlite3"
+# Seconds. A path that hasn't changed reuses its AS and RPKI data until the entry expires, so this
+# is also how stale an RPKI status can get on a stable path.
+PATH_CACHE_TTL = 60 * 60 * 24 * 7
+PATH_CACHE_MAX_ENTRIES = 1_000_000
+
+DNS_CACHE_PATH = "./dns_cache.sqlite3"
+DNS_CACHE_TTL = 60 * 60  # Seconds. The system resolver doesn't tell us the record's TTL, so assume an hour.
+DNS_CACHE_NEGATIVE_TTL = 60 * 5  # Seconds to remember that a name didn't resolve.
+DNS_CACHE_MAX_ENTRIES = 5_000_000
+
+# Most parameters SQLite takes in one statement, for the IN (...) lookups.
+SQLITE_MAX_PARAMS = 900
+
+# Checking the size of the table isn't free, so only do it every so many writes.
+EVICT_INTERVAL = 1000
+
+# How long a connection waits on another process' write lock before giving up.
+SQLITE_TIMEOUT = 30
+
+#######################################################
+# Classes #############################################
+#######################################################
+class SQLiteCache:
+	"""
+	Base for the persistent caches. Connections are opened lazily and per process, since sqlite3
+	connections can't be shared across a fork. WAL mode lets the worker processes read while
+	another one is writing.
+	"""
+
+	SCHEMA = ""
+	# Table that evict() trims, it needs a "fetched" column.
+	TABLE = ""
+
+	def __init__(self, path: str, ttl: float, max_entries: int = None):
+		self.path = path
+		self.ttl = ttl
+		self.max_entries = max_entries
+
+		self._conn = None
+		self._pid = None
+		self._writes = 0
+
+	def __getstate__(self):
+		# Only the settings get sent to pool workers, they'll open their own connection.
+		state = self.__dict__.copy()
+		state["_conn"] = None
+		state["_pid"] = None
+		return state
+
+	@property
+	def conn(self) -> sqlite3.Connection:
+		if self._conn is None or self._pid != os.getpid():
+			folder = os.path.dirname(self.path)
+			if folder:
+				os.makedirs(folder, exist_ok=True)
+
+			# Enrichment runs on a background thread in tracer.main, access is never concurrent within a process.
+			self._conn = sqlite3.connect(self.path, timeout=SQLITE_TIMEOUT, isolation_level=None, check_same_thread=False)
+			self._conn.execute("PRAGMA journal_mode=WAL")
+			self._conn.execute("PRAGMA synchronous=NORMAL")
+			self._conn.executescript(self.SCHEMA)
+			self._pid = os.getpid()
+
+		return self._conn
+
+	def close(self):
+		if self._conn is not None and self._pid == os.getpid():
+			self._conn.close()
+
+		self._conn = None
+		self._pid = None
+
+	def expired_before(self) -> float:
+		return time.time() - self.ttl
+
+	def select_many(self, columns: str, keys: list[str], values: list[tuple], cutoff: float) -> list[tuple]:
+		"""
+		Fetches the rows whose `keys` columns match any of `values` and that were fetched at or after
+		cutoff, with as few queries as SQLITE_MAX_PARAMS allows. The values are joined against the
+		table, so each one is a primary key lookup however big the table is.
+
+		:param columns: What to select, e.g. "name, address".
+		:param keys: The key columns, e.g. ["asn", "prefix"].
+		:param values: A tuple of key values per row to fetch.
+		"""
+		row = f"({', '.join('?' * len(keys))})"
+		join = " AND ".join(f"t.{key} = k.column{i + 1}" for i, key in enumerate(keys))
+		select = ", ".join(f"t.{column.strip()}" for column in columns.split(","))
+		chunk_size = max(1, SQLITE_MAX_PARAMS // len(keys))
+
+		rows = []
+		for i in range(0, len(values), chunk_size):
+			chunk = values[i:i + chunk_size]
+			rows += self.conn.execute(
+				f"SELECT {select} FROM (VALUES {', '.join([row] * len(chunk))}) AS k CROSS JOIN {self.TABLE} AS t ON {join} WHERE t.fetched >= ?",
+				(*[value for key in chunk for value in key], cutoff)
+			).fetchall()
+
+		return rows
+
+	def write_many(self, sql: str, rows: list[tuple]):
+		"""
+		Runs an INSERT OR REPLACE for every row in one transaction.
+		"""
+		if len(rows) == 0:
+			return
+
+		conn = self.conn
+		conn.execute("BEGIN IMMEDIATE")
+		try:
+			conn.executemany(sql, rows)
+			conn.execute("COMMIT")
+		except Exception:
+			conn.execute("ROLLBACK")
+			raise
+
+		self.wrote(len(rows))
+
+	def wrote(self, count: int):
+		self._writes += count
+		if self._writes >= EVICT_INTERVAL:
+			self._writes = 0
+			self.evict()
+
+	def evict(self):
+		"""
+		Drops expired rows, then the oldest rows until we're back under max_entries.
+		"""
+		conn = self.conn
+		conn.execute(f"DELETE FROM {self.TABLE} WHERE fetched < ?", (self.expired_before(),))
+
+		if self.max_entries:
+			count = conn.execute(f"SELECT COUNT(*) FROM {self.TABLE}").fetchone()[0]
+			overflow = count - self.max_entries
+			if overflow > 0:
+				logger.debug(f"{self.TABLE} cache over capacity by {overflow}, evicting oldest entries")
+				conn.execute(
+					f"DELETE FROM {self.TABLE} WHERE rowid IN (SELECT rowid FROM {self.TABLE} ORDER BY fetched ASC LIMIT ?)",
+					(overflow,)
+				)
+
+
+class RPKICache(SQLiteCache):
+	"""
+	Caches RIPEstat rpki-validation responses keyed on (asn, prefix).
+	"""
+
+	SCHEMA = """
+	CREATE TABLE IF NOT EXISTS rpki (
+		asn TEXT NOT NULL,
+		prefix TEXT NOT NULL,
+		data TEXT NOT NULL,
+		fetched REAL NOT NULL,
+		PRIMARY KEY (asn, prefix)
+	);
+	CREATE INDEX IF NOT EXISTS rpki_fetched ON rpki (fetched);
+	"""
+	TABLE = "rpki"
+
+	def __init__(self, path: str = RPKI_CACHE_PATH, ttl: float = RPKI_CACHE_TTL, max_entries: int = RPKI_CACHE_MAX_ENTRIES):
+		super().__init__(path, ttl, max_entries)
+
+	def get(self, asn: str, prefix: str) -> dict | None:
+		row = self.conn.execute(
+			"SELECT data FROM rpki WHERE asn = ? AND prefix = ? AND fetched >= ?",
+			(asn, prefix, self.expired_before())
+		).fetchone()
+
+		if row is None:
+			return None
+
+		return json.loads(row[0])
+
+	def get_many(self, pairs: list[tuple[str, str]]) -> dict[tuple[str, str], dict]:
+		rows = self.select_many("asn, prefix, data", ["asn", "prefix"], list(set(pairs)), self.expired_before())
+		return {(asn, prefix): json.loads(data) for asn, prefix, data in rows}
+
+	def set(self, asn: str, prefix: str, data: dict):
+		self.set_many({(asn, prefix): data})
+
+	def set_many(self, results: dict[tuple[str, str], dict]):
+		if len(results) == 0:
+			return
+
+		now = time.time()
+		rows = [(asn, prefix, json.dumps(data), now) for (asn, prefix), data in results.items()]
+
+		self.write_many("INSERT OR REPLACE INTO rpki (asn, prefix, data, fetched) VALUES (?, ?, ?, ?)", rows)
+
+
+class ASCache(SQLiteCache):
+	"""
+	Caches the BGP prefixes (and their origin AS) that Cymru reports, rather than individual IPs.
+	Any later IP inside a cached prefix can then be mapped without asking Cymru again. IPs that
+	Cymru reports as NA are remembered as /32s with no AS.
+
+	A more specific announcement inside a cached prefix won't be seen until the entry expires,
+	so keep the TTL modest.
+
+	The table is read into memory once per process and new prefixes are added to it as they're
+	stored, so a lookup only costs a dict probe per prefix length in use.
+	"""
+
+	SCHEMA = """
+	CREATE TABLE IF NOT EXISTS as_prefixes (
+		prefix TEXT PRIMARY KEY,
+		asn TEXT NOT NULL,
+		fetched REAL NOT NULL
+	);
+	CREATE INDEX IF NOT EXISTS as_prefixes_fetched ON as_prefixes (fetched);
+	"""
+	TABLE = "as_prefixes"
+
+	def __init__(self, path: str = AS_CACHE_PATH, ttl: float = AS_CACHE_TTL, max_entries: int = AS_CACHE_MAX_ENTRIES):
+		super().__init__(path, ttl, max_entries)
+
+		# prefix length -> network address -> (asn, prefix, fetched), read once per process and
+		# kept up to date by set_many.
+		self._routes: dict[int, dict[int, tuple[str, str, float]]] = None
+		self._lengths: list[int] = []
+		self._routes_pid = None
+
+	def __getstate__(self):
+		state = super().__getstate__()
+		state["_routes"] = None
+		state["_lengths"] = []
+		state["_routes_pid"] = None
+		return state
+
+	@property
+	def routes(self) -> dict[int, dict[int, tuple[str, str, float]]]:
+		if self._routes is None or self._routes_pid != os.getpid():
+			self._routes = {}
+			self._lengths = []
+			self._routes_pid = os.getpid()
+
+			rows = self.conn.execute(
+				"SELECT prefix, asn, fetched FROM as_prefixes WHERE fetched >= ?",
+				(self.expired_before(),)
+			).fetchall()
+			self.add_routes(rows)
+
+		return self._routes
+
+	def add_routes(self, rows: list[tuple[str, str, float]]):
+		"""
+		:param rows: (prefix, asn, fetched) rows, later ones replace earlier ones for the same prefix.
+		"""
+		for prefix, asn, fetched in rows:
+			try:
+				address, length = prefix.split("/")
+				network = ip_to_int(address)
+				length = int(length)
+			except (ValueError, OSError):
+				continue
+
+			if length not in self._routes:
+				self._routes[length] = {}
+				self._lengths = sorted(self._routes.keys(), reverse=True)
+
+			self._routes[length][network] = (asn, prefix, fetched)
+
+	def lookup(self, ips: list[str]) -> (dict, list[str]):
+		"""
+		Longest-prefix match against the cached prefixes that haven't expired, most specific length
+		first.
+
+		:return: Mappings for the IPs covered by the cache, and the IPs that aren't.
+		"""
+		routes = self.routes
+		cutoff = self.expired_before()
+
+		data = {}
+		missing = []
+		for ip in ips:
+			try:
+				value = ip_to_int(ip)
+			except (ValueError, OSError):
+				missing.append(ip)
+				continue
+
+			for length in self._lengths:
+				route = routes[length].get(value & ((0xFFFFFFFF << (32 - length)) & 0xFFFFFFFF))
+				if route is not None and route[2] >= cutoff:
+					asn, prefix, _ = route
+					if asn == "NA":
+						data[ip] = {"asn": "NA", "ip": ip, "prefix": "NA"}
+					else:
+						data[ip] = {"asn": asn, "ip": ip, "prefix": prefix}
+					break
+			else:
+				missing.append(ip)
+
+		return data, missing
+
+	def set_many(self, mappings: dict[str, dict]):
+		now = time.time()
+		rows = []
+		for ip, mapping in mappings.items():
+			if mapping["prefix"] == "NA" or mapping["asn"] == "NA":
+				rows.append((f"{ip}/32", "NA", now))
+			elif mapping["asn"].isdigit():
+				rows.append((mapping["prefix"], mapping["asn"], now))
+
+		if len(rows) == 0:
+			return
+
+		self.write_many("INSERT OR REPLACE INTO as_prefixes (prefix, asn, fetched) VALUES (?, ?, ?)", rows)
+
+		if self._routes is not None and self._routes_pid == os.getpid():
+			self.add_routes(rows)
+
+
+class PathCache(SQLiteCache):
+	"""
+	Remembers the last path seen to each target as a fingerprint of its hop IPs (see
+	tracestore.fingerprint), along with each hop's [ip, asn, prefix, status]. If the next trace to
+	the target comes back with the same fingerprint, its hops don't need mapping or validating.
+	"""
+
+	SCHEMA = """
+	CREATE TABLE IF NOT EXISTS paths (
+		target TEXT PRIMARY KEY,
+		fingerprint TEXT NOT NULL,
+		hops TEXT NOT NULL,
+		fetched REAL NOT NULL
+	);
+	CREATE INDEX IF NOT EXISTS paths_fetched ON paths (fetched);
+	"""
+	TABLE = "paths"
+
+	def __init__(self, path: str = PATH_CACHE_PATH, ttl: float = PATH_CACHE_TTL, max_entries: int = PATH_CACHE_MAX_ENTRIES):
+		super().__init__(path, ttl, max_entries)
+
+	def get_many(self, targets: list[str]) -> dict[str, tuple[str, list[list]]]:
+		"""
+		:return: target -> (fingerprint, hops) for every target with a path that hasn't expired.
+		"""
+		rows = self.select_many("target, fingerprint, hops", ["target"], [(target,) for target in set(targets)], self.expired_before())
+		return {target: (fingerprint, json.loads(hops)) for target, fingerprint, hops in rows}
+
+	def set_many(self, paths: dict[str, tuple[str, list[list]]]):
+		if len(paths) == 0:
+			return
+
+		now = time.time()
+		rows = [(target, fingerprint, json.dumps(hops), now) for target, (fingerprint, hops) in paths.items()]
+
+		self.write_many("INSERT OR REPLACE INTO paths (target, fingerprint, hops, fetched) VALUES (?, ?, ?, ?)", rows)
+
+
+class DNSCache(SQLiteCache):
+	"""
+	Caches what target names resolved to. Names that didn't resolve are kept too (with an empty
+	address), but only for negative_ttl.
+	"""
+
+	SCHEMA = """
+	CREATE TABLE IF NOT EXISTS dns (
+		name TEXT PRIMARY KEY,
+		address TEXT NOT NULL,
+		fetched REAL NOT NULL
+	);
+	CREATE INDEX IF NOT EXISTS dns_fetched ON dns (fetched);
+	"""
+	TABLE = "dns"
+
+	def __init__(self, path: str = DNS_CACHE_PATH, ttl: float = DNS_CACHE_TTL, negative_ttl: float = DNS_CACHE_NEGATIVE_TTL, max_entries: int = DNS_CACHE_MAX_ENTRIES):
+		super().__init__(path, ttl, max_entries)
+		self.negative_ttl = negative_ttl
+
+	def get_many(self, names: list[str]) -> dict[str, str | None]:
+		"""
+		:return: name -> address for every name with an entry that hasn't expired, None for the
+		names that are known not to resolve.
+		"""
+		found = {}
+		cutoff = self.expired_before()
+		negative_cutoff = time.time() - self.negative_ttl
+
+		rows = self.select_many("name, address, fetched", ["name"], [(name,) for name in set(names)], cutoff)
+		for name, address, fetched in rows:
+			if address != "":
+				found[name] = address
+			elif fetched >= negative_cutoff:
+				found[name] = None
+
+		return found
+
+	def set_many(self, addresses: dict[str, str | None]):
+		"""
+		:param addresses: name -> address, or None if it didn't resolve.
+		"""
+		if len(addresses) == 0:
+			return
+
+		now = time.time()
+		rows = [(name, address or "", now) for name, address in addresses.items()]
+
+		self.write_many("INSERT OR REPLACE INTO dns (name, address, fetched) VALUES (?, ?, ?)", rows)
+
+
+#######################################################
+# Functions ###########################################
+#######################################################
+def ip_to_int(ip: str) -> int:
+	"""
+	Dotted quad to an integer. Raises ValueError (or OSError) for anything else, including
+	shorthand like "10.1" that inet_aton would take.
+	"""
+	if ip.count(".") != 3:
+		raise ValueError(f"Not an IPv4 address: {ip}")
+
+	return int.from_bytes(socket.inet_aton(ip), "big")
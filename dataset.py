@@ -0,0 +1,183 @@
+#######################################################
+# Imports #############################################
+#######################################################
+import metrics
+from common import logger
+
+import os
+
+import numpy as np
+import pandas as pd
+
+#######################################################
+# Globals #############################################
+#######################################################
+"""
+Columnar output for whole campaigns. Instead of a .csv and .tex per target, every run appends to
+two Parquet datasets under one root, partitioned by state and run:
+
+<root>/hops/state=Texas/run=20230719T055023/part-0.parquet
+<root>/summary/state=Texas/run=20230719T055023/part-0.parquet
+
+Reading a whole campaign (or any slice of it) back is one pd.read_parquet call, see load_table.
+Parquet support comes from pyarrow, which is only needed if this output is used.
+"""
+
+# "trace" is the target's index in the run's target list, so repeated targets stay apart.
+TRACE_COLUMNS = ["trace", "destination", "destination_ip", "completed"]
+# Where each hop is, from tracer.GEO_TABLE (missing when there's none)
+GEO_COLUMNS = ["country", "region", "city"]
+HOP_COLUMNS = ["trace", "target", "destination_ip", "hop", "ip", "prefix", "asn", "status"] + GEO_COLUMNS
+# Columns of the per-target .csv files
+HOP_DATA_COLUMNS = ["hop", "ip", "prefix", "asn", "status"]
+SUMMARY_COLUMNS = ["destination", "destination_ip", "num_unique_prefixes", "num_valid", "num_invalid", "num_notfound", "hops", "completed"]
+PARTITION_COLUMNS = ["state", "run"]
+# Written as strings even when a run has nothing in them, see write_table.
+STRING_COLUMNS = ["target", "destination", "destination_ip", "ip", "prefix", "asn", "status"] + GEO_COLUMNS
+
+HOP_DTYPES = {"trace": int, "hop": int}
+SUMMARY_DTYPES = {"trace": int, "num_unique_prefixes": int, "num_valid": int, "num_invalid": int, "num_notfound": int, "hops": int, "completed": bool}
+
+HOPS_TABLE = "hops"
+SUMMARY_TABLE = "summary"
+
+DEFAULT_STATE = "-"
+
+#######################################################
+# Functions ###########################################
+#######################################################
+def write_table(root: str, table: str, df: pd.DataFrame, state: str, run: str):
+	"""
+	Writes df as the (state, run) partition of a table. Anything already in that partition is
+	replaced, so writing the same run twice (e.g. after a resume) doesn't duplicate rows.
+	"""
+	df = df.copy()
+	df["state"] = state or DEFAULT_STATE
+	df["run"] = run
+
+	path = os.path.join(root, table)
+	os.makedirs(path, exist_ok=True)
+
+	df.to_parquet(
+		path,
+		index=False,
+		schema=arrow_schema(df),
+		partition_cols=PARTITION_COLUMNS,
+		existing_data_behavior="delete_matching",
+		basename_template="part-{i}.parquet"
+	)
+
+	metrics.ROWS_WRITTEN.inc(len(df), table=table)
+	logger.info(f"Wrote {len(df)} row(s) to {table} (state={state}, run={run})")
+
+def arrow_schema(df: pd.DataFrame):
+	"""
+	The pyarrow schema df is written with. Left to itself pyarrow types an all-missing column as
+	null (or double), and every partition of a table then has to be read back as that.
+	"""
+	import pyarrow as pa
+
+	schema = pa.Schema.from_pandas(df, preserve_index=False)
+	for column in STRING_COLUMNS:
+		if column in df.columns:
+			string_type = (isinstance(df[column].dtype, pd.CategoricalDtype) and pa.dictionary(pa.int32(), pa.string())) or pa.string()
+			schema = schema.set(schema.get_field_index(column), pa.field(column, string_type))
+
+	return schema
+
+def write_run(root: str, hops: pd.DataFrame, summary: pd.DataFrame, state: str, run: str):
+	write_table(root, HOPS_TABLE, hops.astype(HOP_DTYPES), state, run)
+	write_table(root, SUMMARY_TABLE, summary.astype(SUMMARY_DTYPES), state, run)
+
+def load_table(root: str, table: str, states: list[str] = None, runs: list[str] = None, columns: list[str] = None, filters: list[tuple] = None) -> pd.DataFrame:
+	"""
+	Loads a table for a whole campaign, or just some states/runs of it. Filters are pushed down to
+	the partition level so unrelated files aren't read.
+
+	:param filters: Any extra pyarrow filters, e.g. [("target", "in", [...])].
+	"""
+	filters = list(filters or [])
+	if states:
+		filters.append(("state", "in", states))
+	if runs:
+		filters.append(("run", "in", runs))
+
+	df = pd.read_parquet(os.path.join(root, table), columns=columns, filters=filters or None)
+
+	# Partition columns come back as categoricals.
+	for column in PARTITION_COLUMNS:
+		if column in df.columns:
+			df[column] = df[column].astype(str)
+
+	return df
+
+def summarize_hops(traces: pd.DataFrame, hops: pd.DataFrame) -> pd.DataFrame:
+	"""
+	Builds the per-trace RPKI summary from a hop-level table in one grouped pass.
+
+	A prefix is only counted the first time it shows up in a trace, and counts towards the status
+	of that first hop. NA prefixes (private or unannounced space) aren't counted at all. Hops whose
+	RPKI lookup failed ("-") still count as a unique prefix, but not towards any status.
+
+	:param traces: TRACE_COLUMNS, one row per trace.
+	:param hops: At least trace, hop, prefix and status from HOP_COLUMNS.
+	:return: SUMMARY_COLUMNS, one row per trace in the same order as traces.
+	"""
+	trace = hops["trace"].to_numpy(dtype=np.int64)
+	hop = hops["hop"].to_numpy(dtype=np.int64)
+
+	# "First occurrence" needs hops in order within each trace. tracer.main already writes them
+	# that way, so only sort if we have to.
+	in_order = len(trace) < 2 or bool(((np.diff(trace) > 0) | ((np.diff(trace) == 0) & (np.diff(hop) > 0))).all())
+	if not in_order:
+		order = np.lexsort((hop, trace))
+		hops = hops.iloc[order]
+		trace = trace[order]
+
+	# Work on integer codes rather than strings, there are only so many prefixes and statuses.
+	prefix_codes, prefixes = pd.factorize(hops["prefix"])
+	status_codes, statuses = pd.factorize(hops["status"])
+
+	counted = prefix_codes != -1
+	na_codes = np.nonzero(np.asarray(prefixes, dtype=object) == "NA")[0]
+	if len(na_codes) > 0:
+		counted &= prefix_codes != na_codes[0]
+
+	key = trace[counted] * (len(prefixes) + 1) + prefix_codes[counted]
+	first = ~pd.Series(key).duplicated(keep="first").to_numpy()
+
+	first_trace = trace[counted][first]
+	first_status = status_codes[counted][first]
+
+	lowered = pd.Series(statuses, dtype=object).str.lower()
+	is_valid = (lowered == "valid").to_numpy()
+	is_invalid = lowered.str.contains("invalid", regex=False).to_numpy()
+	is_unknown = (lowered == "unknown").to_numpy()
+	is_missing = (lowered == "-").to_numpy()
+
+	unexpected = ~(is_valid | is_invalid | is_unknown | is_missing)
+	if unexpected[first_status].any():
+		logger.debug(list(lowered[unexpected]))
+		raise Exception("unknown status")
+
+	invalid_types = np.bincount(first_status, minlength=len(statuses))
+	for code in np.nonzero(is_invalid)[0]:
+		if invalid_types[code] > 0:
+			logger.warning(f"Invalid Type: {lowered[code]} ({invalid_types[code]})")
+
+	flags = pd.DataFrame({
+		"trace": first_trace,
+		"num_unique_prefixes": 1,
+		"num_valid": is_valid[first_status].astype(int),
+		"num_invalid": is_invalid[first_status].astype(int),
+		"num_notfound": is_unknown[first_status].astype(int),
+	})
+
+	counts = flags.groupby("trace").sum()
+	hop_counts = pd.Series(trace).value_counts().rename("hops")
+
+	summary = traces.set_index("trace").join(counts).join(hop_counts)
+	count_columns = ["num_unique_prefixes", "num_valid", "num_invalid", "num_notfound", "hops"]
+	summary[count_columns] = summary[count_columns].fillna(0).astype(int)
+
+	return summary.reset_index()[SUMMARY_COLUMNS]
@@ -1,18 +1,27 @@
+import archive
+import journal
 import tracer
+import workqueue
 
 import json
-import math
 import os
 import shutil
+import time
 import requests
 
-PC_COUNT = 1 # 16
-PC_INDEX = 0
-
 ROOT_DIR = "C:/Users/Public/RPKI"
+# Set to a folder to write one Parquet dataset for the campaign instead of per-target files.
+DATASET_ROOT = None  # "C:/Users/Public/RPKI_dataset"
+# Set to a folder to keep the raw traceroute output for reanalyze.py.
+ARCHIVE_ROOT = None  # "C:/Users/Public/RPKI_archive"
+# Where the states get handed out from, shared by every PC in the campaign: a SQLite file they can
+# all reach, or the URL of workqueue.py serve on one of them.
+QUEUE = workqueue.QUEUE_PATH  # "http://10.0.0.2:8765"
 
 """
-
+Each PC takes the next state off the queue whenever it finishes one, until there are none left.
+States whose PC stops heartbeating go back on the queue for the others, so PCs keep waiting
+around until every state is done rather than leaving as soon as the rest are handed out.
 """
 
 with open("./upload.txt") as f:
@@ -22,41 +31,53 @@ if __name__ == "__main__":
 	with open("./state_ips.json") as f:
 		state_ips = json.load(f)
 
-	STATE_COUNT = len(state_ips)
-	PER_GROUP = math.floor(STATE_COUNT / PC_COUNT)
-	remainder = STATE_COUNT % PER_GROUP
-
-	GROUPS = []
-	for i in range(0, PC_COUNT):
-		s = PER_GROUP * i
-		group = [x for x in range(s, s + PER_GROUP)]
-		GROUPS.append(group)
+	if ARCHIVE_ROOT:
+		tracer.ARCHIVE = archive.TraceArchive(ARCHIVE_ROOT)
 
-	last = GROUPS[len(GROUPS)-1]
-	last += [x for x in range(last[len(last) - 1] + 1, last[len(last) - 1] + remainder + 1)]
+	WORKER = workqueue.worker_name()
+	queue = workqueue.open_queue(QUEUE)
 
-	MY_GROUP = GROUPS[PC_INDEX]
-	print(PC_INDEX, "|", MY_GROUP)
+	# Every PC adds the whole campaign, whichever gets there first queues it.
+	added = queue.add((state, ips) for state, ips in state_ips)
+	print(WORKER, "|", f"{added} state(s) queued", "|", queue.status())
 
+	while True:
+		lease = queue.lease(WORKER)
+		if lease is None:
+			status = queue.status()
+			if status[workqueue.PENDING] + status[workqueue.LEASED] + status["expired"] == 0:
+				break
 
-	for idx, entry in enumerate(state_ips):
-		if idx not in MY_GROUP:
+			# Other PCs still hold some states. If one of them dies, its state comes back here.
+			print(WORKER, "|", "waiting on other PCs", "|", status)
+			time.sleep(workqueue.POLL_INTERVAL)
 			continue
 
-		state, ips = entry
-		if os.path.exists(os.path.join(ROOT_DIR, state)):
+		state, ips = lease.unit, lease.payload
+		state_dir = os.path.join(ROOT_DIR, state)
+		if journal.is_complete(state_dir):
 			print(f"State info for {state} already exists, skipping.")
+			queue.complete(state, WORKER)
 			continue
-			#pass
 
-		print("TRACE_STATE_IPS:", state, len(ips))
-		tracer.main(ip_list=ips, outfolder=os.path.join(ROOT_DIR, state))
+		# A state folder without a finished journal is from a run that died, pick it back up.
+		# LaTeX tables are left for report.py to render from the stored data.
+		print("TRACE_STATE_IPS:", state, len(ips), f"(attempt {lease.attempt})")
+		try:
+			with workqueue.Heartbeat(queue, state, WORKER):
+				tracer.main(ip_list=ips, outfolder=state_dir, resume=True, dataset_root=DATASET_ROOT, state=state, latex_tables=False)
+		except BaseException:
+			queue.release(state, WORKER)
+			raise
+
+		queue.complete(state, WORKER)
+
+	print(WORKER, "|", "queue drained", "|", queue.status())
 
 	split = os.path.split(ROOT_DIR)
-	archive_path = os.path.join(split[0], f"{split[1]}_{PC_INDEX}")
+	archive_path = os.path.join(split[0], f"{split[1]}_{WORKER}")
 
 	shutil.make_archive(archive_path, "zip", ROOT_DIR)
 	r = requests.post(upload_url, files={
 		"upload_file": open(archive_path + ".zip", "rb")
 	})
-
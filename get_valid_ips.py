@@ -1,3 +1,6 @@
+import probe
+
+import bisect
 import ipaddress
 import logging
 import json
@@ -7,15 +10,18 @@ import random
 import re
 import signal
 import subprocess
+import sys
 import time
 import traceback
 import multiprocessing as mp
 
-import pandas as pd
-
 PING_RESULT = r"Reply from [\d.]+"
 pattern = re.compile(PING_RESULT)
 
+# Find hosts with one concurrent ICMP sweep (probe.sweep) instead of a ping subprocess per
+# candidate. Needs Linux and root, otherwise it falls back to ping.
+USE_SWEEP = sys.platform == "linux"
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
@@ -43,35 +49,102 @@ logger.addHandler(file_handler)
 
 the_queue = mp.Queue()
 
+# prefixes_by_state.json is built from the IP2LOCATION DB3 CSV by ip2location.py
 def get_prefixes_by_state():
 	with open("./prefixes_by_state.json") as f:
 		prefixes_by_state = json.load(f)
 
 	return prefixes_by_state
 
-"""
-def get_ranges_by_state():
-	logger.info("reading csv")
-	df = pd.read_csv("IP2LOCATION-LITE-DB3.CSV", names=["start", "end", "country_code", "country", "state", "city"])
+class HostSampler:
+	"""
+	Draws random host addresses out of a set of prefixes without replacement, without ever
+	listing the hosts. Every host is equally likely, so prefixes are weighted by their size.
+
+	The hosts are numbered 0..n-1 across the (collapsed) prefixes. A full-period LCG modulo the
+	next power of two visits every number below it once, and each of its outputs is put through a
+	random bijection of the same range (xorshift-multiply rounds) before anything past n is
+	skipped. The LCG alone would be far from random: modulo a power of two, bit k of its output
+	repeats every 2^(k+1) steps, so the low bits of the hosts (the last octet) would cycle. Mixing
+	keeps it a permutation that only needs the current state to continue, so memory stays
+	O(prefixes) and each draw takes O(log prefixes), however much address space there is.
+	"""
+
+	MIX_ROUNDS = 3
+
+	def __init__(self, prefixes, rng=None):
+		rng = rng or random.Random()
+
+		# Overlapping or adjacent prefixes would otherwise hand out the same host twice.
+		networks = ipaddress.collapse_addresses(ipaddress.ip_network(prefix) for prefix in prefixes)
+
+		# First host and cumulative host count of each network, same hosts as network.hosts()
+		self.starts = []
+		self.ends = []
+		total = 0
+		for network in networks:
+			first = int(network.network_address)
+			count = network.num_addresses
+			if count > 2:
+				first += 1
+				count -= 2
+
+			self.starts.append(first)
+			total += count
+			self.ends.append(total)
+
+		self.total = total
+
+		# Hull-Dobell: c odd and a = 1 (mod 4) give a full period modulo a power of two. a = 1 would
+		# just count up by c, so it's left out.
+		bits = max(3, (total - 1).bit_length())
+		self.modulus = 1 << bits
+		self.multiplier = rng.randrange(4, self.modulus, 4) + 1
+		self.increment = rng.randrange(1, self.modulus, 2)
+		self.state = rng.randrange(self.modulus)
+		self.drawn = 0
+
+		# Odd multipliers and xorshifts are both invertible modulo 2^bits, so mix() is a bijection.
+		self.shift = (bits + 1) // 2
+		self.keys = [rng.randrange(1, self.modulus, 2) for _ in range(self.MIX_ROUNDS)]
+
+	def __len__(self):
+		return self.total - self.drawn
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+		if self.drawn >= self.total:
+			raise StopIteration
+
+		# Less than half the modulus is ever skipped, so this loops twice on average.
+		while True:
+			self.state = (self.multiplier * self.state + self.increment) % self.modulus
+			number = self.mix(self.state)
+			if number < self.total:
+				break
 
-	logger.info("iterating")
-	state_ranges = {}
-	for idx, row in df.iterrows():
-		state = row["state"]
-		if state == "-" or state == "District of Columbia":
-			continue
+		self.drawn += 1
+		return str(ipaddress.ip_address(self.host(number)))
 
-		if state not in state_ranges:
-			state_ranges[state] = []
+	def mix(self, x):
+		mask = self.modulus - 1
+		for key in self.keys:
+			x ^= x >> self.shift
+			x = (x * key) & mask
 
-		state_ranges[state].append([
-			row["start"], row["end"]
-		])
+		return x ^ (x >> self.shift)
 
-	return state_ranges
-"""
+	def host(self, number):
+		i = bisect.bisect_right(self.ends, number)
+		return self.starts[i] + number - (self.ends[i - 1] if i > 0 else 0)
 
 def ping_ip(ip):
+	if sys.platform != "win32":
+		result = subprocess.run(["ping", "-c", "2", "-W", "1", ip], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+		return result.returncode == 0
+
 	cmd = ["ping", "-w", "500", "-n", "2", ip]
 	cmd = " ".join(cmd)
 
@@ -86,20 +159,19 @@ def get_ips_by_state(state, how_many, prefixes):
 
 	logger.info(f"get_ips_by_state({state})")
 
-	all_hosts = []
-	for i, prefix in enumerate(prefixes):
-		network = ipaddress.ip_network(prefix)
-		all_hosts += [str(host) for host in network.hosts() if random.randint(1, 10) <= 1]
-
-	logger.info(f"begin {state} ({len(all_hosts)})")
+	hosts = HostSampler(prefixes)
 
-	while len(state_ips) < how_many:
-		idx = random.randint(0, len(all_hosts) - 1)
-		ip = all_hosts.pop(idx)
+	logger.info(f"begin {state} ({len(hosts)})")
 
+	for ip in hosts:
 		if ping_ip(ip):
 			state_ips.append(ip)
 
+		if len(state_ips) >= how_many:
+			break
+	else:
+		logger.warning(f"Ran out of hosts for {state} with {len(state_ips)} of {how_many} found")
+
 	logger.info(f"Finished state: {state}")
 
 	return state_ips
@@ -121,6 +193,42 @@ def worker_main(stuff):
 
 	return state, ips
 
+def sweep_random_ips(how_many):
+	"""
+	Same as mp_get_random_ips, but every state is swept at once from this process. Each state's
+	file is written as soon as it has enough hosts.
+	"""
+	os.makedirs(f"./valid_ips", exist_ok=True)
+	state_prefixes = get_prefixes_by_state()
+
+	candidates = {}
+	for state, prefixes in state_prefixes.items():
+		if state == "-" or state == "District of Columbia":
+			continue
+
+		candidates[state] = HostSampler(prefixes)
+		with open(f"./valid_ips/{state}.json", "w") as f:
+			f.write("in progress")
+
+	state_ips = {state: [] for state in candidates}
+
+	def save(state):
+		with open(f"./valid_ips/{state}.json", "w") as f:
+			json.dump(state_ips[state], f)
+
+	for state, ip in probe.sweep(candidates, {state: how_many for state in candidates}):
+		state_ips[state].append(ip)
+		if len(state_ips[state]) == how_many:
+			logger.info(f"Finished state: {state}")
+			save(state)
+
+	# States that ran out of hosts before their quota
+	for state, ips in state_ips.items():
+		if len(ips) < how_many:
+			save(state)
+
+	return [(state, ips) for state, ips in state_ips.items()]
+
 def mp_get_random_ips(how_many):
 	os.makedirs(f"./valid_ips", exist_ok=True)
 	state_prefixes = get_prefixes_by_state()
@@ -180,7 +288,16 @@ def mp_get_random_ips(how_many):
 
 def main():
 	how_many = 100
-	res = mp_get_random_ips(how_many)
+
+	res = None
+	if USE_SWEEP:
+		try:
+			res = sweep_random_ips(how_many)
+		except PermissionError:
+			logger.warning("Raw sockets need root, falling back to ping")
+
+	if res is None:
+		res = mp_get_random_ips(how_many)
 
 	with open("./state_ips.json", "w") as f:
 		json.dump(res, f)
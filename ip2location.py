@@ -0,0 +1,276 @@
+#######################################################
+# Imports #############################################
+#######################################################
+from common import logger
+
+import argparse
+import datetime
+import json
+import time
+
+import numpy as np
+import pandas as pd
+
+#######################################################
+# Globals #############################################
+#######################################################
+"""
+Works with the IP2LOCATION LITE DB3 CSV, which lists every IPv4 range with its country, region
+and city:
+
+"16777216","16777471","US","United States of America","California","Los Angeles"
+
+It's used for two things. GeoTable geolocates hop addresses for tracer.py --geodb. Run on its
+own, this builds prefixes_by_state.json (read by get_valid_ips.get_prefixes_by_state):
+
+python ip2location.py IP2LOCATION-LITE-DB3.CSV
+python ip2location.py IP2LOCATION-LITE-DB3.CSV.ZIP --outfile ./prefixes_by_state.json
+
+Everything is done on whole columns: the CSV is read with integer start/end columns, the country
+and states are filtered with masks, adjacent ranges of a state are merged, and the merged ranges
+are split into the fewest CIDR blocks that cover them exactly. That takes a few seconds for the
+~3M rows of a monthly release.
+"""
+
+DB3_COLUMNS = ["start", "end", "country_code", "country", "state", "city"]
+
+PREFIXES_PATH = "./prefixes_by_state.json"
+
+COUNTRY = "US"
+# Left out of the prefix index, same as everywhere prefixes_by_state.json is used.
+EXCLUDED_STATES = ["-", "District of Columbia"]
+
+# What GeoTable keeps of each range. Hop tables call the region "region" since "state" is
+# already the partition column of the datasets.
+GEO_COLUMNS = {"country_code": "country", "state": "region", "city": "city"}
+
+#######################################################
+# Classes #############################################
+#######################################################
+class GeoTable:
+	"""
+	IPv4 address -> country, region and city.
+
+	DB3 ranges don't overlap, so a lookup is a searchsorted for the last range starting at or
+	before each address, then a check that the address isn't past that range's end. Any number of
+	addresses is one vectorized pass. Names are kept as categorical codes per range.
+	"""
+
+	def __init__(self, starts: np.ndarray, ends: np.ndarray, codes: dict[str, np.ndarray], categories: dict[str, np.ndarray]):
+		self.starts = starts
+		self.ends = ends
+		# column -> code of each range, and column -> names the codes index into
+		self.codes = codes
+		self.categories = categories
+
+	@classmethod
+	def from_db3(cls, df: pd.DataFrame) -> "GeoTable":
+		df = df.sort_values("start", kind="stable")
+
+		codes = {}
+		categories = {}
+		for column, name in GEO_COLUMNS.items():
+			values = df[column].astype("category")
+			codes[name] = values.cat.codes.to_numpy()
+			categories[name] = values.cat.categories.to_numpy(dtype=object)
+
+		return cls(
+			df["start"].to_numpy(dtype=np.uint32),
+			df["end"].to_numpy(dtype=np.uint32),
+			codes,
+			categories
+		)
+
+	def __len__(self):
+		return len(self.starts)
+
+	def lookup_many(self, ips: np.ndarray) -> np.ndarray:
+		"""
+		:param ips: uint32 array of addresses.
+		:return: int64 array of the range each address is in, -1 where there's none.
+		"""
+		ips = np.asarray(ips, dtype=np.uint32)
+		rows = np.searchsorted(self.starts, ips, side="right") - 1
+
+		hit = rows >= 0
+		hit[hit] = ips[hit] <= self.ends[rows[hit]]
+		rows[~hit] = -1
+
+		return rows
+
+	def column(self, name: str, rows: np.ndarray) -> pd.Categorical:
+		"""
+		:param name: One of GEO_COLUMNS' values.
+		:param rows: Ranges as returned by lookup_many, -1 becomes missing.
+		"""
+		codes = np.where(rows >= 0, self.codes[name][rows], -1)
+		return pd.Categorical.from_codes(codes, self.categories[name])
+
+#######################################################
+# Functions ###########################################
+#######################################################
+def load_db3(path: str, columns: list[str] = None) -> pd.DataFrame:
+	"""
+	:param path: The DB3 CSV, can be compressed (.zip/.gz).
+	:param columns: Columns to read, defaults to all of DB3_COLUMNS.
+	:return: The ranges with int64 start/end and categorical text columns.
+	"""
+	columns = columns or DB3_COLUMNS
+	dtypes = {column: "category" for column in columns}
+	dtypes.update({"start": np.int64, "end": np.int64})
+
+	return pd.read_csv(
+		path,
+		names=DB3_COLUMNS,
+		usecols=columns,
+		dtype={column: dtypes[column] for column in columns},
+		keep_default_na=False,
+		engine="c"
+	)
+
+def merge_ranges(groups: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> (np.ndarray, np.ndarray, np.ndarray):
+	"""
+	Merges overlapping and adjacent ranges (inclusive ends) within each group.
+
+	:param groups: Integer group of each range, e.g. category codes.
+	:return: (groups, starts, ends) of the merged ranges, sorted by group then start.
+	"""
+	order = np.lexsort((starts, groups))
+	groups, starts, ends = groups[order], starts[order], ends[order]
+
+	if len(starts) == 0:
+		return groups, starts, ends
+
+	# Furthest end seen so far in each group. Groups are sorted, so offsetting each one past the
+	# previous group's addresses lets a single running maximum do it.
+	offsets = groups.astype(np.int64) << 33
+	reach = np.maximum.accumulate(ends + offsets) - offsets
+
+	new_run = np.ones(len(starts), dtype=bool)
+	new_run[1:] = (groups[1:] != groups[:-1]) | (starts[1:] > reach[:-1] + 1)
+
+	firsts = np.flatnonzero(new_run)
+	lasts = np.append(firsts[1:], len(starts)) - 1
+	return groups[firsts], starts[firsts], reach[lasts]
+
+def ranges_to_cidrs(starts: np.ndarray, ends: np.ndarray) -> (np.ndarray, np.ndarray, np.ndarray):
+	"""
+	Splits IPv4 ranges (inclusive ends) into the minimal set of CIDR blocks covering each.
+
+	Every range takes the largest block that's aligned at its current start and still fits, then
+	moves past it. All ranges take a step per pass, and a range never needs more than 62 blocks.
+
+	:return: (range index, network address, prefix length) per block, in address order per range.
+	"""
+	starts = np.asarray(starts, dtype=np.int64)
+	ends = np.asarray(ends, dtype=np.int64)
+
+	indexes = []
+	networks = []
+	lengths = []
+
+	active = np.flatnonzero(starts <= ends)
+	current = starts[active]
+	while len(active):
+		remaining = ends[active] - current + 1
+
+		# Largest power of two that fits in what's left: frexp's exponent is floor(log2) + 1,
+		# and it's exact for anything below 2^53.
+		fits = np.frexp(remaining.astype(np.float64))[1] - 1
+		# Alignment of the start, 0.0.0.0 is aligned to everything.
+		aligned = np.where(current == 0, 32, np.frexp((current & -current).astype(np.float64))[1] - 1)
+		bits = np.minimum(fits, aligned)
+
+		indexes.append(active)
+		networks.append(current)
+		lengths.append(32 - bits)
+
+		current = current + (np.int64(1) << bits)
+		more = current <= ends[active]
+		active, current = active[more], current[more]
+
+	if len(indexes) == 0:
+		empty = np.empty(0, dtype=np.int64)
+		return empty, empty, empty
+
+	indexes = np.concatenate(indexes)
+	networks = np.concatenate(networks)
+	lengths = np.concatenate(lengths)
+
+	order = np.lexsort((networks, indexes))
+	return indexes[order], networks[order], lengths[order]
+
+def cidr_strings(networks: np.ndarray, lengths: np.ndarray) -> list[str]:
+	octets = [((networks >> shift) & 255).tolist() for shift in (24, 16, 8, 0)]
+	return [f"{a}.{b}.{c}.{d}/{length}" for a, b, c, d, length in zip(*octets, lengths.tolist())]
+
+def prefixes_by_state(df: pd.DataFrame, country: str = None, excluded: list[str] = None) -> dict[str, list[str]]:
+	"""
+	:param df: Ranges as returned by load_db3.
+	:param country: Country code to keep, defaults to COUNTRY.
+	:param excluded: States to leave out, defaults to EXCLUDED_STATES.
+	:return: state -> CIDR prefixes covering exactly that state's ranges.
+	"""
+	country = country or COUNTRY
+	excluded = EXCLUDED_STATES if excluded is None else excluded
+
+	df = df[(df["country_code"] == country) & ~df["state"].isin(excluded)]
+	states = df["state"].cat.remove_unused_categories()
+
+	groups, starts, ends = merge_ranges(
+		states.cat.codes.to_numpy(dtype=np.int64),
+		df["start"].to_numpy(dtype=np.int64),
+		df["end"].to_numpy(dtype=np.int64)
+	)
+
+	indexes, networks, lengths = ranges_to_cidrs(starts, ends)
+	prefixes = cidr_strings(networks, lengths)
+
+	# Blocks come out grouped by range, and ranges grouped by state.
+	block_groups = groups[indexes]
+	bounds = np.searchsorted(block_groups, np.arange(len(states.cat.categories) + 1))
+
+	return {
+		state: prefixes[bounds[code]:bounds[code + 1]]
+		for code, state in sorted(enumerate(states.cat.categories), key=lambda item: item[1])
+		if bounds[code] < bounds[code + 1]
+	}
+
+def load_geo_table(path: str) -> GeoTable:
+	table = GeoTable.from_db3(load_db3(path, columns=["start", "end"] + list(GEO_COLUMNS.keys())))
+	logger.info(f"Loaded {len(table)} IPv4 ranges from {path}")
+
+	return table
+
+def build(path: str, outfile: str = None, country: str = None, excluded: list[str] = None) -> dict[str, list[str]]:
+	start = time.time()
+
+	df = load_db3(path, columns=["start", "end", "country_code", "state"])
+	logger.info(f"Read {len(df)} ranges from {path}, time elapsed: {datetime.timedelta(seconds=time.time()-start)}")
+
+	state_prefixes = prefixes_by_state(df, country=country, excluded=excluded)
+	total = sum(len(prefixes) for prefixes in state_prefixes.values())
+	logger.info(f"Built {total} prefixes for {len(state_prefixes)} states, time elapsed: {datetime.timedelta(seconds=time.time()-start)}")
+
+	with open(outfile or PREFIXES_PATH, "w") as f:
+		json.dump(state_prefixes, f)
+
+	return state_prefixes
+
+#######################################################
+# Initialization ######################################
+#######################################################
+parser = argparse.ArgumentParser(
+	prog="ip2location.py",
+	description="Builds the per-state prefix index used by get_valid_ips.py from an IP2LOCATION LITE DB3 CSV."
+)
+
+parser.add_argument("infile", type=str, help="The IP2LOCATION-LITE-DB3 CSV, optionally compressed.")
+parser.add_argument("--outfile", type=str, default=PREFIXES_PATH, help="Where to write the prefix index.")
+parser.add_argument("--country", type=str, default=COUNTRY, help="Country code whose states to index.")
+parser.add_argument("--exclude", action="append", type=str, help="Leave this state out, can be given more than once. Defaults to '-' and District of Columbia.")
+
+if __name__ == "__main__":
+	args = parser.parse_args()
+
+	build(args.infile, outfile=args.outfile, country=args.country, excluded=args.exclude)
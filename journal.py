@@ -0,0 +1,149 @@
+#######################################################
+# Imports #############################################
+#######################################################
+from common import logger
+
+import json
+import os
+import threading
+
+#######################################################
+# Globals #############################################
+#######################################################
+JOURNAL_NAME = "journal.jsonl"
+
+"""
+One JSON object per line, appended (and fsynced) as each piece of work finishes:
+{"type": "start", "run": "20230719T055023"}
+{"type": "trace", "target": "93.184.216.34", "result": {"output": [...], "destination_ip": "93.184.216.34", "completed": true}}
+{"type": "as", "data": {"216.169.31.34": {"asn": "12119", "ip": "216.169.31.34", "prefix": "216.169.30.0/23"}, ...}}
+{"type": "rpki", "data": [["12119", "216.169.30.0/23", {"status": "valid", ...}], ...]}
+{"type": "done"}
+
+A crash can leave the last line half written. Lines that don't parse are ignored on replay, and a
+resumed run cuts the half-written line off before appending so its first record starts a line.
+"""
+
+#######################################################
+# Classes #############################################
+#######################################################
+class Journal:
+	"""
+	Append-only record of a tracer.main run so an interrupted run can pick up where it left off.
+	"""
+
+	def __init__(self, path: str, resume: bool = False, run_id: str = None):
+		self.path = path
+		self.lock = threading.Lock()
+
+		# A resumed run keeps the id it started with.
+		self.run_id = run_id
+
+		self.traces: dict[str, dict] = {}
+		self.as_mappings: dict[str, dict] = {}
+		self.rpki_table: dict[tuple[str, str], dict] = {}
+		self.done = False
+		# Where the last complete line ends, set by replay()
+		self.end = 0
+
+		if resume and os.path.exists(path):
+			self.replay()
+			with open(path, "r+b") as f:
+				f.truncate(self.end)
+			mode = "a"
+		else:
+			mode = "w"
+
+		folder = os.path.dirname(path)
+		if folder:
+			os.makedirs(folder, exist_ok=True)
+
+		self.file = open(path, mode)
+		if mode == "w":
+			self.write({"type": "start", "run": run_id})
+
+	def replay(self):
+		skipped = 0
+		with open(self.path, "rb") as f:
+			for line in f:
+				if not line.endswith(b"\n"):
+					# Cut off mid-write
+					skipped += 1
+					break
+
+				self.end += len(line)
+				try:
+					record = json.loads(line)
+				except json.JSONDecodeError:
+					skipped += 1
+					continue
+
+				kind = record.get("type")
+				if kind == "start":
+					self.run_id = record["run"] or self.run_id
+				elif kind == "trace":
+					self.traces[record["target"]] = record["result"]
+				elif kind == "as":
+					self.as_mappings.update(record["data"])
+				elif kind == "rpki":
+					for asn, prefix, data in record["data"]:
+						self.rpki_table[(asn, prefix)] = data
+				elif kind == "done":
+					self.done = True
+
+		logger.info(f"Replayed journal {self.path}: {len(self.traces)} trace(s), {len(self.as_mappings)} AS mapping(s), {len(self.rpki_table)} RPKI result(s)")
+		if skipped:
+			logger.warning(f"Skipped {skipped} unreadable line(s) in {self.path}")
+
+	def write(self, record: dict):
+		line = json.dumps(record) + "\n"
+		with self.lock:
+			self.file.write(line)
+			self.file.flush()
+			os.fsync(self.file.fileno())
+
+	def record_trace(self, target: str, result: dict):
+		self.write({"type": "trace", "target": target, "result": result})
+
+	def record_as_mappings(self, mappings: dict[str, dict]):
+		if len(mappings) > 0:
+			self.write({"type": "as", "data": mappings})
+
+	def record_rpki(self, table: dict[tuple[str, str], dict]):
+		if len(table) > 0:
+			self.write({"type": "rpki", "data": [[asn, prefix, data] for (asn, prefix), data in table.items()]})
+
+	def complete(self):
+		self.write({"type": "done"})
+		self.done = True
+
+	def close(self):
+		self.file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+#######################################################
+# Functions ###########################################
+#######################################################
+def journal_path(outfolder: str) -> str:
+	return os.path.join(outfolder, JOURNAL_NAME)
+
+def is_complete(outfolder: str) -> bool:
+	"""
+	Whether a tracer.main run into outfolder finished. Runs from before the journal existed are
+	taken to have finished if they got as far as writing their summary.
+	"""
+	path = journal_path(outfolder)
+	if not os.path.exists(path):
+		return os.path.exists(os.path.join(outfolder, "rpki_summary.csv"))
+
+	with open(path, "r") as f:
+		for line in f:
+			if line.startswith('{"type": "done"'):
+				return True
+
+	return False
@@ -0,0 +1,315 @@
+#######################################################
+# Imports #############################################
+#######################################################
+from common import logger
+
+import bisect
+import http.server
+import math
+import os
+import threading
+import time
+
+#######################################################
+# Globals #############################################
+#######################################################
+"""
+Stage-level metrics for tracer runs, exposed in the OpenMetrics text format either as a file that
+gets rewritten every METRICS_INTERVAL seconds (for node_exporter's textfile collector) or from a
+small HTTP server that Prometheus can scrape:
+
+python tracer.py ./out --infile ips.txt --metricsfile /var/lib/node_exporter/tracer.prom
+python tracer.py ./out --infile ips.txt --metricsport 9464
+
+Metrics only live in the process that records them. Traces run in pool workers are timed by the
+worker and recorded by the parent, see tracer.iter_mp_traceroute.
+"""
+
+METRICS_INTERVAL = 15  # Seconds between textfile writes
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+#######################################################
+# Classes #############################################
+#######################################################
+class Metric:
+	TYPE = ""
+
+	def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+		self.name = name
+		self.documentation = documentation
+		self.labels = labels
+		self.lock = threading.Lock()
+		# label values -> value
+		self.values: dict[tuple, object] = {}
+
+	def key(self, labels: dict) -> tuple:
+		return tuple(str(labels.get(label, "")) for label in self.labels)
+
+	def label_string(self, key: tuple, extra: dict = None) -> str:
+		pairs = list(zip(self.labels, key)) + list((extra or {}).items())
+		if len(pairs) == 0:
+			return ""
+
+		return "{" + ",".join(f'{label}="{escape(value)}"' for label, value in pairs) + "}"
+
+	def samples(self) -> list[str]:
+		return []
+
+	def render(self) -> list[str]:
+		lines = [f"# TYPE {self.name} {self.TYPE}", f"# HELP {self.name} {escape(self.documentation)}"]
+		with self.lock:
+			lines += self.samples()
+
+		return lines
+
+class Counter(Metric):
+	TYPE = "counter"
+
+	def inc(self, amount: float = 1, **labels):
+		key = self.key(labels)
+		with self.lock:
+			self.values[key] = self.values.get(key, 0) + amount
+
+	def samples(self) -> list[str]:
+		return [f"{self.name}_total{self.label_string(key)} {number(value)}" for key, value in self.values.items()]
+
+class Gauge(Metric):
+	TYPE = "gauge"
+
+	def set(self, value: float, **labels):
+		with self.lock:
+			self.values[self.key(labels)] = value
+
+	def inc(self, amount: float = 1, **labels):
+		key = self.key(labels)
+		with self.lock:
+			self.values[key] = self.values.get(key, 0) + amount
+
+	def dec(self, amount: float = 1, **labels):
+		self.inc(-amount, **labels)
+
+	def samples(self) -> list[str]:
+		return [f"{self.name}{self.label_string(key)} {number(value)}" for key, value in self.values.items()]
+
+class Histogram(Metric):
+	TYPE = "histogram"
+
+	def __init__(self, name: str, documentation: str, buckets: tuple[float, ...], labels: tuple[str, ...] = ()):
+		super().__init__(name, documentation, labels)
+		self.buckets = sorted(buckets)
+
+	def observe(self, value: float, **labels):
+		key = self.key(labels)
+		with self.lock:
+			if key not in self.values:
+				# Per-bucket counts (the last one is +Inf), then the sum.
+				self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+
+			counts, _ = self.values[key]
+			counts[bisect.bisect_left(self.buckets, value)] += 1
+			self.values[key][1] += value
+
+	def time(self, **labels) -> "Timer":
+		return Timer(self, labels)
+
+	def samples(self) -> list[str]:
+		lines = []
+		for key, (counts, total) in self.values.items():
+			cumulative = 0
+			for bound, count in zip(self.buckets + [math.inf], counts):
+				cumulative += count
+				lines.append(f"{self.name}_bucket{self.label_string(key, {'le': number(bound)})} {cumulative}")
+
+			lines.append(f"{self.name}_count{self.label_string(key)} {cumulative}")
+			lines.append(f"{self.name}_sum{self.label_string(key)} {number(total)}")
+
+		return lines
+
+class Timer:
+	"""
+	with HISTOGRAM.time(): ... observes how long the block took, in seconds.
+	"""
+	def __init__(self, histogram: Histogram, labels: dict):
+		self.histogram = histogram
+		self.labels = labels
+
+	def __enter__(self):
+		self.start = time.monotonic()
+		return self
+
+	def __exit__(self, *exc):
+		self.histogram.observe(time.monotonic() - self.start, **self.labels)
+
+class Registry:
+	def __init__(self):
+		self.metrics: list[Metric] = []
+
+	def register(self, metric: Metric) -> Metric:
+		self.metrics.append(metric)
+		return metric
+
+	def render(self) -> str:
+		lines = []
+		for metric in self.metrics:
+			lines += metric.render()
+
+		return "\n".join(lines + ["# EOF"]) + "\n"
+
+class TextfileExporter:
+	"""
+	Rewrites `path` with the current metrics every `interval` seconds on a background thread. The
+	file is replaced atomically so a collector never reads half of it.
+	"""
+	def __init__(self, path: str, interval: float = None, registry: Registry = None):
+		self.path = path
+		self.interval = interval or METRICS_INTERVAL
+		self.registry = registry or REGISTRY
+		self.stopped = threading.Event()
+		self.thread = threading.Thread(target=self.run, daemon=True)
+
+	def start(self) -> "TextfileExporter":
+		folder = os.path.dirname(self.path)
+		if folder:
+			os.makedirs(folder, exist_ok=True)
+
+		self.thread.start()
+		return self
+
+	def write(self):
+		tmp_path = f"{self.path}.{os.getpid()}.tmp"
+		with open(tmp_path, "w") as f:
+			f.write(self.registry.render())
+
+		os.replace(tmp_path, self.path)
+
+	def run(self):
+		stopping = False
+		while not stopping:
+			# Stopping still writes once more, so the file ends up with the final numbers.
+			stopping = self.stopped.wait(self.interval)
+			try:
+				self.write()
+			except OSError as err:
+				logger.warning(f"Unable to write metrics to {self.path}: {err}")
+
+	def stop(self):
+		self.stopped.set()
+		self.thread.join()
+
+class HTTPExporter:
+	"""
+	Serves the current metrics at any path on (host, port) from a background thread.
+	"""
+	def __init__(self, port: int, host: str = "127.0.0.1", registry: Registry = None):
+		registry = registry or REGISTRY
+
+		class Handler(http.server.BaseHTTPRequestHandler):
+			def do_GET(self):
+				body = registry.render().encode()
+				self.send_response(200)
+				self.send_header("Content-Type", CONTENT_TYPE)
+				self.send_header("Content-Length", str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, *args):
+				pass
+
+		self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+		self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+	@property
+	def port(self) -> int:
+		return self.server.server_address[1]
+
+	def start(self) -> "HTTPExporter":
+		self.thread.start()
+		logger.info(f"Serving metrics on port {self.port}")
+		return self
+
+	def stop(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+#######################################################
+# Functions ###########################################
+#######################################################
+def escape(value: str) -> str:
+	return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def number(value: float) -> str:
+	if value == math.inf:
+		return "+Inf"
+
+	if type(value) == int or (type(value) == float and value.is_integer() and abs(value) < 1e15):
+		return str(int(value)) if type(value) == int else f"{value:.1f}"
+
+	return repr(float(value))
+
+#######################################################
+# Metrics #############################################
+#######################################################
+REGISTRY = Registry()
+
+TRACE_DURATION = REGISTRY.register(Histogram(
+	"tracer_trace_duration_seconds", "Time taken to trace one target.",
+	(0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300),
+))
+TRACE_HOPS = REGISTRY.register(Histogram(
+	"tracer_trace_hops", "Hops per trace, including ones that didn't respond.",
+	(1, 2, 4, 6, 8, 10, 12, 15, 20, 25, 30),
+))
+TRACES = REGISTRY.register(Counter(
+	"tracer_traces", "Traces finished, by whether they reached their destination.",
+	("completed",),
+))
+TRACES_PENDING = REGISTRY.register(Gauge(
+	"tracer_traces_pending", "Targets of the current run that haven't been traced yet.",
+))
+TRACES_IN_FLIGHT = REGISTRY.register(Gauge(
+	"tracer_traces_in_flight", "Traceroute subprocesses running under asyncio.",
+))
+
+ENRICH_QUEUE = REGISTRY.register(Gauge(
+	"tracer_enrich_queue_depth", "Finished traces waiting for AS mapping and RPKI validation.",
+))
+ENRICH_DURATION = REGISTRY.register(Histogram(
+	"tracer_enrich_batch_duration_seconds", "Time taken to map and validate one batch of hops.",
+	(0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300),
+))
+
+WHOIS_DURATION = REGISTRY.register(Histogram(
+	"tracer_whois_query_duration_seconds", "Time taken by one Cymru bulk whois session.",
+	(0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 120),
+))
+WHOIS_BATCH_SIZE = REGISTRY.register(Histogram(
+	"tracer_whois_batch_size", "IPs sent in one Cymru bulk whois session.",
+	(1, 10, 50, 100, 500, 1000, 2500, 5000, 10000),
+))
+WHOIS_QUERIES = REGISTRY.register(Counter(
+	"tracer_whois_queries", "Cymru bulk whois sessions, by outcome.",
+	("result",),
+))
+
+RPKI_DURATION = REGISTRY.register(Histogram(
+	"tracer_rpki_request_duration_seconds", "Time taken by one RIPEstat rpki-validation request.",
+	(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60),
+))
+RPKI_REQUESTS = REGISTRY.register(Counter(
+	"tracer_rpki_requests", "RIPEstat rpki-validation requests, by outcome.",
+	("result",),
+))
+
+CACHE_LOOKUPS = REGISTRY.register(Counter(
+	"tracer_cache_lookups", "Lookups against the on-disk caches, by cache and whether they hit.",
+	("cache", "result"),
+))
+
+ROWS_WRITTEN = REGISTRY.register(Counter(
+	"tracer_rows_written", "Rows written to output tables.",
+	("table",),
+))
+STAGE_DURATION = REGISTRY.register(Gauge(
+	"tracer_stage_duration_seconds", "Time the last run spent in each stage.",
+	("stage",),
+))
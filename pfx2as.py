@@ -0,0 +1,193 @@
+#######################################################
+# Imports #############################################
+#######################################################
+from common import logger
+
+import gzip
+import ipaddress
+import typing
+
+import numpy as np
+
+#######################################################
+# Globals #############################################
+#######################################################
+"""
+CAIDA Routeviews prefix2as (tab separated, multi-origin prefixes use _ and AS sets use ,):
+1.0.0.0	24	13335
+1.0.4.0	22	38803
+1.0.64.0	18	7670_18144
+
+A RIB dump in bgpdump -m format, the origin is the last AS in the path:
+TABLE_DUMP2|1689811200|B|187.16.216.23|199524|1.0.0.0/24|199524 13335|IGP|187.16.216.23|0|0||NAG||
+"""
+
+NO_ASN = 0
+
+#######################################################
+# Classes #############################################
+#######################################################
+class PrefixTable:
+	"""
+	Longest-prefix-match table for IPv4 prefix -> origin AS.
+
+	There's one sorted array of network addresses per prefix length in use. A lookup masks the
+	IPs down to each length, most specific first, and checks for an exact hit with searchsorted.
+	With ~25 lengths in a full table that's 25 vectorized passes for any number of IPs.
+	"""
+
+	def __init__(self):
+		self.prefixes: list[str] = []
+		# prefix length -> (sorted network addresses, asns, index into self.prefixes)
+		self.tables: dict[int, tuple[np.ndarray, np.ndarray, np.ndarray]] = {}
+
+	@classmethod
+	def from_routes(cls, routes: typing.Iterable[tuple[str, int]]) -> "PrefixTable":
+		table = cls()
+
+		by_length: dict[int, dict[int, tuple[int, int]]] = {}
+		for prefix, asn in routes:
+			try:
+				network = ipaddress.ip_network(prefix, strict=False)
+			except ValueError:
+				continue
+
+			if network.version != 4:
+				continue
+
+			# Only the first route for a prefix is kept, same as the first origin of a MOAS entry.
+			networks = by_length.setdefault(network.prefixlen, {})
+			address = int(network.network_address)
+			if address not in networks:
+				networks[address] = (asn, len(table.prefixes))
+				table.prefixes.append(str(network))
+
+		for length, networks in by_length.items():
+			addresses = np.fromiter(networks.keys(), dtype=np.uint32, count=len(networks))
+			values = list(networks.values())
+			asns = np.fromiter((v[0] for v in values), dtype=np.uint32, count=len(values))
+			ids = np.fromiter((v[1] for v in values), dtype=np.int64, count=len(values))
+
+			order = np.argsort(addresses)
+			table.tables[length] = (addresses[order], asns[order], ids[order])
+
+		return table
+
+	def __len__(self):
+		return len(self.prefixes)
+
+	def lookup_many(self, ips: np.ndarray) -> (np.ndarray, np.ndarray):
+		"""
+		Bulk longest-prefix match.
+
+		:param ips: uint32 array of addresses.
+		:return: uint32 array of origin ASNs (NO_ASN where nothing matched) and an int64 array of
+			indexes into self.prefixes (-1 where nothing matched).
+		"""
+		ips = np.asarray(ips, dtype=np.uint32)
+		asns = np.full(len(ips), NO_ASN, dtype=np.uint32)
+		prefix_ids = np.full(len(ips), -1, dtype=np.int64)
+		unresolved = np.ones(len(ips), dtype=bool)
+
+		for length in sorted(self.tables.keys(), reverse=True):
+			if not unresolved.any():
+				break
+
+			addresses, table_asns, table_ids = self.tables[length]
+			mask = np.uint32((0xFFFFFFFF << (32 - length)) & 0xFFFFFFFF)
+
+			candidates = np.nonzero(unresolved)[0]
+			masked = ips[candidates] & mask
+
+			pos = np.searchsorted(addresses, masked)
+			pos[pos == len(addresses)] = 0
+			hit = addresses[pos] == masked
+
+			found = candidates[hit]
+			asns[found] = table_asns[pos[hit]]
+			prefix_ids[found] = table_ids[pos[hit]]
+			unresolved[found] = False
+
+		return asns, prefix_ids
+
+	def map_to_ases(self, ips: list[str]) -> dict:
+		"""
+		Drop-in for tracer.mapToASes. Anything not covered by a route is NA, like Cymru reports.
+		"""
+		addresses = ips_to_array(ips)
+		asns, prefix_ids = self.lookup_many(addresses)
+
+		data = {}
+		for ip, asn, prefix_id in zip(ips, asns.tolist(), prefix_ids.tolist()):
+			if prefix_id == -1:
+				data[ip] = {"asn": "NA", "ip": ip, "prefix": "NA"}
+			else:
+				data[ip] = {"asn": str(asn), "ip": ip, "prefix": self.prefixes[prefix_id]}
+
+		return data
+
+#######################################################
+# Functions ###########################################
+#######################################################
+def ips_to_array(ips: list[str]) -> np.ndarray:
+	"""
+	Converts dotted quads to a uint32 array. Anything that isn't a valid IPv4 address becomes 0.0.0.0,
+	which never matches a route.
+	"""
+	def to_int(ip):
+		try:
+			return int(ipaddress.IPv4Address(ip))
+		except ValueError:
+			return 0
+
+	return np.fromiter((to_int(ip) for ip in ips), dtype=np.uint32, count=len(ips))
+
+def parse_origin(field: str) -> int | None:
+	# Multi-origin (13335_4134) and AS set ({13335,4134}) entries keep their first origin.
+	field = field.strip().strip("{}")
+	for sep in ("_", ","):
+		field = field.split(sep)[0]
+
+	try:
+		return int(field)
+	except ValueError:
+		return None
+
+def read_routes(path: str) -> typing.Iterator[tuple[str, int]]:
+	opener = path.endswith(".gz") and gzip.open or open
+
+	with opener(path, "rt") as f:
+		for line in f:
+			line = line.strip()
+			if line == "" or line.startswith("#"):
+				continue
+
+			if "|" in line:
+				# bgpdump -m
+				fields = line.split("|")
+				if len(fields) < 7:
+					continue
+
+				path_asns = fields[6].split()
+				if len(path_asns) == 0:
+					continue
+
+				prefix = fields[5]
+				asn = parse_origin(path_asns[-1])
+			else:
+				# pfx2as
+				fields = line.split()
+				if len(fields) < 3:
+					continue
+
+				prefix = f"{fields[0]}/{fields[1]}"
+				asn = parse_origin(fields[2])
+
+			if asn is not None:
+				yield prefix, asn
+
+def load_prefix_table(path: str) -> PrefixTable:
+	table = PrefixTable.from_routes(read_routes(path))
+	logger.info(f"Loaded {len(table)} IPv4 prefixes from {path}")
+
+	return table
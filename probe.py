@@ -0,0 +1,668 @@
+#######################################################
+# Imports #############################################
+#######################################################
+from common import logger
+
+import collections
+import itertools
+import os
+import select
+import socket
+import struct
+import time
+import typing
+
+#######################################################
+# Globals #############################################
+#######################################################
+"""
+In-process traceroute engine. Every probe is an ICMP echo request sent from one raw socket with
+the TTL set per packet. The echo identifier is our PID and the sequence number indexes a table of
+outstanding probes, so a Time Exceeded (which quotes the first 8 bytes of our echo request) or an
+Echo Reply can be matched back to the (target, ttl) it answers.
+
+Linux only, and it needs root or CAP_NET_RAW.
+"""
+
+ICMP_ECHO_REPLY = 0
+ICMP_DEST_UNREACHABLE = 3
+ICMP_ECHO_REQUEST = 8
+ICMP_TIME_EXCEEDED = 11
+
+PROBE_MAX_TTL = 30
+PROBE_RATE = 2000  # Probes per second
+PROBE_TIMEOUT = 2.0  # Seconds to wait for stragglers after the last probe of a batch
+PROBE_PAYLOAD = b"rpki_in_cybersecurity"
+
+# The sequence number is 16 bits, so that's how many probes can be outstanding at once.
+MAX_OUTSTANDING = 0xFFFF
+
+# Engines made one after another in a process get different echo identifiers, so late replies to
+# one can't be taken for replies to the next.
+ENGINE_COUNTER = itertools.count()
+
+"""
+Liveness sweeps (see ProbeEngine.sweep) send one echo request per candidate address at a normal
+TTL and count a host as alive if the echo reply comes back from that address.
+"""
+SWEEP_RATE = 5000  # Probes per second
+SWEEP_TIMEOUT = 1.0  # Seconds before a candidate that hasn't answered is given up on
+SWEEP_TTL = 64
+# Caps how far past its quota a group can go while its last replies are still on the way.
+SWEEP_IN_FLIGHT = 1024
+
+"""
+Doubletree (Donnet et al., "Efficient algorithms for large-scale topology discovery", 2005).
+Each trace starts at a mid-path TTL and probes forwards and backwards from there. Backwards
+probing stops at the first interface any earlier trace has already seen (the local stop set),
+since everything closer to us is the same. Forwards probing stops at an interface that an earlier
+trace to the same destination prefix has already seen (the global stop set), then jumps straight
+to where that trace reached its destination. Hops that weren't probed are filled in from the
+trace that put the interface in the stop set, with no round trip time.
+
+Targets are traced in waves so later waves start at a TTL learned from the earlier ones.
+"""
+PROBE_DOUBLETREE = False  # Whether probe_traceroute uses Doubletree by default
+DOUBLETREE_START_TTL = 8  # Until there are enough finished traces to learn from
+DOUBLETREE_MIN_SAMPLES = 20
+# The start TTL is picked so only this fraction of destinations are closer than it.
+DOUBLETREE_P = 0.05
+DOUBLETREE_PREFIX_LENGTH = 24
+# Forward and backward probes for a whole wave have to fit in the sequence space.
+DOUBLETREE_WAVE = 4096
+
+#######################################################
+# Classes #############################################
+#######################################################
+class Probe:
+	__slots__ = ("target", "ttl", "sent")
+
+	def __init__(self, target: int, ttl: int, sent: float):
+		self.target = target
+		self.ttl = ttl
+		self.sent = sent
+
+class DoubletreeState:
+	__slots__ = ("path", "destination", "prefix", "forward", "backward", "jumped_to", "backward_stop", "forward_stop")
+
+	def __init__(self, path: int, destination: str, start_ttl: int):
+		self.path = path
+		self.destination = destination
+		self.prefix = prefix_of(destination)
+
+		# Next TTL to probe in each direction, None once that direction is done.
+		self.forward = start_ttl
+		self.backward = start_ttl - 1 or None
+		# TTL the forward probe jumped to after a global stop, where the destination should be.
+		self.jumped_to = None
+
+		# (ttl, (path, ttl)) of where probing stopped and the trace it matched.
+		self.backward_stop = None
+		self.forward_stop = None
+
+class ProbeEngine:
+	"""
+	Traces many targets at once from a single raw ICMP socket.
+	"""
+
+	def __init__(self, max_ttl: int = None, rate: float = None, timeout: float = None):
+		self.max_ttl = max_ttl or PROBE_MAX_TTL
+		self.rate = rate or PROBE_RATE
+		self.timeout = timeout or PROBE_TIMEOUT
+		self.ident = (os.getpid() + next(ENGINE_COUNTER) * 0x1000) & 0xFFFF
+
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+		self.sock.setblocking(False)
+
+		self.seq = 0
+		self.sent = 0
+
+		# Doubletree state, kept for the life of the engine so every call shares the stop sets.
+		# Every path traced: ttl -> (responder, rtt), and the TTL it reached its destination at.
+		self.paths: list[dict[int, tuple[str, float]]] = []
+		self.reached: list[int] = []
+		self.active: set[int] = set()
+		# interface -> (path, ttl) that first saw it
+		self.local_stop: dict[str, tuple[int, int]] = {}
+		# (interface, destination prefix) -> (path, ttl) that first saw it
+		self.global_stop: dict[tuple[str, int], tuple[int, int]] = {}
+
+	def close(self):
+		self.sock.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def send_probe(self, destination: str, ttl: int, seq: int):
+		self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, ttl)
+		self.sock.sendto(build_echo(self.ident, seq, PROBE_PAYLOAD), (destination, 0))
+		self.sent += 1
+
+	def receive(self) -> tuple[str, int, int, float] | None:
+		"""
+		:return: (responder, icmp type, seq, receive time) for a reply to one of our probes, or None.
+		"""
+		try:
+			packet, (responder, _) = self.sock.recvfrom(65535)
+		except BlockingIOError:
+			return None
+
+		now = time.monotonic()
+		parsed = parse_reply(packet)
+		if parsed is None:
+			return None
+
+		icmp_type, ident, seq = parsed
+		if ident != self.ident:
+			return None
+
+		return responder, icmp_type, seq, now
+
+	def trace(self, destinations: list[str]) -> list[dict]:
+		"""
+		:param destinations: IPv4 addresses.
+		:return: One dict per destination, shaped like tracer.TracerouteResult.
+		"""
+		# target -> ttl -> (responder, rtt)
+		replies: list[dict[int, tuple[str, float]]] = [{} for _ in destinations]
+		# target -> lowest ttl the destination itself answered at
+		reached: list[int] = [None for _ in destinations]
+
+		outstanding: dict[int, Probe] = {}
+		interval = 1 / self.rate
+
+		def drain(until: float):
+			while True:
+				wait = until - time.monotonic()
+				if wait <= 0:
+					return
+
+				readable, _, _ = select.select([self.sock], [], [], wait)
+				if not readable:
+					return
+
+				while True:
+					reply = self.receive()
+					if reply is None:
+						break
+
+					responder, icmp_type, seq, received = reply
+					probe = outstanding.pop(seq, None)
+					if probe is None:
+						continue
+
+					replies[probe.target].setdefault(probe.ttl, (responder, (received - probe.sent) * 1000))
+					if icmp_type == ICMP_ECHO_REPLY or icmp_type == ICMP_DEST_UNREACHABLE:
+						if reached[probe.target] is None or probe.ttl < reached[probe.target]:
+							reached[probe.target] = probe.ttl
+
+		# Probe breadth first, so one target's hops are spread out over time instead of arriving
+		# at the first few routers all at once.
+		seq = 0
+		next_send = time.monotonic()
+		for ttl in range(1, self.max_ttl + 1):
+			for target, destination in enumerate(destinations):
+				if reached[target] is not None and reached[target] < ttl:
+					continue
+
+				while len(outstanding) >= MAX_OUTSTANDING or seq in outstanding:
+					# Sequence space is exhausted, wait for answers (or give up on the oldest).
+					drain(time.monotonic() + interval)
+					expired = time.monotonic() - self.timeout
+					for s in [s for s, p in outstanding.items() if p.sent < expired]:
+						del outstanding[s]
+
+				drain(next_send)
+				next_send = max(next_send + interval, time.monotonic())
+
+				try:
+					self.send_probe(destination, ttl, seq)
+				except OSError as err:
+					logger.debug(f"Unable to send probe to {destination} at ttl={ttl}: {err}")
+				else:
+					outstanding[seq] = Probe(target, ttl, time.monotonic())
+
+				seq = (seq + 1) & 0xFFFF
+
+		drain(time.monotonic() + self.timeout)
+
+		results = []
+		for target, destination in enumerate(destinations):
+			last = reached[target] or self.max_ttl
+			hops = []
+			for ttl in range(1, last + 1):
+				if ttl in replies[target]:
+					responder, rtt = replies[target][ttl]
+					hops.append({"timestr": f"{round(rtt)} ms", "ip": responder})
+
+			completed = len(hops) > 0 and hops[len(hops)-1]["ip"] == destination
+			results.append({"output": hops, "destination_ip": destination, "completed": completed})
+
+		return results
+
+	def sweep(self, candidates: dict[typing.Hashable, typing.Iterator[str]], quotas: dict[typing.Hashable, int], rate: float = None, timeout: float = None) -> typing.Iterator[tuple[typing.Hashable, str]]:
+		"""
+		Pings candidate addresses from every group at once until each group has `quota` hosts that
+		answered, or runs out of candidates. Groups take turns sending, and up to SWEEP_IN_FLIGHT
+		probes per group are outstanding at a time.
+
+		:param candidates: group -> IPv4 addresses to try, in order. Only read as far as needed.
+		:param quotas: group -> how many live hosts it needs.
+		:param rate: Probes per second, defaults to SWEEP_RATE.
+		:param timeout: Seconds to wait for each reply, defaults to SWEEP_TIMEOUT.
+		:return: (group, address) for each live host, as the replies arrive.
+		"""
+		interval = 1 / (rate or SWEEP_RATE)
+		timeout = timeout or SWEEP_TIMEOUT
+
+		found = {group: 0 for group in candidates}
+		in_flight = {group: 0 for group in candidates}
+		# Groups that still need hosts and have candidates left, in turn order.
+		sending = collections.deque(group for group in candidates if quotas.get(group, 0) > 0)
+		wanted = set(sending)
+
+		# seq -> (group, address, sent). Insertion order is send order, so the oldest is first.
+		outstanding: dict[int, tuple[typing.Hashable, str, float]] = {}
+
+		seq = 0
+		next_send = time.monotonic()
+		while len(wanted) > 0 and (len(sending) > 0 or len(outstanding) > 0):
+			now = time.monotonic()
+			while len(outstanding) > 0:
+				oldest = next(iter(outstanding))
+				group, _, sent = outstanding[oldest]
+				if sent > now - timeout:
+					break
+
+				del outstanding[oldest]
+				in_flight[group] -= 1
+
+			# Take the next group whose probes aren't all still in flight.
+			group = None
+			for _ in range(len(sending)):
+				if in_flight[sending[0]] < SWEEP_IN_FLIGHT:
+					group = sending[0]
+					sending.rotate(-1)
+					break
+
+				sending.rotate(-1)
+
+			if group is not None and now >= next_send and len(outstanding) < MAX_OUTSTANDING:
+				address = next(candidates[group], None)
+				if address is None:
+					sending.remove(group)
+					logger.warning(f"Ran out of candidates for {group} with {found[group]} of {quotas[group]} found")
+				else:
+					while seq in outstanding:
+						seq = (seq + 1) & 0xFFFF
+
+					try:
+						self.send_probe(address, SWEEP_TTL, seq)
+					except OSError as err:
+						logger.debug(f"Unable to send probe to {address}: {err}")
+					else:
+						outstanding[seq] = (group, address, time.monotonic())
+						in_flight[group] += 1
+
+					seq = (seq + 1) & 0xFFFF
+					next_send = max(next_send + interval, now - interval)
+
+				continue
+
+			# Nothing to send right now, wait for replies until the next send or expiry is due.
+			if group is not None:
+				until = next_send
+			elif len(outstanding) > 0:
+				until = outstanding[next(iter(outstanding))][2] + timeout
+			else:
+				until = now + interval
+
+			readable, _, _ = select.select([self.sock], [], [], max(0, until - time.monotonic()))
+			if not readable:
+				continue
+
+			while True:
+				reply = self.receive()
+				if reply is None:
+					break
+
+				responder, icmp_type, reply_seq, _ = reply
+				probe = outstanding.pop(reply_seq, None)
+				if probe is None:
+					continue
+
+				group, address, _ = probe
+				in_flight[group] -= 1
+
+				# An error about our probe (unreachable, TTL exceeded) means the host isn't there.
+				if icmp_type != ICMP_ECHO_REPLY or responder != address or group not in wanted:
+					continue
+
+				found[group] += 1
+				yield group, address
+
+				if found[group] >= quotas[group]:
+					wanted.discard(group)
+					if group in sending:
+						sending.remove(group)
+
+	def start_ttl(self) -> int:
+		"""
+		Doubletree's h: low enough that only DOUBLETREE_P of destinations are closer than it.
+		"""
+		lengths = sorted(r for r in self.reached if r is not None)
+		if len(lengths) < DOUBLETREE_MIN_SAMPLES:
+			return min(DOUBLETREE_START_TTL, self.max_ttl)
+
+		return max(1, min(lengths[int(len(lengths) * DOUBLETREE_P)], self.max_ttl))
+
+	def trace_doubletree(self, destinations: list[str]) -> list[dict]:
+		"""
+		Same as trace(), but probing with Doubletree so hops shared with earlier traces aren't
+		probed again.
+		"""
+		sent = self.sent
+		results = []
+		for start in range(0, len(destinations), DOUBLETREE_WAVE):
+			results += self._doubletree_wave(destinations[start:start + DOUBLETREE_WAVE])
+
+		logger.info(f"Doubletree sent {self.sent - sent} probe(s) for {len(destinations)} destination(s)")
+		return results
+
+	def _collect(self, outstanding: dict[int, Probe], answers: dict[tuple[int, int], tuple[str, int]], until: float):
+		"""
+		Reads replies into answers[(path, ttl)] = (responder, icmp type) until `until`, or until
+		nothing is outstanding.
+		"""
+		while len(outstanding) > 0:
+			wait = until - time.monotonic()
+			if wait <= 0:
+				return
+
+			readable, _, _ = select.select([self.sock], [], [], wait)
+			if not readable:
+				return
+
+			while True:
+				reply = self.receive()
+				if reply is None:
+					break
+
+				responder, icmp_type, seq, received = reply
+				probe = outstanding.pop(seq, None)
+				if probe is None:
+					continue
+
+				if (probe.target, probe.ttl) in answers:
+					continue
+
+				answers[(probe.target, probe.ttl)] = (responder, icmp_type)
+				self.paths[probe.target].setdefault(probe.ttl, (responder, (received - probe.sent) * 1000))
+				if icmp_type == ICMP_ECHO_REPLY or icmp_type == ICMP_DEST_UNREACHABLE:
+					reached = self.reached[probe.target]
+					if reached is None or probe.ttl < reached:
+						self.reached[probe.target] = probe.ttl
+
+	def _doubletree_wave(self, destinations: list[str]) -> list[dict]:
+		start_ttl = self.start_ttl()
+		logger.debug(f"Doubletree wave of {len(destinations)} destination(s) starting at ttl={start_ttl}")
+
+		states = []
+		for destination in destinations:
+			path = len(self.paths)
+			self.paths.append({})
+			self.reached.append(None)
+			self.active.add(path)
+			states.append(DoubletreeState(path, destination, start_ttl))
+
+		# Each round sends the next probe in each direction for every trace still going, then
+		# waits for the answers, since where a trace goes next depends on them.
+		interval = 1 / self.rate
+		next_send = time.monotonic()
+		while True:
+			active = [state for state in states if state.forward is not None or state.backward is not None]
+			if len(active) == 0:
+				break
+
+			outstanding: dict[int, Probe] = {}
+			answers: dict[tuple[int, int], tuple[str, int]] = {}
+			for state in active:
+				for ttl in (state.forward, state.backward):
+					if ttl is None:
+						continue
+
+					self._collect(outstanding, answers, next_send)
+					next_send = max(next_send + interval, time.monotonic())
+
+					try:
+						self.send_probe(state.destination, ttl, self.seq)
+					except OSError as err:
+						logger.debug(f"Unable to send probe to {state.destination} at ttl={ttl}: {err}")
+					else:
+						outstanding[self.seq] = Probe(state.path, ttl, time.monotonic())
+
+					self.seq = (self.seq + 1) & 0xFFFF
+
+			self._collect(outstanding, answers, time.monotonic() + self.timeout)
+
+			for state in active:
+				self._advance(state, answers)
+
+		for state in states:
+			self.active.discard(state.path)
+
+		resolved = {}
+		results = []
+		for state in states:
+			hops = self._resolve(state.path, {state.path: state for state in states}, resolved, set())
+			last = self.reached[state.path] or self.max_ttl
+
+			output = []
+			for ttl in sorted(hops.keys()):
+				if ttl <= last:
+					responder, rtt = hops[ttl]
+					output.append({"timestr": (rtt is not None and f"{round(rtt)} ms") or "", "ip": responder})
+
+			completed = len(output) > 0 and output[len(output)-1]["ip"] == state.destination
+			results.append({"output": output, "destination_ip": state.destination, "completed": completed})
+
+		# Later waves fill in from the finished paths directly.
+		for path, hops in resolved.items():
+			self.paths[path] = hops
+
+		return results
+
+	def _advance(self, state: DoubletreeState, answers: dict[tuple[int, int], tuple[str, int]]):
+		forward, backward = state.forward, state.backward
+
+		if forward is not None:
+			answer = answers.get((state.path, forward))
+			state.forward = forward + 1
+
+			if answer is None:
+				if state.jumped_to == forward:
+					# The destination didn't answer where the matching trace said it would.
+					state.forward = None
+			elif answer[1] != ICMP_TIME_EXCEEDED:
+				state.forward = None
+			elif state.jumped_to is None:
+				source = self.global_stop.get((answer[0], state.prefix))
+				if source is not None and source[0] != state.path:
+					source_path, source_ttl = source
+					source_reached = self.reached[source_path]
+
+					# Only a trace that got to its destination says where ours should be.
+					if source_reached is not None and source_reached > source_ttl:
+						state.forward_stop = (forward, source)
+						state.forward = state.jumped_to = forward + source_reached - source_ttl
+
+			if state.forward is not None and state.forward > self.max_ttl:
+				state.forward = None
+
+		if backward is not None:
+			answer = answers.get((state.path, backward))
+			state.backward = backward - 1 or None
+
+			if answer is not None and answer[1] == ICMP_TIME_EXCEEDED:
+				source = self.local_stop.get(answer[0])
+				if source is not None and source[0] != state.path:
+					state.backward_stop = (backward, source)
+					state.backward = None
+
+		# Only routers go in the stop sets, not destinations. A global stop from a trace that
+		# finished without reaching its destination is no use, so it gets replaced.
+		for ttl in (forward, backward):
+			answer = ttl is not None and answers.get((state.path, ttl))
+			if answer and answer[1] == ICMP_TIME_EXCEEDED:
+				self.local_stop.setdefault(answer[0], (state.path, ttl))
+
+				key = (answer[0], state.prefix)
+				current = self.global_stop.get(key)
+				if current is None or (self.reached[current[0]] is None and current[0] not in self.active):
+					self.global_stop[key] = (state.path, ttl)
+
+	def _resolve(self, path: int, states: dict[int, DoubletreeState], resolved: dict[int, dict], resolving: set[int]) -> dict[int, tuple[str, float]]:
+		"""
+		A path's own answers plus the hops it skipped, copied from the paths it stopped on.
+		"""
+		if path in resolved:
+			return resolved[path]
+
+		hops = dict(self.paths[path])
+		state = states.get(path)
+		if state is None or path in resolving:
+			# From an earlier wave (already resolved), or a loop between stops.
+			return hops
+
+		resolving.add(path)
+
+		if state.backward_stop:
+			ttl, (source, source_ttl) = state.backward_stop
+			for source_hop, (responder, _) in self._resolve(source, states, resolved, resolving).items():
+				shifted = source_hop - source_ttl + ttl
+				if source_hop < source_ttl and shifted >= 1:
+					hops.setdefault(shifted, (responder, None))
+
+		if state.forward_stop:
+			ttl, (source, source_ttl) = state.forward_stop
+			source_reached = self.reached[source]
+			for source_hop, (responder, _) in self._resolve(source, states, resolved, resolving).items():
+				shifted = source_hop - source_ttl + ttl
+				# The matching trace's destination isn't ours.
+				if source_hop > source_ttl and (source_reached is None or source_hop < source_reached):
+					hops.setdefault(shifted, (responder, None))
+
+		resolving.discard(path)
+		resolved[path] = hops
+
+		return hops
+
+#######################################################
+# Functions ###########################################
+#######################################################
+def checksum(data: bytes) -> int:
+	if len(data) % 2:
+		data += b"\0"
+
+	total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+	total = (total >> 16) + (total & 0xFFFF)
+	total += total >> 16
+
+	return ~total & 0xFFFF
+
+def build_echo(ident: int, seq: int, payload: bytes) -> bytes:
+	header = struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, 0, ident, seq)
+	header = struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, checksum(header + payload), ident, seq)
+
+	return header + payload
+
+def parse_reply(packet: bytes) -> tuple[int, int, int] | None:
+	"""
+	:param packet: IPv4 packet as read from a raw ICMP socket.
+	:return: (icmp type, echo identifier, echo sequence) of the echo request it answers, or None.
+	"""
+	ihl = (packet[0] & 0x0F) * 4
+	if len(packet) < ihl + 8:
+		return None
+
+	icmp_type = packet[ihl]
+
+	if icmp_type == ICMP_ECHO_REPLY:
+		ident, seq = struct.unpack("!HH", packet[ihl + 4:ihl + 8])
+		return icmp_type, ident, seq
+
+	if icmp_type == ICMP_TIME_EXCEEDED or icmp_type == ICMP_DEST_UNREACHABLE:
+		# The original IP header and the first 8 bytes of our echo request are quoted after the
+		# 8 byte ICMP header.
+		inner = packet[ihl + 8:]
+		if len(inner) < 20:
+			return None
+
+		inner_ihl = (inner[0] & 0x0F) * 4
+		if len(inner) < inner_ihl + 8 or inner[9] != socket.IPPROTO_ICMP or inner[inner_ihl] != ICMP_ECHO_REQUEST:
+			return None
+
+		ident, seq = struct.unpack("!HH", inner[inner_ihl + 4:inner_ihl + 8])
+		return icmp_type, ident, seq
+
+	return None
+
+def prefix_of(destination: str) -> int:
+	return struct.unpack("!I", socket.inet_aton(destination))[0] >> (32 - DOUBLETREE_PREFIX_LENGTH)
+
+def resolve(addresses: list[str]) -> list[str]:
+	resolved = []
+	for addr in addresses:
+		try:
+			resolved.append(socket.gethostbyname(addr))
+		except OSError:
+			logger.warning(f"Unable to resolve \"{addr}\", it won't be traced")
+			resolved.append(None)
+
+	return resolved
+
+def sweep(candidates: dict[typing.Hashable, typing.Iterator[str]], quotas: dict[typing.Hashable, int], rate: float = None, timeout: float = None) -> typing.Iterator[tuple[typing.Hashable, str]]:
+	"""
+	Finds live hosts for every group at once, see ProbeEngine.sweep.
+	"""
+	with ProbeEngine() as engine:
+		logger.info(f"Sweeping {len(candidates)} group(s) at up to {rate or SWEEP_RATE} probes/s")
+		yield from engine.sweep(candidates, quotas, rate=rate, timeout=timeout)
+		logger.info(f"Sweep finished after {engine.sent} probe(s)")
+
+def probe_traceroute(addresses: list[str] | str, max_ttl: int = None, rate: float = None, timeout: float = None, doubletree: bool = None) -> list[dict]:
+	"""
+	Traces every address from this process without running any traceroute program.
+
+	:param doubletree: Probe with Doubletree (see ProbeEngine.trace_doubletree) instead of every
+		TTL of every target, defaults to PROBE_DOUBLETREE.
+
+	:return: Results in the same order as addresses, shaped like tracer.TracerouteResult.
+	"""
+	if type(addresses) == str:
+		addresses = [addresses]
+
+	if doubletree is None:
+		doubletree = PROBE_DOUBLETREE
+
+	destinations = resolve(addresses)
+	traceable = [d for d in destinations if d is not None]
+
+	with ProbeEngine(max_ttl=max_ttl, rate=rate, timeout=timeout) as engine:
+		logger.info(f"Probing {len(traceable)} destination(s) at up to {engine.rate} probes/s")
+		if doubletree:
+			traced = iter(engine.trace_doubletree(traceable))
+		else:
+			traced = iter(engine.trace(traceable))
+
+	results = []
+	for addr, destination in zip(addresses, destinations):
+		if destination is None:
+			results.append({"output": [], "destination_ip": addr, "completed": False})
+		else:
+			results.append(next(traced))
+
+	return results
@@ -0,0 +1,226 @@
+#######################################################
+# Imports #############################################
+#######################################################
+import archive
+import dataset
+import ip2location
+import pfx2as
+import tracer
+import tracestore
+import vrp
+from common import logger
+
+import datetime
+import multiprocessing as mp
+import os
+import time
+import typing
+
+import pandas as pd
+
+#######################################################
+# Globals #############################################
+#######################################################
+"""
+Runs parsing, AS mapping and RPKI validation again over traceroute output kept by
+tracer.py --archive, without sending a single probe. Handy after fixing a parser or to try a new
+analysis on weeks of measurements.
+
+python reanalyze.py ./archive ./reanalysis
+python reanalyze.py ./archive --dataset ./campaign --state Texas --since 2023-07-01 --vrpfile vrps.json
+
+Segments are parsed in parallel over a process pool. AS mapping and RPKI validation go through
+tracer.enrich, so they're batched and concurrent the same way they are in a normal run, and use
+the same caches and local data.
+
+Output is the hop table and the RPKI summary over every archived trace, each with the state and
+run the trace came from and when it was taken. With --dataset, the partition of each state and run
+is rewritten instead.
+"""
+
+# Runs recorded without a run id go in this partition.
+UNKNOWN_RUN = "-"
+# Traces recorded without a state go in this one, unless --state says otherwise.
+UNKNOWN_STATE = dataset.DEFAULT_STATE
+
+#######################################################
+# Classes #############################################
+#######################################################
+class ArchivedTrace(typing.NamedTuple):
+	target: str
+	run: str
+	state: str
+	time: float
+	trace: tracestore.PackedTrace
+
+#######################################################
+# Functions ###########################################
+#######################################################
+def _parse_segment(args: tuple[str, float, float, set[str], str]) -> (list[ArchivedTrace], int):
+	"""
+	:return: The traces in one segment that pass the filters, and how many records couldn't be parsed.
+	"""
+	path, since, until, targets, state = args
+
+	parsed = []
+	failed = 0
+	for record in archive.read_segment(path):
+		if (since and record["time"] < since) or (until and record["time"] >= until):
+			continue
+		if targets and record["target"] not in targets:
+			continue
+		# Records from before the state was archived are taken to be from the asked for state.
+		record_state = record.get("state") or state or UNKNOWN_STATE
+		if state and record_state != state:
+			continue
+
+		try:
+			output, dest_ip = tracer.TRACE_BACKENDS[record["backend"]].parse(record["output"])
+		except Exception as err:
+			logger.debug(f"Unable to parse archived trace to {record['target']} ({err})")
+			failed += 1
+			continue
+
+		result = tracer.make_result(output, dest_ip)
+		parsed.append(ArchivedTrace(record["target"], record["run"] or UNKNOWN_RUN, record_state, record["time"], tracestore.pack(result)))
+
+	return parsed, failed
+
+def load_archive(root: str, since: float = None, until: float = None, targets: list[str] = None, state: str = None, processes: int = None) -> list[ArchivedTrace]:
+	"""
+	Parses every archived trace, one segment per task.
+
+	:param since: Only traces started at or after this time (seconds since the epoch).
+	:param until: Only traces started before this time.
+	:param targets: Only traces to these targets.
+	:param state: Only traces from this state. Traces archived without a state count as from it.
+	:param processes: Worker processes, defaults to one per CPU. 1 parses in this process.
+	:return: The traces ordered by when they were taken.
+	"""
+	paths = archive.segments(root)
+	tasks = [(path, since, until, set(targets or []), state) for path in paths]
+
+	processes = min(len(tasks), processes or mp.cpu_count())
+	logger.info(f"Parsing {len(paths)} archive segment(s) with {max(processes, 1)} process(es)")
+
+	if processes <= 1:
+		results = list(map(_parse_segment, tasks))
+	else:
+		with mp.Pool(processes=processes) as pool:
+			results = list(pool.imap_unordered(_parse_segment, tasks))
+
+	traces = []
+	failed = 0
+	for parsed, segment_failed in results:
+		traces += parsed
+		failed += segment_failed
+
+	if failed:
+		logger.warning(f"{failed} archived trace(s) couldn't be parsed")
+
+	traces.sort(key=lambda t: t.time)
+	return traces
+
+def reanalyze(root: str, outfolder: str = None, dataset_root: str = None, state: str = None, since: float = None, until: float = None, targets: list[str] = None, processes: int = None) -> pd.DataFrame:
+	"""
+	:return: The hop table for every archived trace, with dataset.HOP_COLUMNS plus state, run and time.
+	"""
+	start = time.time()
+
+	archived = load_archive(root, since=since, until=until, targets=targets, state=state, processes=processes)
+	logger.info(f"Parsed {len(archived)} archived trace(s), time elapsed: {datetime.timedelta(seconds=time.time()-start)}")
+
+	traces = tracestore.TraceStore(len(archived))
+	for index, entry in enumerate(archived):
+		traces.add(index, entry.trace)
+
+	all_as_mappings = {}
+	rpki_table = {}
+	tracer.enrich(traces.hop_ips(), all_as_mappings, rpki_table)
+	logger.info(f"Finished enriching hops, time elapsed: {datetime.timedelta(seconds=time.time()-start)}")
+
+	trace_targets = [entry.target for entry in archived]
+	states = pd.Series([entry.state for entry in archived], dtype=object)
+	runs = pd.Series([entry.run for entry in archived], dtype=object)
+	times = pd.to_datetime(pd.Series([entry.time for entry in archived], dtype=float), unit="s")
+
+	traces.annotate(all_as_mappings, rpki_table, tracer.GEO_TABLE)
+	hops_df = traces.hop_table(trace_targets)
+	traces_df = traces.trace_table(trace_targets)
+	summary = dataset.summarize_hops(traces_df, hops_df)
+
+	trace_index = traces_df["trace"].to_numpy()
+	summary = summary.assign(trace=trace_index, state=states.to_numpy()[trace_index], run=runs.to_numpy()[trace_index], time=times.to_numpy()[trace_index])
+	hop_index = hops_df["trace"].to_numpy()
+	hops_df = hops_df.assign(state=states.to_numpy()[hop_index], run=runs.to_numpy()[hop_index], time=times.to_numpy()[hop_index])
+
+	if outfolder:
+		os.makedirs(outfolder, exist_ok=True)
+		hops_df.to_csv(os.path.join(outfolder, "hops.csv"), index=False)
+		summary.to_csv(os.path.join(outfolder, "rpki_summary.csv"), index=False)
+
+	if dataset_root:
+		# Each partition is replaced as a whole, so a run that was only partly archived loses the
+		# traces that weren't.
+		for (run_state, run), run_summary in summary.groupby(["state", "run"], sort=False):
+			run_hops = hops_df[(hops_df["state"] == run_state) & (hops_df["run"] == run)]
+			dataset.write_run(
+				dataset_root,
+				run_hops[dataset.HOP_COLUMNS],
+				run_summary[dataset.SUMMARY_COLUMNS + ["trace"]],
+				run_state, run
+			)
+
+	logger.info(f"Reanalyzed {len(archived)} trace(s), time elapsed: {datetime.timedelta(seconds=time.time()-start)}")
+	return hops_df
+
+def parse_time(value: str) -> float:
+	return datetime.datetime.fromisoformat(value).timestamp()
+
+#######################################################
+# Initialization ######################################
+#######################################################
+parser = tracer.HelpParser(
+	prog="reanalyze.py",
+	description="Parses, maps and validates archived traceroute output again without tracing.",
+	epilog=None
+)
+
+parser.add_argument("archive", type=str, help="An archive folder written by tracer.py --archive.")
+parser.add_argument("outfolder", type=str, nargs="?", help="A folder to write hops.csv and rpki_summary.csv to.")
+parser.add_argument("--dataset", type=str, help="Rewrite the partition of each archived state and run in the Parquet datasets in this folder.")
+parser.add_argument("--state", type=str, help="Only traces from this state. Traces archived without a state are taken to be from it.")
+parser.add_argument("--since", type=str, help="Only traces taken at or after this time, e.g. 2023-07-01 or 2023-07-01T12:00.")
+parser.add_argument("--until", type=str, help="Only traces taken before this time.")
+parser.add_argument("--target", action="append", type=str, help="Only traces to this target, can be given more than once.")
+parser.add_argument("--processes", type=int, help="Number of processes to parse with, defaults to one per CPU.")
+parser.add_argument("--vrpfile", type=str, help="Validate against a local VRP export (routinator/rpki-client .json or .csv) instead of RIPE.")
+parser.add_argument("--pfx2as", type=str, help="Map IPs to ASes from a local CAIDA pfx2as file or bgpdump -m RIB dump instead of Cymru.")
+parser.add_argument("--geodb", type=str, help="Geolocate every hop (country, region, city) from a local IP2LOCATION LITE DB3 CSV.")
+
+if __name__ == "__main__":
+	args = parser.parse_args()
+
+	if not args.outfolder and not args.dataset:
+		logger.error("Give an outfolder, --dataset, or both.")
+		exit(1)
+
+	if args.pfx2as:
+		tracer.AS_TABLE = pfx2as.load_prefix_table(args.pfx2as)
+
+	if args.vrpfile:
+		tracer.RPKI_VRPS = vrp.load_vrps(args.vrpfile)
+
+	if args.geodb:
+		tracer.GEO_TABLE = ip2location.load_geo_table(args.geodb)
+
+	reanalyze(
+		args.archive,
+		outfolder=args.outfolder,
+		dataset_root=args.dataset,
+		state=args.state,
+		since=args.since and parse_time(args.since),
+		until=args.until and parse_time(args.until),
+		targets=args.target,
+		processes=args.processes
+	)
@@ -0,0 +1,221 @@
+#######################################################
+# Imports #############################################
+#######################################################
+import dataset
+import tracer
+from common import logger
+
+import os
+import sys
+
+import pandas as pd
+
+#######################################################
+# Globals #############################################
+#######################################################
+"""
+Renders LaTeX tables from stored tracer results, only for the traces that are asked for.
+
+Results can come from a Parquet dataset (tracer.py --dataset) or from tracer output folders
+(rpki_summary.csv plus data/<target>.csv). A campaign root with one output folder per state works
+too, pick the state with --state.
+
+python report.py --dataset ./campaign --state Texas --status invalid --top 10 --longtable --out invalid.tex
+python report.py --outfolder C:/Users/Public/RPKI --state Ohio --target 93.184.216.34
+"""
+
+HOP_TABLE_COLUMNS = ["Hop", "IP", "Prefix", "AS", "RPKI Status"]
+
+# --status value -> summary column that has to be non-zero
+STATUS_FILTERS = {
+	"valid": "num_valid",
+	"invalid": "num_invalid",
+	"notfound": "num_notfound",
+}
+
+#######################################################
+# Functions ###########################################
+#######################################################
+def create_latex_longtable(columns: list, data: list, caption: str, label: str, hlines: bool = True) -> str:
+	"""
+	Same idea as tracer.create_latex_table, but as a longtable that can run over several pages,
+	with the header repeated on each one.
+	"""
+	c_str = "|" + "c|" * len(columns)
+	columns_str = " & ".join(columns)
+	data_str = []
+
+	hline_sep = (hlines and "\n\t\\hline\n\t") or "\n\t"
+
+	for row in data:
+		if type(row) == list:
+			data_str.append(" & ".join(str(v) for v in row) + "\\\\")
+		elif type(row) == str:
+			x = "\\multicolumn{" + str(len(columns)) + "}{|c|}{" + row + "}"
+			data_str.append(x + "\\\\")
+
+	data_str = hline_sep.join(data_str)
+
+	tex = """\\begin{longtable}{""" + c_str + """}
+	\\caption{""" + caption + """}
+	\\label{""" + label + """} \\\\
+	\\hline
+	""" + columns_str + """ \\\\
+	\\hline
+	\\endfirsthead
+	\\hline
+	""" + columns_str + """ \\\\
+	\\hline
+	\\endhead
+	""" + data_str + """
+	\\hline
+\\end{longtable}"""
+
+	return tex
+
+def target_string(target: str, destination_ip: str) -> str:
+	return (target == destination_ip and target) or f"{target} ({destination_ip})"
+
+def completed_string(completed) -> str:
+	return "Traceroute was " + ((completed is True or str(completed) == "True") and "successful" or "unsuccessful")
+
+def load_summary_from_dataset(root: str, states: list[str] = None, runs: list[str] = None) -> pd.DataFrame:
+	return dataset.load_table(root, dataset.SUMMARY_TABLE, states=states, runs=runs)
+
+def load_hops_from_dataset(root: str, selected: pd.DataFrame) -> dict[tuple, list[list]]:
+	"""
+	Reads only the partitions (and targets) that the selected summary rows live in.
+	"""
+	hops = dataset.load_table(
+		root, dataset.HOPS_TABLE,
+		states=list(selected["state"].unique()),
+		runs=list(selected["run"].unique()),
+		filters=[("target", "in", list(selected["destination"].unique()))]
+	)
+
+	hops = hops.sort_values(["state", "run", "trace", "hop"])
+	grouped = {}
+	for key, group in hops.groupby(["state", "run", "trace"], sort=False):
+		grouped[key] = group[dataset.HOP_DATA_COLUMNS].values.tolist()
+
+	return grouped
+
+def load_summary_from_outfolder(outfolder: str, state: str = None) -> pd.DataFrame:
+	summary = pd.read_csv(os.path.join(outfolder, "rpki_summary.csv"), dtype={"destination": str, "destination_ip": str})
+	summary["state"] = state or dataset.DEFAULT_STATE
+	summary["run"] = "-"
+	summary["trace"] = range(len(summary))
+
+	return summary
+
+def load_hops_from_outfolder(outfolder: str, selected: pd.DataFrame) -> dict[tuple, list[list]]:
+	grouped = {}
+	for row in selected.itertuples():
+		path = os.path.join(outfolder, "data", f"{row.destination}.csv")
+		if not os.path.exists(path):
+			logger.warning(f"No hop data for {row.destination} at {path}")
+			grouped[(row.state, row.run, row.trace)] = []
+			continue
+
+		hops = pd.read_csv(path, dtype=str, keep_default_na=False)
+		grouped[(row.state, row.run, row.trace)] = hops[dataset.HOP_DATA_COLUMNS].values.tolist()
+
+	return grouped
+
+def select(summary: pd.DataFrame, targets: list[str] = None, status: str = None, top: int = None, sort: str = "num_invalid") -> pd.DataFrame:
+	selected = summary
+
+	if targets:
+		selected = selected[selected["destination"].isin(targets) | selected["destination_ip"].isin(targets)]
+
+	if status:
+		selected = selected[selected[STATUS_FILTERS[status]].astype(int) > 0]
+
+	if top:
+		selected = selected.sort_values(sort, ascending=False, kind="stable").head(top)
+
+	return selected
+
+def render(selected: pd.DataFrame, hops: dict[tuple, list[list]], longtable: bool = False, caption: str = None, label: str = None) -> str:
+	"""
+	Renders one table per trace, or one longtable with every trace in it.
+	"""
+	tables = []
+	combined = []
+	for row in selected.itertuples():
+		target_str = target_string(row.destination, row.destination_ip)
+		data = [list(hop) for hop in hops.get((row.state, row.run, row.trace), [])]
+
+		if longtable:
+			state_str = (row.state != dataset.DEFAULT_STATE and f", {row.state}") or ""
+			combined.append(f"\\textbf{{{target_str}{state_str}}}")
+			combined += data
+			combined.append(completed_string(row.completed))
+		else:
+			data.append(completed_string(row.completed))
+			tables.append(tracer.create_latex_table(
+				HOP_TABLE_COLUMNS, data,
+				f"The results from a traceroute to {target_str}.",
+				f"tab:table-{target_str}"
+			))
+
+	if longtable:
+		return create_latex_longtable(
+			HOP_TABLE_COLUMNS, combined,
+			caption or f"The results from traceroutes to {len(selected)} target(s).",
+			label or "tab:traceroutes"
+		)
+
+	return "\n\n".join(tables)
+
+#######################################################
+# Initialization ######################################
+#######################################################
+parser = tracer.HelpParser(
+	prog="report.py",
+	description="Renders LaTeX tables from stored traceroute results.",
+	epilog=None
+)
+
+source = parser.add_mutually_exclusive_group(required=True)
+source.add_argument("--dataset", type=str, help="A Parquet dataset written by tracer.py --dataset.")
+source.add_argument("--outfolder", type=str, help="A tracer.py output folder, or a folder of them named by state.")
+parser.add_argument("--state", action="append", type=str, help="Only include this state, can be given more than once.")
+parser.add_argument("--run", action="append", type=str, help="Only include this run (dataset only), can be given more than once.")
+parser.add_argument("--target", action="append", type=str, help="Only include this target, can be given more than once.")
+parser.add_argument("--status", type=str, choices=list(STATUS_FILTERS.keys()), help="Only include traces with at least one prefix of this RPKI status.")
+parser.add_argument("--top", type=int, help="Only include this many traces, ordered by --sort.")
+parser.add_argument("--sort", type=str, default="num_invalid", help="Summary column to order by for --top.")
+parser.add_argument("--longtable", action="store_true", help="Put every selected trace in one longtable.")
+parser.add_argument("--caption", type=str, help="Caption for --longtable.")
+parser.add_argument("--label", type=str, help="Label for --longtable.")
+parser.add_argument("--out", type=str, help="File to write to, otherwise the tables are printed.")
+
+if __name__ == "__main__":
+	args = parser.parse_args()
+
+	if args.dataset:
+		summary = load_summary_from_dataset(args.dataset, states=args.state, runs=args.run)
+		selected = select(summary, targets=args.target, status=args.status, top=args.top, sort=args.sort)
+		hops = load_hops_from_dataset(args.dataset, selected) if len(selected) > 0 else {}
+	else:
+		summaries = []
+		hops = {}
+		folders = [(state, os.path.join(args.outfolder, state)) for state in args.state] if args.state else [(None, args.outfolder)]
+		for state, folder in folders:
+			summaries.append(load_summary_from_outfolder(folder, state))
+
+		summary = pd.concat(summaries, ignore_index=True)
+		selected = select(summary, targets=args.target, status=args.status, top=args.top, sort=args.sort)
+		for state, folder in folders:
+			in_folder = selected[selected["state"] == (state or dataset.DEFAULT_STATE)]
+			hops.update(load_hops_from_outfolder(folder, in_folder))
+
+	logger.info(f"Rendering {len(selected)} of {len(summary)} trace(s)")
+	tex = render(selected, hops, longtable=args.longtable, caption=args.caption, label=args.label)
+
+	if args.out:
+		with open(args.out, "w") as f:
+			f.write(tex)
+	else:
+		sys.stdout.write(tex + "\n")
@@ -0,0 +1,102 @@
+#######################################################
+# Imports #############################################
+#######################################################
+import cache
+import metrics
+from common import logger
+
+import ipaddress
+import socket
+import typing
+from multiprocessing.pool import ThreadPool
+
+#######################################################
+# Globals #############################################
+#######################################################
+"""
+Resolves target names to addresses ahead of tracing, so every traceroute runs against an IP
+instead of each subprocess resolving its own name one at a time.
+
+Lookups go through the system resolver (getaddrinfo) on a pool of threads, and answers are kept
+in a cache.DNSCache so a name is only looked up once per DNS_CACHE_TTL, however many lists it's in.
+"""
+
+DNS_CONCURRENCY = 64  # Lookups in flight at once
+# Traces (and the trace store) are IPv4.
+DNS_FAMILY = socket.AF_INET
+# Resolved names are written to the cache in batches this big.
+DNS_CACHE_BATCH = 1000
+
+#######################################################
+# Functions ###########################################
+#######################################################
+def is_address(target: str) -> bool:
+	try:
+		ipaddress.ip_address(target)
+		return True
+	except ValueError:
+		return False
+
+def _resolve_one(name: str) -> (str, str | None):
+	try:
+		infos = socket.getaddrinfo(name, None, family=DNS_FAMILY, type=socket.SOCK_STREAM)
+	except (socket.gaierror, UnicodeError) as err:
+		logger.debug(f"Unable to resolve {name}: {err}")
+		return name, None
+
+	if len(infos) == 0:
+		return name, None
+
+	return name, infos[0][4][0]
+
+def resolve(targets: typing.Iterable[str], concurrency: int = None, dns_cache: cache.DNSCache = None) -> dict[str, str | None]:
+	"""
+	:param targets: Names and/or addresses, duplicates are fine. Addresses map to themselves.
+	:param concurrency: Lookups in flight at once, defaults to DNS_CONCURRENCY.
+	:param dns_cache: Cache to read from and write to.
+	:return: target -> address, or None for names that didn't resolve.
+	"""
+	concurrency = concurrency or DNS_CONCURRENCY
+
+	addresses = {}
+	names = []
+	for target in dict.fromkeys(targets):
+		if is_address(target):
+			addresses[target] = target
+		else:
+			names.append(target)
+
+	if len(names) == 0:
+		return addresses
+
+	if dns_cache:
+		cached = dns_cache.get_many(names)
+		addresses.update(cached)
+		names = [name for name in names if name not in cached]
+		metrics.CACHE_LOOKUPS.inc(len(cached), cache="dns", result="hit")
+		metrics.CACHE_LOOKUPS.inc(len(names), cache="dns", result="miss")
+
+	logger.info(f"Resolving {len(names)} name(s) ({len(addresses)} target(s) already known)")
+	if len(names) == 0:
+		return addresses
+
+	failed = 0
+	resolved = {}
+	with ThreadPool(processes=min(len(names), concurrency)) as pool:
+		for name, address in pool.imap_unordered(_resolve_one, names, chunksize=4):
+			resolved[name] = address
+			failed += address is None
+
+			if dns_cache and len(resolved) >= DNS_CACHE_BATCH:
+				dns_cache.set_many(resolved)
+				addresses.update(resolved)
+				resolved = {}
+
+	if dns_cache:
+		dns_cache.set_many(resolved)
+	addresses.update(resolved)
+
+	if failed:
+		logger.warning(f"Unable to resolve {failed} of {len(names)} name(s)")
+
+	return addresses
@@ -0,0 +1,64 @@
+import dataset
+import ip2location
+import tracestore
+
+import numpy as np
+
+#######################################################
+# Functions ###########################################
+#######################################################
+def geo_table() -> ip2location.GeoTable:
+	# 8.8.8.0 - 8.8.8.255
+	return ip2location.GeoTable(
+		np.asarray([134744064], dtype=np.uint32),
+		np.asarray([134744319], dtype=np.uint32),
+		{"country": np.asarray([0], dtype=np.int8), "region": np.asarray([0], dtype=np.int8), "city": np.asarray([0], dtype=np.int8)},
+		{"country": np.asarray(["US"], dtype=object), "region": np.asarray(["California"], dtype=object), "city": np.asarray(["Mountain View"], dtype=object)},
+	)
+
+def write(root: str, run: str, as_mappings: dict, rpki_table: dict, geo: ip2location.GeoTable = None):
+	targets = ["8.8.8.8"]
+	traces = tracestore.TraceStore(len(targets))
+	traces.add(0, {"output": [{"ip": "10.0.0.1", "timestr": "1 ms"}, {"ip": "8.8.8.8", "timestr": "9 ms"}], "destination_ip": "8.8.8.8", "completed": True})
+	traces.annotate(as_mappings, rpki_table, geo)
+
+	hops = traces.hop_table(targets)
+	traces_df = traces.trace_table(targets)
+	summary = dataset.summarize_hops(traces_df, hops)
+	dataset.write_run(root, hops, summary.assign(trace=traces_df["trace"].to_numpy()), "California", run)
+
+#######################################################
+# Tests ###############################################
+#######################################################
+MAPPINGS = {
+	"10.0.0.1": {"asn": "NA", "ip": "10.0.0.1", "prefix": "NA"},
+	"8.8.8.8": {"asn": "15169", "ip": "8.8.8.8", "prefix": "8.8.8.0/24"},
+}
+RPKI_TABLE = {("NA", "NA"): {}, ("15169", "8.8.8.0/24"): {"status": "valid"}}
+
+def test_runs_with_and_without_geo_table(tmp_path):
+	root = str(tmp_path)
+	write(root, "20230719T055023", MAPPINGS, RPKI_TABLE)
+	write(root, "20230720T055023", MAPPINGS, RPKI_TABLE, geo_table())
+
+	hops = dataset.load_table(root, dataset.HOPS_TABLE).sort_values(["run", "hop"])
+
+	countries = hops["country"].astype(object).where(hops["country"].notna(), None).tolist()
+	assert countries == [None, None, None, "US"]
+	assert hops["city"].astype(object).iloc[3] == "Mountain View"
+
+def test_run_without_prefixes_next_to_one_with(tmp_path):
+	# Hops that were never mapped have no prefix, ASN or status at all.
+	root = str(tmp_path)
+	targets = ["8.8.8.8"]
+	traces = tracestore.TraceStore(len(targets))
+	traces.add(0, {"output": [{"ip": "10.0.0.1", "timestr": "1 ms"}], "destination_ip": "8.8.8.8", "completed": False})
+
+	hops = traces.hop_table(targets)
+	assert hops["prefix"].isna().all()
+	dataset.write_table(root, dataset.HOPS_TABLE, hops.astype(dataset.HOP_DTYPES), "California", "20230719T055023")
+	write(root, "20230720T055023", MAPPINGS, RPKI_TABLE)
+
+	hops = dataset.load_table(root, dataset.HOPS_TABLE).sort_values(["run", "hop"])
+	prefixes = hops["prefix"].astype(object).where(hops["prefix"].notna(), None).tolist()
+	assert prefixes == [None, "NA", "8.8.8.0/24"]
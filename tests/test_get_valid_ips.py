@@ -0,0 +1,38 @@
+import ipaddress
+import random
+
+import pytest
+
+#######################################################
+# Fixtures ############################################
+#######################################################
+@pytest.fixture
+def get_valid_ips(tmp_path, monkeypatch):
+	# It opens its log file in the working directory on import.
+	monkeypatch.chdir(tmp_path)
+	import get_valid_ips
+	return get_valid_ips
+
+#######################################################
+# Tests ###############################################
+#######################################################
+def test_host_sampler_draws_every_host_once(get_valid_ips):
+	prefixes = ["10.0.0.0/24", "10.0.1.0/25", "192.168.5.0/30"]
+	hosts = list(get_valid_ips.HostSampler(prefixes, random.Random(1)))
+
+	expected = {str(host) for prefix in prefixes for host in ipaddress.ip_network(prefix).hosts()}
+	assert len(hosts) == len(expected)
+	assert set(hosts) == expected
+
+@pytest.mark.parametrize("seed", range(5))
+def test_host_sampler_low_bits_are_not_periodic(get_valid_ips, seed):
+	hosts = get_valid_ips.HostSampler(["10.0.0.0/16"], random.Random(seed))
+	numbers = [int(ipaddress.ip_address(next(hosts))) for _ in range(4000)]
+
+	# A bare LCG modulo a power of two repeats bit k every 2^(k+1) draws.
+	for bit in range(4):
+		period = 2 << bit
+		values = [(number >> bit) & 1 for number in numbers]
+		repeats = sum(values[i] == values[i + period] for i in range(len(values) - period))
+
+		assert 0.4 < repeats / (len(values) - period) < 0.6, f"bit {bit} repeats every {period} draws"
@@ -0,0 +1,53 @@
+import journal
+import tracer
+
+import pytest
+
+#######################################################
+# Fixtures ############################################
+#######################################################
+@pytest.fixture
+def offline(monkeypatch):
+	"""
+	No caches, archive or name lookups, and RPKI lookups answered locally. Returns the pairs each
+	resolve_rpki_data call was given.
+	"""
+	for name in ["AS_CACHE", "RPKI_CACHE", "PATH_CACHE", "DNS_CACHE", "ARCHIVE", "GEO_TABLE"]:
+		monkeypatch.setattr(tracer, name, None)
+	monkeypatch.setattr(tracer, "RESOLVE_TARGETS", False)
+
+	calls = []
+	def resolve_rpki_data(pairs, *args, **kwargs):
+		calls.append(sorted(pairs))
+		return {pair: {"status": "valid"} for pair in pairs}
+
+	monkeypatch.setattr(tracer, "resolve_rpki_data", resolve_rpki_data)
+	return calls
+
+#######################################################
+# Tests ###############################################
+#######################################################
+def test_resume_resolves_rpki_missing_from_journal(tmp_path, offline, monkeypatch):
+	# Died after journaling the AS mappings, before the RPKI data.
+	outfolder = str(tmp_path / "out")
+	with journal.Journal(journal.journal_path(outfolder), run_id="20230719T055023") as run_journal:
+		run_journal.record_trace("8.8.8.8", {"output": [{"ip": "10.0.0.1", "timestr": "1 ms"}, {"ip": "8.8.8.8", "timestr": "9 ms"}], "destination_ip": "8.8.8.8", "completed": True})
+		run_journal.record_as_mappings({
+			"10.0.0.1": {"asn": "NA", "ip": "10.0.0.1", "prefix": "NA"},
+			"8.8.8.8": {"asn": "15169", "ip": "8.8.8.8", "prefix": "8.8.8.0/24"},
+		})
+
+	def mapToASes(ips):
+		raise AssertionError(f"{ips} were mapped already")
+	monkeypatch.setattr(tracer, "mapToASes", mapToASes)
+
+	hops = tracer.main(["8.8.8.8"], outfolder=outfolder, multiprocessing=False, resume=True, latex_tables=False)
+
+	assert offline == [[("15169", "8.8.8.0/24"), ("NA", "NA")]]
+	assert hops["status"].tolist() == ["Valid", "Valid"]
+	assert journal.is_complete(outfolder)
+
+	# The resolved pairs were journaled too, so resuming again has nothing left to look up.
+	resumed = journal.Journal(journal.journal_path(outfolder), resume=True)
+	resumed.close()
+	assert set(resumed.rpki_table) == {("15169", "8.8.8.0/24"), ("NA", "NA")}
@@ -1,24 +1,44 @@
 #######################################################
 # Imports #############################################
 #######################################################
+import archive
+import cache
 import common
+import dataset
+import ip2location
+import journal
+import metrics
+import pfx2as
+import probe
+import resolver
+import tracestore
+import vrp
 from common import logger
 
 import argparse
+import asyncio
+import csv
 import datetime
+import gzip
 import json
 import os
+import numpy as np
 import pandas as pd
 import multiprocessing as mp
+import queue
 import re
 import signal
 import socket
 import sys
+import threading
 import time
 import traceback
 import typing
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.pool import ThreadPool
 from urllib.parse import urlparse
 
+import aiohttp
 import requests
 
 # import scapy.layers.inet as scapyinet
@@ -34,6 +54,49 @@ WIN32_TRACE_PATTERN = r"^\s*(\d+)\s+([<\d\sms*]+)\s+([\w\d\s.]+)\s*$"  # /gm
 # WIN32_TRACE_DEST_IP = r"Tracing route to [\w\d.-]+ \[(\d+\.\d+\.\d+\.\d+)\]"
 WIN32_TRACE_DEST_IP = r"Tracing route to ([\w\d.-]+)[\s\w]*\[*([\d.]*)\]*"
 
+LINUX_TRACE = ["traceroute", "-n"]
+LINUX_TRACE_PATTERN = r"^\s*(\d+)\s+(.+)$"  # /gm
+LINUX_TRACE_DEST_IP = r"traceroute to ([\w\d.:-]+) \(([\d.:a-fA-F]+)\)"
+IP_PATTERN = r"^\d+\.\d+\.\d+\.\d+$"
+
+"""
+traceroute to 93.184.216.34 (93.184.216.34), 30 hops max, 60 byte packets
+ 1  10.0.0.1  0.390 ms  0.360 ms  0.342 ms
+ 2  * * *
+ 3  216.169.31.34  2.104 ms 216.169.31.35  2.114 ms  2.099 ms
+ 4  93.184.216.34  6.153 ms  6.133 ms *
+"""
+
+MTR_TRACE = ["mtr", "--json", "-n", "-c", "3"]
+
+"""
+{
+	"report": {
+		"mtr": { "src": "host", "dst": "93.184.216.34", "tos": 0, "tests": 3, "psize": "64", "bitpattern": "0x00" },
+		"hubs": [
+			{ "count": 1, "host": "10.0.0.1", "Loss%": 0.0, "Snt": 3, "Last": 0.4, "Avg": 0.4, "Best": 0.3, "Wrst": 0.5, "StDev": 0.1 },
+			{ "count": 2, "host": "???", "Loss%": 100.0, "Snt": 3, "Last": 0.0, "Avg": 0.0, "Best": 0.0, "Wrst": 0.0, "StDev": 0.0 },
+			...
+		]
+	}
+}
+"""
+
+# Default backend for the platform, see TRACE_BACKENDS.
+TRACE_BACKEND = (sys.platform == "win32" and "win32") or "traceroute"
+
+# Adaptive concurrency for async_traceroute, driven by probe loss at hops that do answer (see probe_loss).
+TRACE_CONCURRENCY = 256
+TRACE_MIN_CONCURRENCY = 4
+TRACE_LOSS_HIGH = 0.2  # Halve concurrency above this much (smoothed) probe loss
+TRACE_LOSS_LOW = 0.05  # Creep concurrency back up below this much
+TRACE_LOSS_SMOOTHING = 0.1
+
+# main hands finished traces to AS mapping / RPKI validation once this many have piled up, or
+# this many seconds have passed, whichever comes first.
+ENRICH_BATCH_SIZE = 50
+ENRICH_INTERVAL = 10
+
 """
 Tracing route to 93.184.216.34 over a maximum of 30 hops
                                                         
@@ -89,7 +152,41 @@ NA      | 10.255.235.4     | NA                  |    | other    |            |
 
 """
 
-PROCESS_START_TIME = time.time()
+CYMRU_WHOIS = ("whois.cymru.com", 43)
+WHOIS_CHUNK_SIZE = 5000  # IPs per bulk session
+WHOIS_CONNECTIONS = 4  # Cymru doesn't like being hammered, keep this small.
+WHOIS_RETRIES = 3
+WHOIS_TIMEOUT = 120  # Seconds without any data before a session is abandoned
+
+# When set, IPs are mapped to ASes from this local prefix table instead of Cymru.
+AS_TABLE: pfx2as.PrefixTable = None
+
+# When set, every hop is also geolocated (country, region, city) from this IP2LOCATION DB3 table.
+GEO_TABLE: ip2location.GeoTable = None
+
+# Set to None to always go to Cymru.
+AS_CACHE = cache.ASCache()
+
+# Set to None to always go to RIPE.
+RPKI_CACHE = cache.RPKICache()
+
+# Limits for the batch RPKI lookup stage. RIPEstat asks that clients stay polite.
+RPKI_CONCURRENCY = 32  # Requests in flight at once
+RPKI_RATE_LIMIT = 50  # Requests per second
+RPKI_RETRIES = 3
+
+# When set, RPKI validation is done against this local VRP export instead of RIPE.
+RPKI_VRPS: vrp.VRPIndex = None
+
+# Last known path to each target. Set to None to always map and validate every hop.
+PATH_CACHE = cache.PathCache()
+
+# Target names get resolved up front (concurrently, and cached here) so traces only see addresses.
+RESOLVE_TARGETS = True
+DNS_CACHE = cache.DNSCache()
+
+# Set to an archive.TraceArchive to keep the raw output of every traceroute, see reanalyze.py.
+ARCHIVE = None
 
 #######################################################
 # Classes #############################################
@@ -109,6 +206,74 @@ class TracerouteResult(typing.TypedDict):
 	destination_ip: str
 	completed: bool
 
+class TokenBucket:
+	"""
+	Simple token bucket for asyncio code. Tokens refill at `rate` per second up to `capacity`.
+	"""
+	def __init__(self, rate: float, capacity: float = None):
+		self.rate = rate
+		self.capacity = capacity or rate
+		self.tokens = self.capacity
+		self.last = time.monotonic()
+		self.lock = asyncio.Lock()
+
+	async def acquire(self):
+		async with self.lock:
+			while True:
+				now = time.monotonic()
+				self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+				self.last = now
+
+				if self.tokens >= 1:
+					self.tokens -= 1
+					return
+
+				await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class TraceBackend(typing.NamedTuple):
+	name: str  # Key in TRACE_BACKENDS
+	command: list[str]
+	parse: typing.Callable[[str], tuple[list[Hop], str]]
+	# (answered, sent) probes per hop, used to detect rate limiting.
+	probes: typing.Callable[[str], list[tuple[int, int]]]
+
+class AdaptiveLimiter:
+	"""
+	Concurrency limit for asyncio tasks that backs off multiplicatively when hop loss goes up and
+	recovers additively when it's low, so we don't set off ICMP rate limiting along the path.
+	"""
+	def __init__(self, maximum: int, minimum: int = 1):
+		self.maximum = maximum
+		self.minimum = min(minimum, maximum)
+		self.limit = maximum
+		self.in_flight = 0
+		self.loss = 0.0
+		self.condition = asyncio.Condition()
+
+	async def acquire(self):
+		async with self.condition:
+			await self.condition.wait_for(lambda: self.in_flight < self.limit)
+			self.in_flight += 1
+			metrics.TRACES_IN_FLIGHT.set(self.in_flight)
+
+	async def release(self, loss: float = None):
+		async with self.condition:
+			self.in_flight -= 1
+			metrics.TRACES_IN_FLIGHT.set(self.in_flight)
+
+			if loss is not None:
+				self.loss += (loss - self.loss) * TRACE_LOSS_SMOOTHING
+
+				if self.loss > TRACE_LOSS_HIGH and self.limit > self.minimum:
+					self.limit = max(self.minimum, self.limit // 2)
+					# Start over so one bad stretch doesn't keep halving the limit.
+					self.loss = (TRACE_LOSS_HIGH + TRACE_LOSS_LOW) / 2
+					logger.warning(f"Hop loss is high, lowering trace concurrency to {self.limit}")
+				elif self.loss < TRACE_LOSS_LOW and self.limit < self.maximum:
+					self.limit += 1
+
+			self.condition.notify_all()
+
 class HelpParser(argparse.ArgumentParser):
 	def error(self, message):
 		sys.stderr.write("Error: %s\n" % message)
@@ -120,24 +285,55 @@ class HelpParser(argparse.ArgumentParser):
 #######################################################
 # Functions ###########################################
 #######################################################
-def get_IPs_from_file(infile: str, column: str = None) -> list[str]:
-	ext = os.path.splitext(infile)[1]
+def target_host(url: str) -> str:
+	"""
+	The host part of a URL from a .csv target list. Bare names (no scheme) are taken as they are.
+	"""
+	url = url.strip()
+	if "//" not in url:
+		url = "//" + url
+
+	return urlparse(url).hostname or ""
+
+def iter_targets(infile: str, column: str = None) -> typing.Iterator[str]:
+	"""
+	Streams the targets out of a .txt (one per line) or .csv (URLs in `column`) list, either of
+	which can be gzipped (e.g. sites.csv.gz). Blank entries and repeats are skipped.
+	"""
+	path, ext = os.path.splitext(infile)
+	opener = open
+	if ext == ".gz":
+		opener = gzip.open
+		ext = os.path.splitext(path)[1]
 
 	if ext == ".txt":
-		with open(args.infile, "r") as f:
-			return list(map(lambda l: l.strip(), f.readlines()))
+		def read(f):
+			for line in f:
+				yield line.strip()
 	elif ext == ".csv":
 		if column is None:
 			logger.error("Unable to process .csv without specifying the column to get URLs from.")
 			exit(1)
 
-		df = pd.read_csv(infile)
-		sites = df[column]
-		return list(sites.apply(lambda x: urlparse(x).netloc))
+		def read(f):
+			for row in csv.DictReader(f):
+				yield target_host(row[column] or "")
 	else:
 		logger.error(f"Unable to process infile of filetype [{ext}]")
 		exit(1)
 
+	seen = set()
+	with opener(infile, "rt", newline="") as f:
+		for target in read(f):
+			if target == "" or target in seen:
+				continue
+
+			seen.add(target)
+			yield target
+
+def get_IPs_from_file(infile: str, column: str = None) -> list[str]:
+	return list(iter_targets(infile, column))
+
 def create_latex_table(columns: list, data: list, caption: str, label: str, hlines: bool = True) -> str:
 	c_str = "|" + "c|" * len(columns)
 	columns_str = " & ".join(columns)
@@ -171,8 +367,21 @@ def create_latex_table(columns: list, data: list, caption: str, label: str, hlin
 	return tex
 
 
-def get_rpki_data(asn: str, ip_prefix: str):
-	res = requests.get(RIPE_RPKI.format(asn, ip_prefix))
+def get_rpki_data(asn: str, ip_prefix: str, rpki_cache: cache.RPKICache = None):
+	if RPKI_VRPS:
+		return RPKI_VRPS.validate(asn, ip_prefix)
+
+	if rpki_cache is None:
+		rpki_cache = RPKI_CACHE
+
+	if rpki_cache:
+		cached = rpki_cache.get(asn, ip_prefix)
+		metrics.CACHE_LOOKUPS.inc(cache="rpki", result=(cached is not None and "hit") or "miss")
+		if cached is not None:
+			return cached
+
+	with metrics.RPKI_DURATION.time():
+		res = requests.get(RIPE_RPKI.format(asn, ip_prefix))
 	# Who needs error handling?
 	res = res.json()
 
@@ -208,56 +417,128 @@ def get_rpki_data(asn: str, ip_prefix: str):
 	}
 	"""
 
-	return res["data"]
+	data = res["data"]
+	metrics.RPKI_REQUESTS.inc(result=("status" in data and "ok") or "failed")
 
-def mapToASes(ips: list[str]) -> dict[str, ASMapping]:
-	"""
-	Maps a list of IPs to their autonomous systems.
+	# Don't remember failed lookups, they might work next time.
+	if rpki_cache and "status" in data:
+		rpki_cache.set(asn, ip_prefix, data)
 
-	:param ips:
-	:return:
-	"""
-	# https://docs.python.org/3/library/socket.html
-	# https://docs.python.org/3/howto/sockets.html
+	return data
 
-	# 15169   | 8.8.8.8          | 8.8.8.0/24          | US | arin     | 1992-12-01 | GOOGLE, US
+async def _fetch_rpki_data(session: aiohttp.ClientSession, semaphore: asyncio.Semaphore, bucket: TokenBucket, asn: str, ip_prefix: str) -> dict:
+	url = RIPE_RPKI.format(asn, ip_prefix)
+
+	for attempt in range(RPKI_RETRIES):
+		await bucket.acquire()
+		async with semaphore:
+			try:
+				with metrics.RPKI_DURATION.time():
+					async with session.get(url) as res:
+						if res.status == 429 or res.status >= 500:
+							raise aiohttp.ClientResponseError(res.request_info, res.history, status=res.status)
+						res = await res.json()
+				data = res["data"]
+			except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+				metrics.RPKI_REQUESTS.inc(result="retried")
+				logger.debug(f"RPKI lookup for {asn}, {ip_prefix} failed ({err}), attempt {attempt + 1}/{RPKI_RETRIES}")
+			except (ValueError, KeyError, TypeError) as err:
+				# A body that isn't what RIPE normally sends won't get any better by asking again.
+				metrics.RPKI_REQUESTS.inc(result="failed")
+				logger.warning(f"Unexpected RPKI response for {asn}, {ip_prefix} ({err!r})")
+				return {}
+			else:
+				metrics.RPKI_REQUESTS.inc(result="ok")
+				return data
+
+		if attempt + 1 < RPKI_RETRIES:
+			await asyncio.sleep(2 ** attempt)
 
-	s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-	s.connect(("whois.cymru.com", 43))
-	s.send(b"begin\n")
-	s.send(b"verbose\n")
+	metrics.RPKI_REQUESTS.inc(result="failed")
+	logger.warning(f"Giving up on RPKI lookup for {asn}, {ip_prefix}")
+	return {}
 
-	results = str(s.recv(256), "ascii")
-	for idx, ip in enumerate(ips):
-		s.send(bytes(ip + "\n", "ascii"))
-		res = s.recv(256)
-		results += str(res, "ascii")
+async def _resolve_rpki_data(pairs: list[tuple[str, str]], concurrency: int, rate: float) -> dict[tuple[str, str], dict]:
+	semaphore = asyncio.Semaphore(concurrency)
+	bucket = TokenBucket(rate)
 
-	s.send(b"end\n")
-	s.close()
+	# One pooled session so connections (and their TLS handshakes) get reused.
+	connector = aiohttp.TCPConnector(limit=concurrency)
+	timeout = aiohttp.ClientTimeout(total=60)
+	async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+		results = await asyncio.gather(*[_fetch_rpki_data(session, semaphore, bucket, asn, prefix) for asn, prefix in pairs])
 
+	return dict(zip(pairs, results))
+
+def resolve_rpki_data(pairs: list[tuple[str, str]], concurrency: int = None, rate: float = None, rpki_cache: cache.RPKICache = None) -> dict[tuple[str, str], dict]:
 	"""
-	results = ""
-	while True:
-		msg = s.recv(2^5)
-		if msg == b'':
-			break
-		results += str(msg, "ascii")
+	Looks up the RPKI status of every unique (asn, prefix) pair concurrently.
+
+	:param pairs: (asn, prefix) pairs, duplicates are fine.
+	:param concurrency: Maximum requests in flight, defaults to RPKI_CONCURRENCY.
+	:param rate: Maximum requests per second, defaults to RPKI_RATE_LIMIT.
+	:param rpki_cache: Cache to use instead of RPKI_CACHE.
+	:return: The RIPE "data" object for each pair.
 	"""
+	concurrency = concurrency or RPKI_CONCURRENCY
+	rate = rate or RPKI_RATE_LIMIT
+	if rpki_cache is None:
+		rpki_cache = RPKI_CACHE
+
+	table = {}
+	pending = []
+	for pair in set(pairs):
+		asn, prefix = pair
+		if prefix is None or prefix == "NA":
+			# Private or unannounced space, RIPE has nothing to say about these.
+			table[pair] = {}
+		else:
+			pending.append(pair)
 
-	#with open("afgh.txt", "w") as f:
-		#f.write("\n".join(ips))
+	if RPKI_VRPS:
+		# Local validation is cheap enough that there's nothing to gain from the cache or batching.
+		for asn, prefix in pending:
+			table[(asn, prefix)] = RPKI_VRPS.validate(asn, prefix)
 
-	#with open("asd.txt", "w") as f:
-		#f.write(results)
+		return table
 
-	lines = results.splitlines()
-	lines.pop(0)
-	data = {}
+	if rpki_cache:
+		cached = rpki_cache.get_many(pending)
+		table.update(cached)
+		pending = [pair for pair in pending if pair not in cached]
+		metrics.CACHE_LOOKUPS.inc(len(cached), cache="rpki", result="hit")
+		metrics.CACHE_LOOKUPS.inc(len(pending), cache="rpki", result="miss")
 
+	logger.info(f"Resolving RPKI status for {len(pending)} pair(s) ({len(table)} already known)")
+	if len(pending) > 0:
+		fetched = asyncio.run(_resolve_rpki_data(pending, concurrency, rate))
+		table.update(fetched)
+
+		if rpki_cache:
+			# Don't remember failed lookups, they might work next time.
+			rpki_cache.set_many({pair: data for pair, data in fetched.items() if "status" in data})
+
+	return table
+
+def _query_cymru(ips: list[str]) -> (dict[str, ASMapping], list[str]):
+	"""
+	Runs one bulk whois session against Team Cymru for a chunk of IPs.
+
+	The whole chunk is written up front and the reply is read until the server closes the
+	connection, splitting on newlines as data arrives so a line spanning two recv calls is fine.
+
+	:param ips:
+	:return: The mappings that were parsed, and any lines that didn't match CYMRU_PATTERN.
+	"""
+	# https://docs.python.org/3/library/socket.html
+	# https://docs.python.org/3/howto/sockets.html
+
+	# 15169   | 8.8.8.8          | 8.8.8.0/24          | US | arin     | 1992-12-01 | GOOGLE, US
 	pattern = re.compile(CYMRU_PATTERN)
+	data = {}
+	bad_lines = []
 
-	for line in lines:
+	def parse_line(line: str):
 		match = pattern.match(line)
 
 		# Two notable differences between a private and something without an AS: CC and Allocated
@@ -272,11 +553,94 @@ def mapToASes(ips: list[str]) -> dict[str, ASMapping]:
 				"ip": IP,
 				"prefix": BGP_Prefix
 			}
-		else:
-			raise Exception('oh no!')
+		elif line.strip() != "" and not line.startswith("Bulk mode;"):
+			bad_lines.append(line)
+
+	query = "begin\nverbose\n" + "\n".join(ips) + "\nend\n"
+
+	with socket.create_connection(CYMRU_WHOIS, timeout=WHOIS_TIMEOUT) as s:
+		s.sendall(bytes(query, "ascii"))
+
+		buffer = b""
+		while True:
+			chunk = s.recv(65536)
+			if chunk == b"":
+				break
+
+			buffer += chunk
+			*lines, buffer = buffer.split(b"\n")
+			for line in lines:
+				parse_line(str(line, "ascii", errors="replace"))
+
+		if buffer:
+			parse_line(str(buffer, "ascii", errors="replace"))
+
+	return data, bad_lines
+
+def _query_cymru_chunk(ips: list[str]) -> (dict[str, ASMapping], list[str]):
+	metrics.WHOIS_BATCH_SIZE.observe(len(ips))
+	try:
+		with metrics.WHOIS_DURATION.time():
+			data, bad_lines = _query_cymru(ips)
+	except OSError as err:
+		metrics.WHOIS_QUERIES.inc(result="failed")
+		logger.warning(f"Cymru whois query for a chunk of {len(ips)} IP(s) failed: {err}")
+		return {}, ips
+
+	metrics.WHOIS_QUERIES.inc(result="ok")
+
+	for line in bad_lines:
+		logger.warning(f"Unable to parse Cymru whois line: {line}")
+
+	missing = [ip for ip in ips if ip not in data]
+	return data, missing
+
+def mapToASes(ips: list[str]) -> dict[str, ASMapping]:
+	"""
+	Maps a list of IPs to their autonomous systems.
 
-	#with open("data.json", "w") as f:
-		#json.dump(data, f, indent="\t")
+	IPs covered by a prefix in AS_CACHE are mapped locally. The rest are sent to Cymru's bulk whois in chunks of WHOIS_CHUNK_SIZE over up to WHOIS_CONNECTIONS
+	connections at once. IPs that didn't come back get retried, and anything still unresolved after
+	WHOIS_RETRIES is mapped to NA like private space is.
+
+	:param ips:
+	:return:
+	"""
+	ips = list(dict.fromkeys(ips))
+
+	if AS_TABLE:
+		return AS_TABLE.map_to_ases(ips)
+
+	data = {}
+
+	pending = ips
+	if AS_CACHE:
+		data, pending = AS_CACHE.lookup(ips)
+		cached = set(data.keys())
+		metrics.CACHE_LOOKUPS.inc(len(data), cache="as", result="hit")
+		metrics.CACHE_LOOKUPS.inc(len(pending), cache="as", result="miss")
+		logger.info(f"{len(data)} IP(s) covered by cached prefixes, querying Cymru for {len(pending)}")
+
+	for attempt in range(WHOIS_RETRIES):
+		if len(pending) == 0:
+			break
+
+		chunks = [pending[i:i + WHOIS_CHUNK_SIZE] for i in range(0, len(pending), WHOIS_CHUNK_SIZE)]
+		logger.debug(f"Querying Cymru for {len(pending)} IP(s) in {len(chunks)} chunk(s), attempt {attempt + 1}/{WHOIS_RETRIES}")
+
+		pending = []
+		with ThreadPool(processes=min(len(chunks), WHOIS_CONNECTIONS)) as pool:
+			for chunk_data, missing in pool.imap_unordered(_query_cymru_chunk, chunks):
+				data.update(chunk_data)
+				pending += missing
+
+	if AS_CACHE:
+		AS_CACHE.set_many({ip: mapping for ip, mapping in data.items() if ip not in cached})
+
+	if len(pending) > 0:
+		logger.warning(f"Unable to map {len(pending)} IP(s) to an AS, treating them as NA")
+		for ip in pending:
+			data[ip] = {"asn": "NA", "ip": ip, "prefix": "NA"}
 
 	return data
 
@@ -313,28 +677,262 @@ def parse_output(results: str) -> (list[Hop], str):
 
 	return route_data, destination_ip
 
-def traceroute(addresses: list[str] | str) -> list[TracerouteResult]:
+def parse_traceroute_output(results: str) -> (list[Hop], str):
+	hop_pattern = re.compile(LINUX_TRACE_PATTERN)
+	ip_pattern = re.compile(IP_PATTERN)
+
+	route_data = []
+
+	lines = results.splitlines()
+
+	destination_ip = re.match(LINUX_TRACE_DEST_IP, lines[0])
+	destination_ip = destination_ip.group(2)
+
+	for line in lines[1:]:
+		match = hop_pattern.match(line)
+		if match:
+			hop, rest = match.groups()
+
+			# The first address is the one we go with if a hop answered from several interfaces.
+			tokens = rest.split()
+			ips = [t for t in tokens if ip_pattern.match(t)]
+			if len(ips) == 0:
+				continue
+
+			_time = " ".join(t for t in tokens if not ip_pattern.match(t))
+
+			h: Hop = {"timestr": _time, "ip": ips[0]}
+			route_data.append(h)
+
+	return route_data, destination_ip
+
+def parse_mtr_output(results: str) -> (list[Hop], str):
+	report = json.loads(results)["report"]
+
+	route_data = []
+	for hub in report["hubs"]:
+		if hub["host"] == "???" or hub["Loss%"] >= 100:
+			continue
+
+		h: Hop = {"timestr": f"{hub['Avg']} ms", "ip": hub["host"]}
+		route_data.append(h)
+
+	return route_data, report["mtr"]["dst"]
+
+def _win32_probes(results: str) -> list[tuple[int, int]]:
+	hop_pattern = re.compile(WIN32_TRACE_PATTERN)
+	probes = []
+	for line in results.splitlines():
+		match = hop_pattern.match(line.strip())
+		if match:
+			_time = match.group(2)
+			lost = _time.count("*")
+			probes.append((_time.count("ms"), _time.count("ms") + lost))
+
+	return probes
+
+def _traceroute_probes(results: str) -> list[tuple[int, int]]:
+	hop_pattern = re.compile(LINUX_TRACE_PATTERN)
+	probes = []
+	for line in results.splitlines()[1:]:
+		match = hop_pattern.match(line)
+		if match:
+			tokens = match.group(2).split()
+			answered = tokens.count("ms")
+			probes.append((answered, answered + tokens.count("*")))
+
+	return probes
+
+def _mtr_probes(results: str) -> list[tuple[int, int]]:
+	probes = []
+	for hub in json.loads(results)["report"]["hubs"]:
+		sent = hub.get("Snt", 1)
+		probes.append((round(sent * (100 - hub["Loss%"]) / 100), sent))
+
+	return probes
+
+TRACE_BACKENDS: dict[str, TraceBackend] = {
+	"win32": TraceBackend("win32", WIN32_TRACE, parse_output, _win32_probes),
+	"traceroute": TraceBackend("traceroute", LINUX_TRACE, parse_traceroute_output, _traceroute_probes),
+	"mtr": TraceBackend("mtr", MTR_TRACE, parse_mtr_output, _mtr_probes),
+}
+
+def probe_loss(probes: list[tuple[int, int]]) -> float:
+	"""
+	Fraction of probes lost at hops that answered at least one of them. Hops that never answer
+	are usually routers that just don't send Time Exceeded, so they're left out.
+	"""
+	answered = sum(a for a, sent in probes if a > 0)
+	sent = sum(sent for a, sent in probes if a > 0)
+	if sent == 0:
+		return 0.0
+
+	return 1 - answered / sent
+
+def make_result(output: list[Hop], dest_ip: str) -> TracerouteResult:
+	completed = len(output) > 0 and output[len(output)-1]["ip"] == dest_ip
+
+	r: TracerouteResult = {"output": output, "destination_ip": dest_ip, "completed": completed}
+	return r
+
+def traceroute(addresses: list[str] | str, backend: str = None, targets: list[str] = None) -> list[TracerouteResult]:
+	"""
+	:param targets: What each address was traced for (e.g. the name it was resolved from), kept
+		in the archive. Defaults to the addresses.
+	"""
 	# res, unanswered = traceroute(ipaddr, maxttl=32)
 
 	if type(addresses) == str:
 		addresses = [addresses]
+	targets = targets or addresses
+
+	backend = TRACE_BACKENDS[backend or TRACE_BACKEND]
 
 	results = []
-	for addr in addresses:
-		cmd = " ".join(WIN32_TRACE + [addr])
+	for addr, target in zip(addresses, targets):
+		cmd = " ".join(backend.command + [addr])
 		logger.info(f"Performing traceroute for \"{addr}\" via [{cmd}]")
+		started = time.time()
 		trace = os.popen(cmd).read()
+		if ARCHIVE:
+			ARCHIVE.append(target, backend.name, started, time.time() - started, trace)
+
+		output, dest_ip = backend.parse(trace)
+		results.append(make_result(output, dest_ip))
+
+	return results
+
+async def _async_trace(addr: str, backend: TraceBackend, limiter: AdaptiveLimiter, target: str = None) -> TracerouteResult:
+	await limiter.acquire()
+	loss = None
+	try:
+		logger.debug(f"Performing traceroute for \"{addr}\" via [{' '.join(backend.command + [addr])}]")
+		started = time.time()
+		with metrics.TRACE_DURATION.time():
+			process = await asyncio.create_subprocess_exec(
+				*backend.command, addr,
+				stdout=asyncio.subprocess.PIPE,
+				stderr=asyncio.subprocess.DEVNULL
+			)
+			stdout, _ = await process.communicate()
+		trace = str(stdout, "utf-8", errors="replace")
+		if ARCHIVE:
+			ARCHIVE.append(target or addr, backend.name, started, time.time() - started, trace)
+
+		output, dest_ip = backend.parse(trace)
+		loss = probe_loss(backend.probes(trace))
+
+		return make_result(output, dest_ip)
+	finally:
+		await limiter.release(loss)
+
+async def _async_traceroute(addresses: list[str], backend: TraceBackend, concurrency: int, on_result: typing.Callable[[int, TracerouteResult], None], targets: list[str]):
+	limiter = AdaptiveLimiter(concurrency, TRACE_MIN_CONCURRENCY)
+
+	async def run(index: int, addr: str):
+		on_result(index, await _async_trace(addr, backend, limiter, targets[index]))
+
+	await asyncio.gather(*[run(index, addr) for index, addr in enumerate(addresses)])
+
+def iter_async_traceroute(addresses: list[str] | str, concurrency: int = None, backend: str = None, targets: list[str] = None) -> typing.Iterator[tuple[int, TracerouteResult]]:
+	"""
+	Runs every traceroute as a subprocess from this one process, with up to `concurrency` of them
+	at once. Tracing is all waiting on the network, so this goes far past mp.cpu_count().
+
+	The event loop runs on its own thread so results can be handed out as they finish.
+
+	:param addresses:
+	:param concurrency: Starting (and maximum) number of traces at once, defaults to TRACE_CONCURRENCY.
+	:param backend: One of TRACE_BACKENDS, defaults to TRACE_BACKEND.
+	:param targets: Same as traceroute.
+	:return: (index into addresses, result) pairs in the order the traces finish.
+	"""
+	if type(addresses) == str:
+		addresses = [addresses]
+	targets = targets or addresses
+
+	concurrency = min(len(addresses), concurrency or TRACE_CONCURRENCY)
+	backend = TRACE_BACKENDS[backend or TRACE_BACKEND]
+
+	logger.info(f"async_traceroute running at concurrency={concurrency} via {backend.command[0]}")
+
+	results = queue.Queue()
+	def run_loop():
+		try:
+			asyncio.run(_async_traceroute(addresses, backend, concurrency, lambda index, r: results.put((index, r)), targets))
+		except BaseException as err:
+			results.put(err)
+		results.put(None)
+
+	thread = threading.Thread(target=run_loop, daemon=True)
+	thread.start()
+
+	while True:
+		item = results.get()
+		if item is None:
+			break
+		elif isinstance(item, BaseException):
+			raise item
+
+		yield item
 
-		output, dest_ip = parse_output(trace)
-		completed = output[len(output)-1]["ip"] == dest_ip
+	thread.join()
+	logger.info("Async traceroute finished")
+
+def async_traceroute(addresses: list[str] | str, concurrency: int = None, backend: str = None, progress_data=None) -> list[TracerouteResult]:
+	"""
+	Same as iter_async_traceroute, but waits for everything.
 
-		r: TracerouteResult = {"output": output, "destination_ip": dest_ip, "completed": completed}
+	:param progress_data: Same as mp_traceroute.
+	:return: Results in the same order as addresses.
+	"""
+	if type(addresses) == str:
+		addresses = [addresses]
 
-		results.append(r)
+	results = [None] * len(addresses)
+	for done, (index, r) in enumerate(iter_async_traceroute(addresses, concurrency, backend)):
+		results[index] = r
+		update_progress(progress_data, done + 1)
 
 	return results
 
-def mp_traceroute(addresses: list[str] | str, max_processes: int = None, progress_data = None) -> list[TracerouteResult]:
+def update_progress(progress_data, traceroutes_complete: int):
+	if progress_data:
+		# See https://docs.python.org/3/library/multiprocessing.html#proxy-objects
+		# on how to update the shared data.
+		# TLDR: It seems that modifications aren't detected until you force
+		# notification of a change.
+		d = progress_data[0]
+		d["traceroutes_complete"] = traceroutes_complete
+		progress_data[0] = d
+
+def _init_trace_worker(trace_archive: archive.TraceArchive):
+	"""
+	Pool initializer. Workers started with spawn (the only start method on Windows) import this
+	module afresh, so what main() set up for the run has to be handed to them.
+	"""
+	global ARCHIVE
+	ARCHIVE = trace_archive
+
+def _indexed_traceroute(args: tuple[int, str, str, str]) -> tuple[int, tracestore.PackedTrace, float]:
+	index, addr, backend, target = args
+	# Metrics recorded in a worker never reach the parent, so the parent records the duration.
+	start = time.monotonic()
+	packed = tracestore.pack(traceroute(addr, backend, [target])[0])
+	return index, packed, time.monotonic() - start
+
+def iter_mp_traceroute(addresses: list[str] | str, max_processes: int = None, targets: list[str] = None) -> typing.Iterator[tuple[int, tracestore.PackedTrace]]:
+	"""
+	Runs the traceroutes over a process pool. Workers send their results back packed, see
+	tracestore.PackedTrace.unpack for the TracerouteResult.
+
+	:param targets: Same as traceroute.
+	:return: (index into addresses, packed result) pairs in the order the traces finish.
+	"""
+	if type(addresses) == str:
+		addresses = [addresses]
+	targets = targets or addresses
+
 	process_count = min(len(addresses), mp.cpu_count())
 	if max_processes:
 		process_count = min(process_count, max_processes)
@@ -348,180 +946,345 @@ def mp_traceroute(addresses: list[str] | str, max_processes: int = None, progres
 
 	signal.signal(signal.SIGINT, sigint_handler)
 
-	def error_callback(e):
-		logger.error("callback error")
-		traceback.print_exception(type(e), e, e.__traceback__)
-		pool.terminate()
-		logger.error("Worker pool has consequently been terminated, exiting.")
-		# exit(1)
-
-	successful_run = False
-	with mp.Pool(processes=process_count) as pool:
-		# See comments in RPKI project for reasoning on why this is done like this
-		results = [pool.apply_async(traceroute, args=(addr,), error_callback=error_callback) for addr in addresses]
-		last_ready = 0
-		while True:
-			time.sleep(1)
-			try:
-				# These need to be done here to get the exception.
-				ready = [r.ready() for r in results]
-				last_ready = ready.count(True)
-				if progress_data:
-					# See https://docs.python.org/3/library/multiprocessing.html#proxy-objects
-					# on how to update the shared data.
-					# TLDR: It seems that modifications aren't detected until you force
-					# notification of a change.
-					d = progress_data[0]
-					d["traceroutes_complete"] = last_ready
-					progress_data[0] = d
-
-				successful = [r.successful() for r in results]
-			except Exception as err:
-				if pool._state == "TERMINATE":
-					break
-				continue
+	with mp.Pool(processes=process_count, initializer=_init_trace_worker, initargs=(ARCHIVE,)) as pool:
+		tasks = [(index, addr, TRACE_BACKEND, target) for index, (addr, target) in enumerate(zip(addresses, targets))]
+		try:
+			# Results come back as each worker finishes, a worker's exception is raised here.
+			for index, packed, duration in pool.imap_unordered(_indexed_traceroute, tasks):
+				metrics.TRACE_DURATION.observe(duration)
+				yield index, packed
+		except Exception as e:
+			logger.error("callback error")
+			traceback.print_exception(type(e), e, e.__traceback__)
+			pool.terminate()
+			logger.error("Worker pool has consequently been terminated, exiting.")
+			exit(1)
 
-			if all(successful):
-				# Everything completed successfully.
-				successful_run = True
-				break
-			elif all(ready):
-				# Not everything completed successfully, but everything is ready now.
-				raise Exception("MP Traceroute failed")
-
-	if successful_run:
-		# Everything processed successfully.
-		logger.info("MP Traceroute finished")
-		return [r.get()[0] for r in results]
-	else:
-		logger.error("Error in pool processing")
-		exit(1)
+	logger.info("MP Traceroute finished")
+
+def mp_traceroute(addresses: list[str] | str, max_processes: int = None, progress_data = None) -> list[TracerouteResult]:
+	if type(addresses) == str:
+		addresses = [addresses]
+
+	results = [None] * len(addresses)
+	for done, (index, packed) in enumerate(iter_mp_traceroute(addresses, max_processes)):
+		results[index] = packed.unpack()
+		update_progress(progress_data, done + 1)
+
+	return results
+
+def iter_traceroute(addresses: list[str], backend: str = None, targets: list[str] = None) -> typing.Iterator[tuple[int, TracerouteResult]]:
+	targets = targets or addresses
+	for index, (addr, target) in enumerate(zip(addresses, targets)):
+		with metrics.TRACE_DURATION.time():
+			result = traceroute(addr, backend, [target])[0]
+
+		yield index, result
+
+def enrich(hop_ips: typing.Iterable[str], as_mappings: dict[str, ASMapping], rpki_table: dict[tuple[str, str], dict], run_journal: journal.Journal = None):
+	"""
+	Maps the hop IPs that aren't in as_mappings yet, then resolves the RPKI status of any new
+	(asn, prefix) pairs. Both tables are updated in place, and the new entries are recorded in
+	run_journal if there is one.
+	"""
+	new_ips = [ip for ip in hop_ips if ip not in as_mappings]
+	if len(new_ips) == 0:
+		return
+
+	logger.info(f"Mapping hops ({len(new_ips)}) to ASes")
+	with metrics.ENRICH_DURATION.time():
+		# Perform bulk query
+		mappings = mapToASes(new_ips)
+		as_mappings.update(mappings)
+		if run_journal:
+			run_journal.record_as_mappings(mappings)
+
+		pairs = {(as_data["asn"], as_data["prefix"]) for as_data in mappings.values()}
+		new_pairs = [pair for pair in pairs if pair not in rpki_table]
+		if len(new_pairs) > 0:
+			resolved = resolve_rpki_data(new_pairs)
+			rpki_table.update(resolved)
+			if run_journal:
+				run_journal.record_rpki(resolved)
+
+def main(ip_list: list[str], outfolder: str = None, multiprocessing: bool | int = True, progress_data = None, async_concurrency: int = None, use_probe_engine: bool = False, resume: bool = False, dataset_root: str = None, state: str = None, latex_tables: bool = True, confirm_paths: bool = False) -> pd.DataFrame:
+	"""
+	Traces every target, maps the hops to ASes and validates them with RPKI.
 
+	Output goes to outfolder as a .csv and .tex per target plus rpki_summary.csv. If dataset_root
+	is given, the per-target files are skipped and the hop and summary tables are appended to the
+	Parquet datasets there instead, partitioned by state and run (see dataset.py).
 
-def main(ip_list: list[str], outfolder: str = None, multiprocessing: bool | int = True, progress_data = None) -> list[list]:
+	With GEO_TABLE set, every hop also gets the country, region and city it's in (looked up once
+	per distinct address, all in one pass), in the hop table and the per-target .csv files.
+
+	LaTeX tables can be left out with latex_tables=False and rendered later from the stored data
+	with report.py.
+
+	With ARCHIVE set, the raw output of every traceroute is kept there so the run can be parsed
+	and analysed again with reanalyze.py. The probe engine has no raw output to keep.
+
+	Targets whose path hasn't changed since it was stored in PATH_CACHE reuse that path's AS and
+	RPKI data. Only those targets do, the rest of the run is mapped and validated afresh. With confirm_paths, known paths are first checked with one raw probe per hop (see
+	probe.py) and only the targets whose path changed get a full traceroute.
+
+	:return: The hop table for the run, with dataset.HOP_COLUMNS.
+	"""
 	trace_start = time.time()
-	if multiprocessing:
+	# Every call is a run of its own, even when one process traces several states.
+	run_id = datetime.datetime.fromtimestamp(trace_start).strftime("%Y%m%dT%H%M%S")
+
+	# Hops are kept in flat arrays rather than a dict per hop, see tracestore.py.
+	traces = tracestore.TraceStore(len(ip_list))
+	all_as_mappings = {}
+	rpki_table = {}
+
+	# Everything gets journaled as it's produced, so a run that dies part way can be resumed.
+	run_journal = None
+	if outfolder:
+		run_journal = journal.Journal(journal.journal_path(outfolder), resume=resume, run_id=run_id)
+		run_id = run_journal.run_id
+		all_as_mappings.update(run_journal.as_mappings)
+		rpki_table.update(run_journal.rpki_table)
+
+		# A run that died between journaling a batch's AS mappings and its RPKI data left pairs
+		# without a status. Their hops are mapped already so enrich won't get to them, do it here.
+		missing_pairs = {(as_data["asn"], as_data["prefix"]) for as_data in all_as_mappings.values()} - rpki_table.keys()
+		if len(missing_pairs) > 0:
+			logger.info(f"Resolving RPKI data for {len(missing_pairs)} journaled pair(s)")
+			resolved = resolve_rpki_data(list(missing_pairs))
+			rpki_table.update(resolved)
+			run_journal.record_rpki(resolved)
+
+		for index, target_ip in enumerate(ip_list):
+			if target_ip in run_journal.traces:
+				traces.add(index, run_journal.traces[target_ip])
+
+	if ARCHIVE:
+		ARCHIVE.close()
+		ARCHIVE.run_id = run_id
+		ARCHIVE.state = state
+
+	# Paths from an earlier run, target -> (fingerprint, hops). A trace that comes back with the
+	# same fingerprint doesn't need its hops mapped or validated again.
+	known_paths = {}
+	if PATH_CACHE:
+		known_paths = PATH_CACHE.get_many(ip_list)
+	# index -> the known path's [ip, asn, prefix, status] hops. These are kept to the trace they
+	# came from, so a stale status can't leak into other paths through the run's tables.
+	reused = {}
+
+	def check_known_path(index: int):
+		known = known_paths.get(ip_list[index])
+		if known and known[0] == traces.fingerprint(index):
+			reused[index] = known[1]
+
+		if PATH_CACHE:
+			metrics.CACHE_LOOKUPS.inc(cache="path", result=(index in reused and "hit") or "miss")
+
+	for index in range(len(ip_list)):
+		if index in traces:
+			check_known_path(index)
+
+	remaining = [index for index in range(len(ip_list)) if index not in traces]
+	if len(remaining) < len(ip_list):
+		logger.info(f"Resuming run, {len(ip_list) - len(remaining)} of {len(ip_list)} trace(s) already done")
+
+	# What each target gets traced as. Names are resolved here in one concurrent pass instead of
+	# serially inside each traceroute.
+	addresses = {ip_list[index]: ip_list[index] for index in remaining}
+	if RESOLVE_TARGETS:
+		addresses = resolver.resolve(addresses.keys(), dns_cache=DNS_CACHE)
+
+		# Names that don't resolve get an empty, unsuccessful trace.
+		for index in remaining:
+			if addresses[ip_list[index]] is None:
+				traces.add(index, make_result([], ""))
+		remaining = [index for index in remaining if index not in traces]
+
+	if confirm_paths:
+		confirm = [index for index in remaining if ip_list[index] in known_paths]
+		if len(confirm) > 0:
+			logger.info(f"Confirming {len(confirm)} known path(s) with the probe engine")
+			# Hops filled in by Doubletree would confirm themselves, so every hop gets probed here.
+			for index, result in zip(confirm, probe.probe_traceroute([addresses[ip_list[index]] for index in confirm], doubletree=False)):
+				packed = tracestore.pack(result)
+				if packed.fingerprint() != known_paths[ip_list[index]][0]:
+					continue
+
+				traces.add(index, packed)
+				if run_journal:
+					run_journal.record_trace(ip_list[index], traces.result(index))
+				check_known_path(index)
+
+			remaining = [index for index in remaining if index not in traces]
+			confirmed = len([index for index in confirm if index in traces])
+			logger.info(f"{confirmed} of {len(confirm)} known path(s) confirmed, {len(remaining)} target(s) left to trace")
+
+	to_trace = [addresses[ip_list[index]] for index in remaining]
+	# The archive keeps what was asked for, not what it resolved to.
+	trace_targets = [ip_list[index] for index in remaining]
+
+	if len(to_trace) == 0:
+		trace_iter = iter([])
+	elif use_probe_engine:
+		logger.info("Using the in-process probe engine for traceroutes.")
+		# Probes for every target are in flight together, so there's nothing to stream.
+		trace_iter = enumerate(probe.probe_traceroute(to_trace))
+	elif async_concurrency:
+		logger.info("Using asyncio for traceroutes.")
+		trace_iter = iter_async_traceroute(to_trace, concurrency=async_concurrency, targets=trace_targets)
+	elif multiprocessing:
 		if type(multiprocessing) == bool:
 			# Set to nothing so it doesn't affect max processes. In other words, assume no maximum.
 			multiprocessing = None
 
 		logger.info("Using multiprocessing for traceroutes.")
-		traces = mp_traceroute(ip_list, max_processes=multiprocessing, progress_data=progress_data)
+		trace_iter = iter_mp_traceroute(to_trace, max_processes=multiprocessing, targets=trace_targets)
 	else:
 		logger.info("Multiprocessing disabled, using single process.")
-		traces = traceroute(ip_list)
-
-	trace_end = time.time()
-
-	logger.info(f"Finished tracing IPs, time elapsed: {datetime.timedelta(seconds=trace_end-trace_start)}")
+		trace_iter = iter_traceroute(to_trace, targets=trace_targets)
+
+	# Hops get mapped to ASes and RPKI validated in batches on a background thread while the
+	# remaining traces are still running. Only one batch runs at a time, completed traces pile up
+	# in the meantime so each whois session gets as many IPs as possible.
+	# Traces from the journal go in the first batch in case the run died before enriching them.
+	batch = [index for index in range(len(ip_list)) if index in traces and index not in reused]
+	last_batch = time.time()
+	done = len(batch)
+	metrics.TRACES_PENDING.set(len(to_trace))
+	metrics.ENRICH_QUEUE.set(len(batch))
+	with ThreadPoolExecutor(max_workers=1) as executor:
+		enriching = None
+		for remaining_index, trace_data in trace_iter:
+			index = remaining[remaining_index]
+			traces.add(index, trace_data)
+			if run_journal:
+				run_journal.record_trace(ip_list[index], traces.result(index))
+
+			start, end = traces.hop_range(index)
+			metrics.TRACE_HOPS.observe(end - start)
+			metrics.TRACES.inc(completed=str(bool(traces.completed[index])).lower())
+			metrics.TRACES_PENDING.dec()
+
+			check_known_path(index)
+			if index not in reused:
+				batch.append(index)
+			done += 1
+			update_progress(progress_data, done)
+
+			idle = enriching is None or enriching.done()
+			if idle and (len(batch) >= ENRICH_BATCH_SIZE or time.time() - last_batch >= ENRICH_INTERVAL):
+				if enriching:
+					enriching.result()
+
+				# The hop IPs are pulled out here, the store isn't safe to read while it's being added to.
+				enriching = executor.submit(enrich, traces.hop_ips(batch), all_as_mappings, rpki_table, run_journal)
+				batch = []
+				last_batch = time.time()
+
+			metrics.ENRICH_QUEUE.set(len(batch))
+
+		trace_end = time.time()
+		metrics.STAGE_DURATION.set(trace_end - trace_start, stage="trace")
+		logger.info(f"Finished tracing IPs, time elapsed: {datetime.timedelta(seconds=trace_end-trace_start)}")
+
+		if enriching:
+			enriching.result()
+		enrich(traces.hop_ips(batch), all_as_mappings, rpki_table, run_journal)
+		metrics.ENRICH_QUEUE.set(0)
+
+	enrich_end = time.time()
+	# Only the enrichment left over once tracing is done, the rest overlaps with the trace stage.
+	metrics.STAGE_DURATION.set(enrich_end - trace_end, stage="enrich")
+
+	if len(reused) > 0:
+		logger.info(f"Reused the known path of {len(reused)} of {len(ip_list)} trace(s)")
+
+	logger.info(f"Finished enriching hops, time elapsed: {datetime.timedelta(seconds=time.time()-trace_start)}")
 
 	if outfolder and not os.path.exists(outfolder):
 		os.makedirs(outfolder, exist_ok=True)
 
-	summary = None
-	if outfolder:
-		summary = pd.DataFrame(columns=["destination", "destination_ip", "num_unique_prefixes", "num_valid", "num_invalid", "num_notfound", "hops", "completed"], dtype=str)
+	logger.info("Beginning calculations")
+	# Every hop of every trace in one table, built straight from the store's arrays.
+	traces.annotate(all_as_mappings, rpki_table, GEO_TABLE, known_hops=reused)
+	hops_df = traces.hop_table(ip_list)
+	traces_df = traces.trace_table(ip_list)
+
+	# Hops are in trace order, so each trace's rows are one contiguous slice.
+	bounds = np.searchsorted(hops_df["trace"].to_numpy(), np.arange(len(ip_list) + 1))
+
+	calculate_end = time.time()
+	metrics.STAGE_DURATION.set(calculate_end - enrich_end, stage="calculate")
+
+	if PATH_CACHE:
+		# Reused paths keep their old entry, so they still expire and get looked up again. Paths
+		# with a failed RPKI lookup aren't stored, like RPKICache doesn't store the failure.
+		paths = {}
+		for index in range(len(ip_list)):
+			if index in reused or index not in traces:
+				continue
 
-	# Collect every hop IP we've worked with for a bulk query
-	logger.debug("Combining hop list")
-	all_hop_ips = []
-	for index, trace_data in enumerate(traces):
-		hop_list = trace_data["output"]
-		all_hop_ips += list(map(lambda x: x["ip"], hop_list))
+			hops = traces.path(index)
+			if any(status == "-" and prefix != "NA" for _, _, prefix, status in hops):
+				continue
 
-	# Remove duplicates
-	all_hop_ips = list(set(all_hop_ips))
+			paths[ip_list[index]] = (traces.fingerprint(index), hops)
+		PATH_CACHE.set_many(paths)
 
-	logger.info(f"Mapping hops ({len(all_hop_ips)}) to ASes")
-	# Perform bulk query
-	all_as_mappings = mapToASes(all_hop_ips)
+	if outfolder and not dataset_root:
+		data_columns = dataset.HOP_DATA_COLUMNS + ((GEO_TABLE is not None and dataset.GEO_COLUMNS) or [])
+		rows = hops_df[data_columns].values.tolist()
 
-	logger.info("Beginning calculations")
-	all_raw_data = []
-	for index, trace_data in enumerate(traces):
-		hop_list = trace_data["output"]
-		target_ip = ip_list[index]
-
-		unique_prefixes = []
-		num_valid = 0
-		num_invalid = 0
-		num_notfound = 0
-
-		raw_data = []
-		for hop_number, hop in enumerate(hop_list):
-			# logger.debug(hop["ip"], hop_number, hop)
-			ip = hop["ip"]
-			as_data = all_as_mappings[ip]
-			# logger.debug(f"\tGetting RPKI Data for {as_data['asn']}, {as_data['prefix']}")
-			rpki_data = get_rpki_data(as_data["asn"], as_data["prefix"])
-
-			unique = True
-			if (as_data["prefix"] is None or as_data["prefix"] == "NA") or (as_data["prefix"] in unique_prefixes):
-				unique = False
-			else:
-				unique_prefixes.append(as_data["prefix"])
-
-
-			asn = as_data["asn"] or "-"
-			prefix = as_data["prefix"] or "-"
-			status = "-"
-
-			if "status" in rpki_data:
-				status = rpki_data["status"]
-
-				if unique:
-					if status == "valid":
-						num_valid += 1
-					elif status.find("invalid") != -1:
-						logger.warning(f"Invalid Type: {status}")
-						num_invalid += 1
-					elif status == "unknown":
-						num_notfound += 1
-					else:
-						logger.debug(ip)
-						logger.debug(asn)
-						logger.debug(status)
-						logger.debug('=' * 50)
-						logger.debug(hop)
-						logger.debug(as_data)
-						logger.debug(rpki_data)
-						raise Exception("unknown status")
-
-			# df.concat({"hop": key, "ip": ip, "prefix": prefix, "asn": asn, "status": status})
-			raw_data.append([hop_number + 1, ip, prefix, asn, status.capitalize()])
-
-		if outfolder:
-			df = pd.DataFrame(data=raw_data, columns=["hop", "ip", "prefix", "asn", "status"], dtype=str)
+		for index, target_ip in enumerate(ip_list):
+			raw_data = rows[bounds[index]:bounds[index + 1]]
+			destination_ip = traces.destination_ip(index)
+			completed = bool(traces.completed[index])
+
+			df = pd.DataFrame(data=raw_data, columns=data_columns, dtype=str)
 			data_path = os.path.join(outfolder, "data")
 			if not os.path.exists(data_path):
 				os.mkdir(data_path)
 			df.to_csv(os.path.join(data_path, f"{target_ip}.csv"), index=False)
-
-			# ({trace_data['completed'] and 'Successful' or 'Unsuccessful'})
-			target_str = (target_ip == trace_data["destination_ip"] and target_ip) or f"{target_ip} ({trace_data['destination_ip']})"
-			caption = f"The results from a traceroute to {target_str}."
-			label = f"tab:table-{target_str}"
-			raw_data.append("Traceroute was " + (trace_data["completed"] and "successful" or "unsuccessful"))
-			tex = create_latex_table(["Hop", "IP", "Prefix", "AS", "RPKI Status"], raw_data, caption, label)
+			metrics.ROWS_WRITTEN.inc(len(df), table="data")
+
+			if latex_tables:
+				# ({completed and 'Successful' or 'Unsuccessful'})
+				target_str = (target_ip == destination_ip and target_ip) or f"{target_ip} ({destination_ip})"
+				caption = f"The results from a traceroute to {target_str}."
+				label = f"tab:table-{target_str}"
+				raw_data = [row[:len(dataset.HOP_DATA_COLUMNS)] for row in raw_data]
+				raw_data.append("Traceroute was " + (completed and "successful" or "unsuccessful"))
+				tex = create_latex_table(["Hop", "IP", "Prefix", "AS", "RPKI Status"], raw_data, caption, label)
 			
-			table_path = os.path.join(outfolder, "latex_tables")
-			if not os.path.exists(table_path):
-				os.mkdir(table_path)
-
-			with open(os.path.join(table_path, f"{target_ip}.tex"), "w") as f:
-				f.write(tex)
+				table_path = os.path.join(outfolder, "latex_tables")
+				if not os.path.exists(table_path):
+					os.mkdir(table_path)
 
-			# summary.append([target_ip, len(unique_prefixes), num_valid, num_invalid, num_notfound])
-			summary.loc[len(summary), summary.columns] = target_ip, trace_data['destination_ip'], len(unique_prefixes), num_valid, num_invalid, num_notfound, len(hop_list), trace_data["completed"]
-			# summary.loc[len(summary), summary.columns] = None, None, None, None, None
+				with open(os.path.join(table_path, f"{target_ip}.tex"), "w") as f:
+					f.write(tex)
 
-		all_raw_data.append(raw_data)
+	summary = dataset.summarize_hops(traces_df, hops_df)
 
 	if outfolder:
 		summary.to_csv(os.path.join(outfolder, f"rpki_summary.csv"), index=False)
+		metrics.ROWS_WRITTEN.inc(len(summary), table="rpki_summary")
 
+	if dataset_root:
+		# The stored summary keeps the trace index so it can be joined back to its hops.
+		dataset.write_run(dataset_root, hops_df, summary.assign(trace=traces_df["trace"].to_numpy()), state, run_id)
+
+	if run_journal:
+		run_journal.complete()
+		run_journal.close()
+
+	if ARCHIVE:
+		ARCHIVE.close()
+
+	metrics.STAGE_DURATION.set(time.time() - calculate_end, stage="write")
 	logger.info(f"Finished tracing and validating list of {len(ip_list)} ip(s).")
-	return all_raw_data
+	return hops_df
 
 
 # https://superuser.com/questions/355486/what-is-the-range-of-ports-that-is-usually-used-in-the-traceroute-command
@@ -540,10 +1303,44 @@ parser = HelpParser(
 )
 
 parser.add_argument("outfolder", type=str, help="A folder to put output data in.")
-parser.add_argument("--infile", type=str, help="A path to a list of IPs.")
+parser.add_argument("--infile", type=str, help="A path to a list of IPs or names (.txt), or of URLs (.csv), optionally gzipped.")
 parser.add_argument("--column", type=str, help="The column to get URLs from if a .csv is provided as an infile.")
 parser.add_argument("--ip", action="append", type=str, help="Used to specify an IP to process, with or without an infile.")
 parser.add_argument("--nomultiprocessing", action="store_true", help="Forces the program to do the traceroutes individually instead of using multiple processes.")
+parser.add_argument("--backend", type=str, choices=list(TRACE_BACKENDS.keys()), default=TRACE_BACKEND, help="The traceroute program to run and parse the output of.")
+parser.add_argument("--async", dest="async_concurrency", nargs="?", type=int, const=TRACE_CONCURRENCY, help="Run traceroutes as asyncio subprocesses from one process, optionally with a maximum concurrency.")
+parser.add_argument("--probe", action="store_true", help="Trace from this process with raw ICMP sockets instead of running a traceroute program (Linux, needs root).")
+parser.add_argument("--doubletree", action="store_true", help="With --probe, skip hops that earlier traces already found (Doubletree) instead of probing every hop of every target.")
+parser.add_argument("--proberate", type=float, default=probe.PROBE_RATE, help="Maximum number of probes per second for --probe.")
+parser.add_argument("--confirm", action="store_true", help="Check targets with a known path using the probe engine first, and only fully trace the ones whose path changed (Linux, needs root).")
+parser.add_argument("--resume", action="store_true", help="Pick up an interrupted run from the journal in the outfolder instead of starting over.")
+parser.add_argument("--dataset", type=str, help="Append hop and summary tables to the Parquet datasets in this folder instead of writing a .csv and .tex per target.")
+parser.add_argument("--archive", type=str, help="Keep the raw output of every traceroute in this folder, so it can be analysed again with reanalyze.py.")
+parser.add_argument("--nolatex", action="store_true", help="Don't write a LaTeX table per target, they can be rendered later with report.py.")
+parser.add_argument("--state", type=str, help="The state partition to use with --dataset.")
+parser.add_argument("--rpkicache", type=str, default=cache.RPKI_CACHE_PATH, help="Path to the on-disk cache of RPKI validation results.")
+parser.add_argument("--rpkicachettl", type=float, default=cache.RPKI_CACHE_TTL, help="Seconds before a cached RPKI validation result is fetched again.")
+parser.add_argument("--rpkicachesize", type=int, default=cache.RPKI_CACHE_MAX_ENTRIES, help="Maximum number of cached RPKI validation results to keep.")
+parser.add_argument("--rpkiconcurrency", type=int, default=RPKI_CONCURRENCY, help="Maximum number of RPKI validation requests in flight at once.")
+parser.add_argument("--rpkiratelimit", type=float, default=RPKI_RATE_LIMIT, help="Maximum number of RPKI validation requests per second.")
+parser.add_argument("--vrpfile", type=str, help="Validate against a local VRP export (routinator/rpki-client .json or .csv) instead of RIPE.")
+parser.add_argument("--pfx2as", type=str, help="Map IPs to ASes from a local CAIDA pfx2as file or bgpdump -m RIB dump instead of Cymru.")
+parser.add_argument("--geodb", type=str, help="Geolocate every hop (country, region, city) from a local IP2LOCATION LITE DB3 CSV.")
+parser.add_argument("--ascache", type=str, default=cache.AS_CACHE_PATH, help="Path to the on-disk cache of IP to AS mappings.")
+parser.add_argument("--ascachettl", type=float, default=cache.AS_CACHE_TTL, help="Seconds before a cached BGP prefix is looked up again.")
+parser.add_argument("--noascache", action="store_true", help="Always query Cymru instead of using the IP to AS cache.")
+parser.add_argument("--pathcache", type=str, default=cache.PATH_CACHE_PATH, help="Path to the on-disk store of each target's last path.")
+parser.add_argument("--pathcachettl", type=float, default=cache.PATH_CACHE_TTL, help="Seconds before an unchanged path's hops are mapped and validated again.")
+parser.add_argument("--nopathcache", action="store_true", help="Map and validate every hop, even on paths that haven't changed.")
+parser.add_argument("--noresolve", action="store_true", help="Pass target names straight to the traceroute program instead of resolving them first.")
+parser.add_argument("--dnsconcurrency", type=int, default=resolver.DNS_CONCURRENCY, help="Maximum number of DNS lookups in flight at once.")
+parser.add_argument("--dnscache", type=str, default=cache.DNS_CACHE_PATH, help="Path to the on-disk cache of resolved target names.")
+parser.add_argument("--dnscachettl", type=float, default=cache.DNS_CACHE_TTL, help="Seconds before a resolved name is looked up again.")
+parser.add_argument("--nodnscache", action="store_true", help="Always resolve target names instead of using the DNS cache.")
+parser.add_argument("--norpkicache", action="store_true", help="Always query RIPE instead of using the RPKI validation cache.")
+parser.add_argument("--metricsfile", type=str, help="Write stage metrics in the OpenMetrics text format to this file as the run goes, e.g. for node_exporter's textfile collector.")
+parser.add_argument("--metricsport", type=int, help="Serve stage metrics in the OpenMetrics text format on this local port for Prometheus to scrape.")
+parser.add_argument("--metricsinterval", type=float, default=metrics.METRICS_INTERVAL, help="Seconds between writes of --metricsfile.")
 #parser.add_argument("--as", action="store_true", help="Map an IP address to an AS")
 
 if __name__ == "__main__":
@@ -552,20 +1349,25 @@ if __name__ == "__main__":
 	if sys.platform == "win32":
 		# Windows
 		pass
-	elif sys.platform == "darwin":
-		# OS X
-		logger.error(f"Not supported for platform: {sys.platform}")
-		exit(1)
-
-	elif sys.platform == "linux" or sys.platform == "linux":
-		# Linux
-		logger.error(f"Not supported for platform: {sys.platform}")
-		exit(1)
+	elif sys.platform == "darwin" or sys.platform == "linux":
+		# OS X / Linux
+		if args.backend == "win32":
+			logger.error(f"The win32 backend isn't supported for platform: {sys.platform}")
+			exit(1)
 
 	else:
 		logger.error(f"Unknown platform: {sys.platform}")
 		exit(1)
 
+	TRACE_BACKEND = args.backend
+
+	if (args.probe or args.confirm) and sys.platform != "linux":
+		logger.error(f"The probe engine isn't supported for platform: {sys.platform}")
+		exit(1)
+
+	probe.PROBE_RATE = args.proberate
+	probe.PROBE_DOUBLETREE = args.doubletree
+
 	vargs = vars(args)
 	logger.debug("Launched with arguments: %s", vargs)
 
@@ -580,10 +1382,60 @@ if __name__ == "__main__":
 		logger.info("Outfolder is going to null device.")
 		args.outfolder = None
 
+	# Same target from --ip and the infile
+	IPs = list(dict.fromkeys(IPs))
+
 	if len(IPs) == 0:
 		logger.error("No IPs specified.")
 		exit(0)
 
-	main(IPs, outfolder=args.outfolder, multiprocessing=not args.nomultiprocessing)
+	if args.norpkicache:
+		RPKI_CACHE = None
+	else:
+		RPKI_CACHE = cache.RPKICache(args.rpkicache, ttl=args.rpkicachettl, max_entries=args.rpkicachesize)
+
+	if args.noascache:
+		AS_CACHE = None
+	else:
+		AS_CACHE = cache.ASCache(args.ascache, ttl=args.ascachettl)
+
+	if args.nopathcache:
+		PATH_CACHE = None
+	else:
+		PATH_CACHE = cache.PathCache(args.pathcache, ttl=args.pathcachettl)
+
+	RESOLVE_TARGETS = not args.noresolve
+	resolver.DNS_CONCURRENCY = args.dnsconcurrency
+	if args.nodnscache:
+		DNS_CACHE = None
+	else:
+		DNS_CACHE = cache.DNSCache(args.dnscache, ttl=args.dnscachettl)
+
+	if args.archive:
+		ARCHIVE = archive.TraceArchive(args.archive)
+
+	if args.pfx2as:
+		AS_TABLE = pfx2as.load_prefix_table(args.pfx2as)
+
+	if args.vrpfile:
+		RPKI_VRPS = vrp.load_vrps(args.vrpfile)
+
+	if args.geodb:
+		GEO_TABLE = ip2location.load_geo_table(args.geodb)
+
+	RPKI_CONCURRENCY = args.rpkiconcurrency
+	RPKI_RATE_LIMIT = args.rpkiratelimit
+
+	exporters = []
+	if args.metricsfile:
+		exporters.append(metrics.TextfileExporter(args.metricsfile, interval=args.metricsinterval).start())
+	if args.metricsport:
+		exporters.append(metrics.HTTPExporter(args.metricsport).start())
+
+	try:
+		main(IPs, outfolder=args.outfolder, multiprocessing=not args.nomultiprocessing, async_concurrency=args.async_concurrency, use_probe_engine=args.probe, resume=args.resume, dataset_root=args.dataset, state=args.state, latex_tables=not args.nolatex, confirm_paths=args.confirm)
+	finally:
+		for exporter in exporters:
+			exporter.stop()
 
 
@@ -0,0 +1,404 @@
+#######################################################
+# Imports #############################################
+#######################################################
+import dataset
+import ip2location
+from common import logger
+
+import array
+import hashlib
+import re
+import socket
+import struct
+import typing
+
+import numpy as np
+import pandas as pd
+
+#######################################################
+# Globals #############################################
+#######################################################
+"""
+Compact storage for a whole run's traces. Instead of a dict per trace holding a dict per hop, the
+hops of every trace live in flat arrays:
+
+ips      uint32 hop addresses, all traces back to back
+rtts     float32 average round trip time per hop in ms (NaN if there wasn't one)
+offsets  where each trace's hops start in ips/rtts, plus one past the end
+
+Traces are appended in the order they finish and `slots` maps a trace's index in the target list
+to its position in `offsets`. Once hops are mapped to ASes, annotate() adds a prefix, ASN and
+RPKI status id per hop, each interned into a small table of strings. Given an
+ip2location.GeoTable it also keeps the IP2LOCATION range of each hop for its location.
+
+That's 17 bytes a hop once annotated, against several hundred for the dicts and strings.
+"""
+
+RTT_PATTERN = r"<?(\d+(?:\.\d+)?)\s*ms"
+
+# Anything that isn't an IPv4 address (IPv6, or a name that didn't resolve) is stored as this and
+# kept as a string on the side.
+NO_IP = 0
+
+IPV4_STRUCT = struct.Struct("!I")
+
+#######################################################
+# Classes #############################################
+#######################################################
+class PackedTrace(typing.NamedTuple):
+	"""
+	One trace as bytes, for sending from a pool worker back to the parent. Pickles to about a
+	quarter of the size of the TracerouteResult it came from.
+	"""
+	destination_ip: str
+	completed: bool
+	ips: bytes
+	rtts: bytes
+	# hop number -> address, for hops that aren't IPv4
+	other_ips: dict[int, str]
+
+	def unpack(self) -> dict:
+		ips = np.frombuffer(self.ips, dtype=np.uint32)
+		rtts = np.frombuffer(self.rtts, dtype=np.float32)
+
+		output = []
+		for hop, (ip, rtt) in enumerate(zip(ips.tolist(), rtts.tolist())):
+			output.append({"timestr": rtt_string(rtt), "ip": self.other_ips.get(hop) or int_to_ip(ip)})
+
+		return {"output": output, "destination_ip": self.destination_ip, "completed": self.completed}
+
+	def fingerprint(self) -> str:
+		return fingerprint(self.ips, self.other_ips.values())
+
+class Interned:
+	"""
+	Strings <-> small integer ids.
+	"""
+	def __init__(self):
+		self.values: list[str] = []
+		self.ids: dict[str, int] = {}
+
+	def __len__(self):
+		return len(self.values)
+
+	def intern(self, value: str) -> int:
+		if value not in self.ids:
+			self.ids[value] = len(self.values)
+			self.values.append(value)
+
+		return self.ids[value]
+
+class TraceStore:
+	def __init__(self, size: int):
+		"""
+		:param size: Number of traces in the run, i.e. the length of the target list.
+		"""
+		self.size = size
+
+		self.slots = np.full(size, -1, dtype=np.int64)
+		self.destinations = np.zeros(size, dtype=np.uint32)
+		self.completed = np.zeros(size, dtype=bool)
+		self.other_destinations: dict[int, str] = {}
+
+		self.ips = array.array("I")
+		self.rtts = array.array("f")
+		self.offsets = array.array("q", [0])
+		# hop position -> address, for hops that aren't IPv4
+		self.other_ips: dict[int, str] = {}
+
+		# Filled in by annotate()
+		self.prefixes = Interned()
+		self.asns = Interned()
+		self.statuses = Interned()
+		self.prefix_ids: np.ndarray = None
+		self.asn_ids: np.ndarray = None
+		self.status_ids: np.ndarray = None
+		# DB3 range of each hop, -1 for none, when annotated with a GeoTable
+		self.geo_table = None
+		self.geo_ids: np.ndarray = None
+
+	def __len__(self):
+		return len(self.offsets) - 1
+
+	@property
+	def hop_count(self) -> int:
+		return len(self.ips)
+
+	def __contains__(self, index: int) -> bool:
+		return self.slots[index] != -1
+
+	def add(self, index: int, result: dict | PackedTrace):
+		"""
+		Stores the trace for target `index`, from a TracerouteResult or a PackedTrace.
+		"""
+		if self.slots[index] != -1:
+			raise ValueError(f"Trace {index} has already been stored")
+
+		if type(result) != PackedTrace:
+			result = pack(result)
+
+		start = len(self.ips)
+		for hop, ip in result.other_ips.items():
+			self.other_ips[start + hop] = ip
+
+		self.ips.frombytes(result.ips)
+		self.rtts.frombytes(result.rtts)
+
+		self.slots[index] = len(self.offsets) - 1
+		self.offsets.append(len(self.ips))
+
+		destination = ip_to_int(result.destination_ip)
+		self.destinations[index] = destination
+		if destination == NO_IP:
+			self.other_destinations[index] = result.destination_ip
+
+		self.completed[index] = result.completed
+
+	def hop_range(self, index: int) -> (int, int):
+		slot = self.slots[index]
+		return self.offsets[slot], self.offsets[slot + 1]
+
+	def destination_ip(self, index: int) -> str:
+		if index in self.other_destinations:
+			return self.other_destinations[index]
+
+		return int_to_ip(int(self.destinations[index]))
+
+	def result(self, index: int) -> dict:
+		"""
+		:return: The trace for target `index` as a TracerouteResult.
+		"""
+		start, end = self.hop_range(index)
+
+		output = []
+		for position in range(start, end):
+			ip = self.other_ips.get(position) or int_to_ip(self.ips[position])
+			output.append({"timestr": rtt_string(self.rtts[position]), "ip": ip})
+
+		return {"output": output, "destination_ip": self.destination_ip(index), "completed": bool(self.completed[index])}
+
+	def fingerprint(self, index: int) -> str:
+		start, end = self.hop_range(index)
+		others = [self.other_ips[p] for p in range(start, end) if p in self.other_ips] if self.other_ips else []
+
+		return fingerprint(self.ips[start:end].tobytes(), others)
+
+	def path(self, index: int) -> list[list[str]]:
+		"""
+		:return: [ip, asn, prefix, status] of each hop of the trace for `index`, as cache.PathCache
+			keeps them. Only once annotated.
+		"""
+		start, end = self.hop_range(index)
+
+		hops = []
+		for position in range(start, end):
+			ip = self.other_ips.get(position) or int_to_ip(self.ips[position])
+			hops.append([
+				ip,
+				self.asns.values[self.asn_ids[position]],
+				self.prefixes.values[self.prefix_ids[position]],
+				self.statuses.values[self.status_ids[position]],
+			])
+
+		return hops
+
+	def hop_ips(self, indexes: typing.Iterable[int] = None) -> list[str]:
+		"""
+		:return: Every distinct hop address in the traces for `indexes`, or in all of them.
+		"""
+		if indexes is None:
+			positions = np.arange(len(self.ips))
+		else:
+			positions = self._positions(np.asarray(list(indexes), dtype=np.int64))
+
+		ips = np.frombuffer(self.ips, dtype=np.uint32)[positions]
+		unique = [int_to_ip(ip) for ip in np.unique(ips[ips != NO_IP]).tolist()]
+
+		others = {self.other_ips[p] for p in positions.tolist() if p in self.other_ips} if self.other_ips else set()
+		return unique + list(others)
+
+	def annotate(self, as_mappings: dict[str, dict], rpki_table: dict[tuple[str, str], dict], geo_table: ip2location.GeoTable = None, known_hops: dict[int, list[list]] = None):
+		"""
+		Looks up each distinct hop address once and gives every hop the ids of its prefix, ASN and
+		RPKI status, and with a geo_table its location.
+
+		:param known_hops: trace index -> [ip, asn, prefix, status] per hop, for traces that take
+			their data from a known path (see cache.PathCache) instead of the tables.
+		"""
+		known_hops = known_hops or {}
+		ips = np.frombuffer(self.ips, dtype=np.uint32)
+		unique, inverse = np.unique(ips, return_inverse=True)
+
+		def ids_for(ip: str) -> tuple[int, int, int]:
+			as_data = as_mappings.get(ip)
+			if as_data is None:
+				# Only seen on known paths, which get their ids below.
+				return self.prefixes.intern("-"), self.asns.intern("-"), self.statuses.intern("-")
+
+			rpki_data = rpki_table[(as_data["asn"], as_data["prefix"])]
+
+			return (
+				self.prefixes.intern(as_data["prefix"] or "-"),
+				self.asns.intern(as_data["asn"] or "-"),
+				self.statuses.intern(rpki_data.get("status", "-").capitalize()),
+			)
+
+		table = np.zeros((len(unique), 3), dtype=np.int32)
+		for row, ip in enumerate(unique.tolist()):
+			if ip != NO_IP:
+				table[row] = ids_for(int_to_ip(ip))
+
+		hop_ids = table[inverse.reshape(-1)]
+		for position, ip in self.other_ips.items():
+			hop_ids[position] = ids_for(ip)
+
+		for index, hops in known_hops.items():
+			start, _ = self.hop_range(index)
+			for position, (_, asn, prefix, status) in enumerate(hops, start):
+				hop_ids[position] = (self.prefixes.intern(prefix or "-"), self.asns.intern(asn or "-"), self.statuses.intern(status or "-"))
+
+		self.prefix_ids = hop_ids[:, 0].copy()
+		self.asn_ids = hop_ids[:, 1].copy()
+		self.status_ids = hop_ids[:, 2].astype(np.int8)
+
+		self.geo_table = geo_table
+		if geo_table is not None:
+			# Every distinct address in one pass. Hops that aren't IPv4 don't have a location.
+			geo_rows = geo_table.lookup_many(unique)
+			geo_rows[unique == NO_IP] = -1
+			self.geo_ids = geo_rows[inverse.reshape(-1)]
+
+		logger.debug(f"Annotated {len(ips)} hop(s): {len(unique)} address(es), {len(self.prefixes)} prefix(es), {len(self.asns)} AS(es)")
+
+	def hop_table(self, targets: list[str]) -> pd.DataFrame:
+		"""
+		Every hop of every stored trace in target order, with dataset.HOP_COLUMNS. String columns
+		are categoricals, so the table stays about as small as the store.
+
+		:param targets: The target list the trace indexes refer to.
+		"""
+		indexes = np.nonzero(self.slots != -1)[0]
+		positions = self._positions(indexes)
+		lengths = self._lengths(indexes)
+
+		trace = np.repeat(indexes, lengths)
+		firsts = np.cumsum(lengths) - lengths
+		hop = np.arange(len(positions)) - np.repeat(firsts, lengths) + 1
+
+		ips = np.frombuffer(self.ips, dtype=np.uint32)[positions]
+		unique, inverse = np.unique(ips, return_inverse=True)
+		ip_strings = np.asarray([int_to_ip(ip) for ip in unique.tolist()], dtype=object)[inverse.reshape(-1)]
+		if self.other_ips:
+			for row in np.nonzero(ips == NO_IP)[0].tolist():
+				ip_strings[row] = self.other_ips.get(positions[row], ip_strings[row])
+
+		destinations = np.asarray([self.destination_ip(index) for index in indexes.tolist()], dtype=object)
+
+		geo = {}
+		for column in dataset.GEO_COLUMNS:
+			if self.geo_table is not None:
+				geo[column] = self.geo_table.column(column, self.geo_ids[positions])
+			else:
+				geo[column] = missing_strings(len(positions))
+
+		return pd.DataFrame({
+			"trace": trace,
+			"target": pd.Categorical(np.asarray(targets, dtype=object)[trace]),
+			"destination_ip": pd.Categorical(np.repeat(destinations, lengths)),
+			"hop": hop,
+			"ip": pd.Categorical(ip_strings),
+			"prefix": pd.Categorical.from_codes(self.prefix_ids[positions], self.prefixes.values) if len(self.prefixes) else missing_strings(len(positions)),
+			"asn": pd.Categorical.from_codes(self.asn_ids[positions], self.asns.values) if len(self.asns) else missing_strings(len(positions)),
+			"status": pd.Categorical.from_codes(self.status_ids[positions], self.statuses.values) if len(self.statuses) else missing_strings(len(positions)),
+			**geo,
+		})[dataset.HOP_COLUMNS]
+
+	def trace_table(self, targets: list[str]) -> pd.DataFrame:
+		"""
+		One row per stored trace in target order, with dataset.TRACE_COLUMNS.
+		"""
+		indexes = np.nonzero(self.slots != -1)[0]
+
+		return pd.DataFrame({
+			"trace": indexes,
+			"destination": np.asarray(targets, dtype=object)[indexes],
+			"destination_ip": [self.destination_ip(index) for index in indexes.tolist()],
+			"completed": self.completed[indexes],
+		})[dataset.TRACE_COLUMNS]
+
+	def _lengths(self, indexes: np.ndarray) -> np.ndarray:
+		offsets = np.frombuffer(self.offsets, dtype=np.int64)
+		slots = self.slots[indexes]
+
+		return offsets[slots + 1] - offsets[slots]
+
+	def _positions(self, indexes: np.ndarray) -> np.ndarray:
+		"""
+		Positions in ips/rtts of every hop of the traces for `indexes`, in that order.
+		"""
+		offsets = np.frombuffer(self.offsets, dtype=np.int64)
+		starts = offsets[self.slots[indexes]]
+		lengths = self._lengths(indexes)
+
+		firsts = np.cumsum(lengths) - lengths
+		return np.arange(lengths.sum(), dtype=np.int64) + np.repeat(starts - firsts, lengths)
+
+#######################################################
+# Functions ###########################################
+#######################################################
+def ip_to_int(ip: str) -> int:
+	# inet_aton is a lot faster than ipaddress, but also takes shorthand like "10.1", hence the dots.
+	try:
+		if ip.count(".") != 3:
+			return NO_IP
+		return IPV4_STRUCT.unpack(socket.inet_aton(ip))[0]
+	except (OSError, AttributeError):
+		return NO_IP
+
+def int_to_ip(ip: int) -> str:
+	return socket.inet_ntoa(IPV4_STRUCT.pack(ip))
+
+def missing_strings(size: int) -> pd.Categorical:
+	"""
+	A column of size missing values that's still typed as strings, for columns a run has nothing
+	in (e.g. no GeoTable). Without categories pandas would take it for numbers.
+	"""
+	return pd.Categorical([None] * size, categories=pd.Index([], dtype=object))
+
+def parse_rtt(timestr: str) -> float:
+	"""
+	Average of the round trip times in a hop's time string, e.g. "<1 ms    2 ms    1 ms" or
+	"0.512 ms  0.431 ms  *". "<1 ms" counts as 1.
+	"""
+	times = re.findall(RTT_PATTERN, timestr)
+	if len(times) == 0:
+		return float("nan")
+
+	return sum(float(t) for t in times) / len(times)
+
+def rtt_string(rtt: float) -> str:
+	if rtt != rtt:
+		# NaN
+		return ""
+
+	return f"{round(rtt, 3):g} ms"
+
+def fingerprint(ips: bytes, other_ips: typing.Iterable[str] = ()) -> str:
+	"""
+	Hash of a path's hop IPs, in order. Two traces to a target with the same fingerprint took the
+	same path, as far as traceroute can tell.
+	"""
+	h = hashlib.blake2b(ips, digest_size=16)
+	for ip in other_ips:
+		h.update(ip.encode())
+
+	return h.hexdigest()
+
+def pack(result: dict) -> PackedTrace:
+	hops = result["output"]
+
+	ips = np.fromiter((ip_to_int(hop["ip"]) for hop in hops), dtype=np.uint32, count=len(hops))
+	rtts = np.fromiter((parse_rtt(hop["timestr"]) for hop in hops), dtype=np.float32, count=len(hops))
+	other_ips = {hop: hops[hop]["ip"] for hop in np.nonzero(ips == NO_IP)[0].tolist()}
+
+	return PackedTrace(result["destination_ip"], bool(result["completed"]), ips.tobytes(), rtts.tobytes(), other_ips)
@@ -0,0 +1,177 @@
+#######################################################
+# Imports #############################################
+#######################################################
+from common import logger
+
+import csv
+import ipaddress
+import json
+import os
+import typing
+
+#######################################################
+# Globals #############################################
+#######################################################
+"""
+Routinator / rpki-client JSON exports look like this:
+{
+	"metadata": { ... },
+	"roas": [
+		{ "asn": "AS13335", "prefix": "1.0.0.0/24", "maxLength": 24, "ta": "apnic" },
+		...
+	]
+}
+
+rpki-client uses a plain integer for "asn", routinator uses the AS-prefixed string.
+
+The CSV exports look like this:
+ASN,IP Prefix,Max Length,Trust Anchor
+AS13335,1.0.0.0/24,24,apnic
+"""
+
+#######################################################
+# Classes #############################################
+#######################################################
+class VRP(typing.NamedTuple):
+	asn: int
+	prefix: str
+	max_length: int
+
+class VRPIndex:
+	"""
+	In-memory index of Validated ROA Payloads for route origin validation (RFC 6811).
+
+	VRPs are bucketed by address family and prefix length, keyed on the network address as an
+	integer. Finding every covering VRP for a route is then one dict lookup per distinct prefix
+	length that's actually in use, which is at most a few dozen.
+	"""
+
+	def __init__(self, vrps: typing.Iterable[VRP] = ()):
+		# version -> prefix length -> network int -> [VRP, ...]
+		self.tables: dict[int, dict[int, dict[int, list[VRP]]]] = {4: {}, 6: {}}
+		self.lengths: dict[int, list[int]] = {4: [], 6: []}
+		self.count = 0
+
+		for v in vrps:
+			self.add(v)
+
+	def add(self, v: VRP):
+		network = ipaddress.ip_network(v.prefix, strict=False)
+		table = self.tables[network.version]
+
+		if network.prefixlen not in table:
+			table[network.prefixlen] = {}
+			self.lengths[network.version] = sorted(table.keys())
+
+		table[network.prefixlen].setdefault(int(network.network_address), []).append(v)
+		self.count += 1
+
+	def covering(self, network: ipaddress.IPv4Network | ipaddress.IPv6Network) -> list[VRP]:
+		table = self.tables[network.version]
+		address = int(network.network_address)
+		bits = network.max_prefixlen
+
+		found = []
+		for length in self.lengths[network.version]:
+			if length > network.prefixlen:
+				break
+
+			mask = ((1 << length) - 1) << (bits - length)
+			found += table[length].get(address & mask, [])
+
+		return found
+
+	def validate(self, asn: str, ip_prefix: str) -> dict:
+		"""
+		Validates a route the same way RIPEstat's rpki-validation call does.
+
+		:param asn: Origin AS, with or without the "AS" prefix.
+		:param ip_prefix: The announced prefix.
+		:return: A dict shaped like the "data" object of the RIPEstat response.
+		"""
+		try:
+			network = ipaddress.ip_network(ip_prefix, strict=False)
+			origin = parse_asn(asn)
+		except ValueError:
+			return {}
+
+		vrps = self.covering(network)
+
+		status = "unknown"
+		validating = []
+		if len(vrps) > 0:
+			status = "invalid_asn"
+			for v in vrps:
+				if v.asn != origin or v.asn == 0:
+					validity = "invalid_asn"
+				elif network.prefixlen > v.max_length:
+					validity = "invalid_length"
+				else:
+					validity = "valid"
+
+				if validity == "valid":
+					status = "valid"
+				elif validity == "invalid_length" and status != "valid":
+					status = "invalid_length"
+
+				validating.append({
+					"origin": str(v.asn),
+					"prefix": v.prefix,
+					"max_length": v.max_length,
+					"validity": validity
+				})
+
+		return {
+			"validating_roas": validating,
+			"status": status,
+			"validator": "local",
+			"resource": str(origin),
+			"prefix": ip_prefix
+		}
+
+#######################################################
+# Functions ###########################################
+#######################################################
+def parse_asn(asn: str | int) -> int:
+	if type(asn) == int:
+		return asn
+
+	asn = asn.strip().upper()
+	if asn.startswith("AS"):
+		asn = asn[2:]
+
+	return int(asn)
+
+def read_vrp_json(path: str) -> typing.Iterator[VRP]:
+	with open(path, "r") as f:
+		data = json.load(f)
+
+	for roa in data["roas"]:
+		prefix = roa["prefix"]
+		max_length = roa.get("maxLength") or int(prefix.split("/")[1])
+		yield VRP(parse_asn(roa["asn"]), prefix, int(max_length))
+
+def read_vrp_csv(path: str) -> typing.Iterator[VRP]:
+	with open(path, "r", newline="") as f:
+		reader = csv.reader(f)
+		for row in reader:
+			if len(row) < 3 or not row[0].strip().upper().startswith("AS"):
+				# Header or junk.
+				continue
+
+			yield VRP(parse_asn(row[0]), row[1].strip(), int(row[2]))
+
+def load_vrps(path: str) -> VRPIndex:
+	ext = os.path.splitext(path)[1]
+
+	if ext == ".json":
+		vrps = read_vrp_json(path)
+	elif ext == ".csv":
+		vrps = read_vrp_csv(path)
+	else:
+		raise ValueError(f"Unable to read VRPs from filetype [{ext}]")
+
+	index = VRPIndex(vrps)
+	logger.info(f"Loaded {index.count} VRPs from {path}")
+
+	return index
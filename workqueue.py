@@ -0,0 +1,408 @@
+#######################################################
+# Imports #############################################
+#######################################################
+import cache
+from common import logger
+
+import argparse
+import http.server
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import typing
+
+import requests
+
+#######################################################
+# Globals #############################################
+#######################################################
+"""
+Hands out a campaign's work units (states) to however many PCs are tracing, instead of each PC
+taking a fixed slice. Every PC pulls the next unit when it's done with its last one, so fast PCs
+end up doing more of the work, and the campaign finishes about when the total work divided by the
+number of PCs would suggest.
+
+A unit is leased to one worker at a time. Workers renew their lease with a heartbeat while they
+work on it, and a unit whose lease runs out (its PC died or lost the network) goes back to
+whoever asks next.
+
+The queue is a SQLite file. PCs can share it directly, or one PC serves it over HTTP and the
+rest point at that:
+
+python workqueue.py serve ./work_queue.sqlite3 --host 10.0.0.2 --port 8765
+python workqueue.py status http://10.0.0.2:8765
+
+There's no authentication, anyone who can reach the server can lease and complete units. It only
+listens on localhost unless given the address (or 0.0.0.0 for every interface) to serve on.
+
+See delegate_tracer.py for the worker side.
+"""
+
+QUEUE_PATH = "./work_queue.sqlite3"
+QUEUE_HOST = "127.0.0.1"
+QUEUE_PORT = 8765
+
+LEASE_TTL = 15 * 60  # Seconds a lease lasts without a heartbeat
+HEARTBEAT_INTERVAL = 60  # Seconds between heartbeats, keep this well under LEASE_TTL
+# Seconds a worker with nothing left to lease waits before checking again. Units other workers
+# hold could still come back, at the latest LEASE_TTL after their last heartbeat.
+POLL_INTERVAL = LEASE_TTL
+# A unit that's been leased this many times without finishing is probably what's killing its
+# workers, so it's left alone.
+MAX_ATTEMPTS = 3
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+
+HTTP_TIMEOUT = 30
+# Attempts at a request the server answers with 503, i.e. its SQLite file was busy. Backs off 1, 2,
+# 4, ... seconds in between.
+HTTP_RETRIES = 5
+
+#######################################################
+# Classes #############################################
+#######################################################
+class Lease(typing.NamedTuple):
+	unit: str
+	payload: typing.Any
+	attempt: int
+
+class WorkQueue:
+	"""
+	The queue itself, in a SQLite file. Every change is one IMMEDIATE transaction, so any number
+	of processes (or PCs sharing the file) can use it at once. Like cache.SQLiteCache, the
+	connection is opened lazily and per process.
+	"""
+
+	SCHEMA = """
+	CREATE TABLE IF NOT EXISTS units (
+		unit TEXT PRIMARY KEY,
+		position INTEGER NOT NULL,
+		payload TEXT NOT NULL,
+		status TEXT NOT NULL,
+		worker TEXT,
+		expires REAL,
+		attempts INTEGER NOT NULL DEFAULT 0,
+		started REAL,
+		finished REAL
+	);
+	CREATE INDEX IF NOT EXISTS units_status ON units (status, position);
+	"""
+
+	def __init__(self, path: str = QUEUE_PATH, lease_ttl: float = LEASE_TTL, max_attempts: int = MAX_ATTEMPTS):
+		self.path = path
+		self.lease_ttl = lease_ttl
+		self.max_attempts = max_attempts
+
+		self._conn = None
+		self._pid = None
+		# The HTTP server calls in from a thread per request.
+		self._lock = threading.Lock()
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		state["_conn"] = None
+		state["_pid"] = None
+		state["_lock"] = None
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self._lock = threading.Lock()
+
+	@property
+	def conn(self) -> sqlite3.Connection:
+		if self._conn is None or self._pid != os.getpid():
+			folder = os.path.dirname(self.path)
+			if folder:
+				os.makedirs(folder, exist_ok=True)
+
+			self._conn = sqlite3.connect(self.path, timeout=cache.SQLITE_TIMEOUT, isolation_level=None, check_same_thread=False)
+			# No WAL: it needs shared memory, which doesn't work for a file on a network share.
+			self._conn.executescript(self.SCHEMA)
+			self._pid = os.getpid()
+
+		return self._conn
+
+	def _transaction(self, work: typing.Callable[[sqlite3.Connection], typing.Any]) -> typing.Any:
+		with self._lock:
+			conn = self.conn
+			conn.execute("BEGIN IMMEDIATE")
+			try:
+				result = work(conn)
+				conn.execute("COMMIT")
+			except Exception:
+				conn.execute("ROLLBACK")
+				raise
+
+		return result
+
+	def add(self, units: typing.Iterable[tuple[str, typing.Any]]) -> int:
+		"""
+		Adds units in the order they should be handed out. Units that are already queued (from
+		another worker, or an earlier start) are left as they are, so every worker can add the
+		whole campaign.
+
+		:param units: (unit, payload) pairs, payloads must be JSON serializable.
+		:return: How many units were new.
+		"""
+		def work(conn):
+			position = conn.execute("SELECT COALESCE(MAX(position), -1) + 1 FROM units").fetchone()[0]
+			rows = [(unit, position + i, json.dumps(payload), PENDING) for i, (unit, payload) in enumerate(units)]
+			before = conn.total_changes
+			conn.executemany("INSERT OR IGNORE INTO units (unit, position, payload, status) VALUES (?, ?, ?, ?)", rows)
+			return conn.total_changes - before
+
+		return self._transaction(work)
+
+	def lease(self, worker: str) -> Lease | None:
+		"""
+		:return: The next pending unit, or one whose lease ran out, now leased to `worker`. None
+			once there's nothing left to hand out.
+		"""
+		def work(conn):
+			now = time.time()
+			row = conn.execute(
+				"SELECT unit, payload, attempts FROM units WHERE (status = ? OR (status = ? AND expires < ?)) AND attempts < ? ORDER BY position LIMIT 1",
+				(PENDING, LEASED, now, self.max_attempts)
+			).fetchone()
+			if row is None:
+				return None
+
+			unit, payload, attempts = row
+			conn.execute(
+				"UPDATE units SET status = ?, worker = ?, expires = ?, attempts = ?, started = ? WHERE unit = ?",
+				(LEASED, worker, now + self.lease_ttl, attempts + 1, now, unit)
+			)
+			return Lease(unit, json.loads(payload), attempts + 1)
+
+		return self._transaction(work)
+
+	def _update_lease(self, unit: str, worker: str, sql: str, params: tuple) -> bool:
+		def work(conn):
+			cursor = conn.execute(sql + " WHERE unit = ? AND worker = ? AND status = ?", params + (unit, worker, LEASED))
+			return cursor.rowcount == 1
+
+		return self._transaction(work)
+
+	def heartbeat(self, unit: str, worker: str) -> bool:
+		"""
+		:return: False if `worker` doesn't hold the lease anymore.
+		"""
+		return self._update_lease(unit, worker, "UPDATE units SET expires = ?", (time.time() + self.lease_ttl,))
+
+	def complete(self, unit: str, worker: str) -> bool:
+		"""
+		:return: False if the lease had already gone to someone else. The unit is done either way.
+		"""
+		if self._update_lease(unit, worker, "UPDATE units SET status = ?, finished = ?", (DONE, time.time())):
+			return True
+
+		self._transaction(lambda conn: conn.execute("UPDATE units SET status = ?, finished = ? WHERE unit = ? AND status != ?", (DONE, time.time(), unit, DONE)))
+		return False
+
+	def release(self, unit: str, worker: str) -> bool:
+		"""
+		Gives a unit back without finishing it, e.g. after an error, so it can be leased again.
+		"""
+		return self._update_lease(unit, worker, "UPDATE units SET status = ?, worker = NULL, expires = NULL", (PENDING,))
+
+	def status(self) -> dict[str, int]:
+		"""
+		:return: How many units are pending, leased (and still live), expired, failed and done.
+		"""
+		def work(conn):
+			now = time.time()
+			counts = {PENDING: 0, LEASED: 0, "expired": 0, "failed": 0, DONE: 0}
+			for status, expires, attempts in conn.execute("SELECT status, expires, attempts FROM units"):
+				if status == LEASED and expires < now:
+					status = "expired"
+				if status != DONE and status != LEASED and attempts >= self.max_attempts:
+					status = "failed"
+
+				counts[status] += 1
+
+			return counts
+
+		return self._transaction(work)
+
+	def close(self):
+		if self._conn is not None and self._pid == os.getpid():
+			self._conn.close()
+
+		self._conn = None
+		self._pid = None
+
+class RemoteWorkQueue:
+	"""
+	Same interface as WorkQueue, for a queue served by QueueServer.
+	"""
+
+	def __init__(self, url: str):
+		self.url = url.rstrip("/")
+		self.session = requests.Session()
+
+	def _post(self, method: str, **data) -> typing.Any:
+		for attempt in range(HTTP_RETRIES):
+			response = self.session.post(f"{self.url}/{method}", json=data, timeout=HTTP_TIMEOUT)
+			if response.status_code != 503 or attempt + 1 == HTTP_RETRIES:
+				break
+
+			logger.warning(f"Work queue busy ({method}), attempt {attempt + 1}/{HTTP_RETRIES}")
+			time.sleep(2 ** attempt)
+
+		response.raise_for_status()
+		return response.json()["result"]
+
+	def add(self, units: typing.Iterable[tuple[str, typing.Any]]) -> int:
+		return self._post("add", units=list(units))
+
+	def lease(self, worker: str) -> Lease | None:
+		result = self._post("lease", worker=worker)
+		return result and Lease(*result)
+
+	def heartbeat(self, unit: str, worker: str) -> bool:
+		return self._post("heartbeat", unit=unit, worker=worker)
+
+	def complete(self, unit: str, worker: str) -> bool:
+		return self._post("complete", unit=unit, worker=worker)
+
+	def release(self, unit: str, worker: str) -> bool:
+		return self._post("release", unit=unit, worker=worker)
+
+	def status(self) -> dict[str, int]:
+		return self._post("status")
+
+	def close(self):
+		self.session.close()
+
+class QueueHandler(http.server.BaseHTTPRequestHandler):
+	"""
+	POST /<method> with the method's arguments as a JSON object, answers {"result": ...}.
+	"""
+	queue: WorkQueue = None
+	methods = ["add", "lease", "heartbeat", "complete", "release", "status"]
+
+	def do_POST(self):
+		method = self.path.strip("/")
+		if method not in self.methods:
+			self.send_error(404)
+			return
+
+		try:
+			length = int(self.headers.get("Content-Length") or 0)
+			data = json.loads(self.rfile.read(length) or b"{}")
+			result = getattr(self.queue, method)(**data)
+		except (TypeError, ValueError) as err:
+			self.send_error(400, str(err))
+			return
+		except sqlite3.OperationalError as err:
+			# Locked or busy for longer than cache.SQLITE_TIMEOUT. Nothing was changed, the client can
+			# ask again.
+			logger.warning(f"Work queue {method} failed ({err})")
+			self.send_error(503, str(err))
+			return
+
+		body = json.dumps({"result": result}).encode()
+		self.send_response(200)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		logger.debug(f"{self.address_string()} {format % args}")
+
+class Heartbeat:
+	"""
+	Keeps a lease alive from a background thread while the unit is worked on:
+
+	with Heartbeat(queue, lease.unit, worker) as heartbeat:
+		...
+	"""
+
+	def __init__(self, queue: WorkQueue | RemoteWorkQueue, unit: str, worker: str, interval: float = HEARTBEAT_INTERVAL):
+		self.queue = queue
+		self.unit = unit
+		self.worker = worker
+		self.interval = interval
+		# Set once the lease has gone to another worker, the work might get done twice.
+		self.lost = False
+
+		self._stop = threading.Event()
+		self._thread = None
+
+	def run(self):
+		while not self._stop.wait(self.interval):
+			try:
+				held = self.queue.heartbeat(self.unit, self.worker)
+			except Exception as err:
+				# Keep trying, the lease doesn't run out for a while.
+				logger.warning(f"Heartbeat for {self.unit} failed ({err})")
+				continue
+
+			if not held and not self.lost:
+				self.lost = True
+				logger.warning(f"Lost the lease on {self.unit}, another worker may be doing it too")
+
+	def __enter__(self) -> "Heartbeat":
+		self._thread = threading.Thread(target=self.run, daemon=True)
+		self._thread.start()
+		return self
+
+	def __exit__(self, *exc):
+		self._stop.set()
+		self._thread.join()
+
+#######################################################
+# Functions ###########################################
+#######################################################
+def open_queue(location: str) -> WorkQueue | RemoteWorkQueue:
+	"""
+	:param location: A SQLite file, or the http:// URL of a QueueServer.
+	"""
+	if location.startswith("http://") or location.startswith("https://"):
+		return RemoteWorkQueue(location)
+
+	return WorkQueue(location)
+
+def worker_name() -> str:
+	return f"{socket.gethostname()}-{os.getpid()}"
+
+def serve(path: str, port: int = QUEUE_PORT, host: str = QUEUE_HOST):
+	QueueHandler.queue = WorkQueue(path)
+	server = http.server.ThreadingHTTPServer((host, port), QueueHandler)
+	server.daemon_threads = True
+
+	logger.info(f"Serving the work queue in {path} on {host}:{server.server_address[1]}")
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+
+#######################################################
+# Initialization ######################################
+#######################################################
+parser = argparse.ArgumentParser(
+	prog="workqueue.py",
+	description="Serves a campaign's work queue over HTTP, or shows how far along it is."
+)
+
+parser.add_argument("command", type=str, choices=["serve", "status"], help="serve: share a queue file over HTTP. status: count the units in each state.")
+parser.add_argument("queue", type=str, nargs="?", default=QUEUE_PATH, help="The queue's SQLite file, or for status also a served queue's URL.")
+parser.add_argument("--port", type=int, default=QUEUE_PORT, help="Port to serve on.")
+parser.add_argument("--host", type=str, default=QUEUE_HOST, help="Address to serve on. Defaults to localhost only, give the LAN address (or 0.0.0.0 for every interface) for other PCs to reach it.")
+
+if __name__ == "__main__":
+	args = parser.parse_args()
+
+	if args.command == "serve":
+		serve(args.queue, port=args.port, host=args.host)
+	else:
+		print(json.dumps(open_queue(args.queue).status(), indent=4))